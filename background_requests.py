@@ -0,0 +1,90 @@
+"""Send the requests to the online sources whose replies aren't needed in the background, away from the moves."""
+from __future__ import annotations
+import collections
+import logging
+import threading
+import time
+import lichess
+import requests
+from urllib.parse import urlparse
+from typing import Any, Deque, Dict, OrderedDict, Tuple
+
+# The most requests that wait to be sent to a host. Further requests are dropped.
+MAX_PENDING_REQUESTS = 1000
+# The number of recently sent requests that are remembered, so that they aren't sent again.
+MAX_SENT_REQUESTS = 10000
+# The most time in seconds that one request may take, including its retries.
+REQUEST_TIME = 5
+# The time in seconds that the first request waits for others, so that they are sent together over one connection.
+BATCH_DELAY = 2
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRequests:
+    """
+    Sends the requests to one host from a background thread. The requests are collected for a while and then sent
+    one after another, so that they share a connection and the thread sleeps between the batches.
+
+    Requests that are already waiting or that were sent recently are not sent again. When too many requests are
+    waiting, new ones are dropped. A request that fails is not retried, since its reply isn't needed.
+
+    The thread has a `requests.Session` of its own, since sessions can't be shared between threads. The requests are
+    only deduplicated within a process, so the game processes of the process game runner can each send the same one.
+    """
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.lock = threading.Lock()
+        self.requests_waiting = threading.Condition(self.lock)
+        self.pending: Deque[Tuple[lichess.Lichess, str, Dict[str, Any]]] = collections.deque()
+        self.keys: OrderedDict[str, None] = collections.OrderedDict()
+        self.dropped = 0
+        self.session = requests.Session()
+        self.thread = threading.Thread(target=self.run, name=f"requests-{host}", daemon=True)
+        self.thread.start()
+
+    def submit(self, li: lichess.Lichess, path: str, params: Dict[str, Any]) -> None:
+        key = path + "?" + "&".join(f"{name}={value}" for name, value in sorted(params.items()))
+        with self.lock:
+            if key in self.keys:
+                return
+            if len(self.pending) >= MAX_PENDING_REQUESTS:
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    logger.debug(f"Dropped {self.dropped} request(s) to {self.host} because too many are waiting.")
+                return
+            self.keys[key] = None
+            if len(self.keys) > MAX_SENT_REQUESTS:
+                self.keys.popitem(last=False)
+            self.pending.append((li, path, dict(params)))
+            self.requests_waiting.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.requests_waiting.wait()
+            time.sleep(BATCH_DELAY)
+            with self.lock:
+                batch, self.pending = self.pending, collections.deque()
+
+            for li, path, params in batch:
+                try:
+                    li.online_book_get(path, params=params, max_time=REQUEST_TIME, session=self.session)
+                except Exception as error:
+                    logger.debug(f"A background request to {self.host} failed: {error!r}")
+
+
+hosts: Dict[str, BackgroundRequests] = {}
+hosts_lock = threading.Lock()
+
+
+def send_in_background(li: lichess.Lichess, path: str, params: Dict[str, Any]) -> None:
+    """Send a request whose reply isn't needed without waiting for it. The requests to each host share a thread."""
+    host = urlparse(path).netloc
+    with hosts_lock:
+        # The thread doesn't survive when a game process is forked from this one.
+        if host not in hosts or not hosts[host].thread.is_alive():
+            hosts[host] = BackgroundRequests(host)
+        background_requests = hosts[host]
+    background_requests.submit(li, path, params)
@@ -84,9 +84,37 @@ def change_value_to_list(config: CONFIG_DICT_TYPE, *sections: str, key: str) ->
 def insert_default_values(CONFIG: CONFIG_DICT_TYPE) -> None:
     set_config_default(CONFIG, key="abort_time", default=20)
     set_config_default(CONFIG, key="move_overhead", default=1000)
+    set_config_default(CONFIG, key="adaptive_move_overhead", default=False)
     set_config_default(CONFIG, key="rate_limiting_delay", default=0)
+    set_config_default(CONFIG, key="game_runner", default="process", force_empty_values=True)
     set_config_default(CONFIG, "engine", key="working_dir", default=os.getcwd(), force_empty_values=True)
     set_config_default(CONFIG, "engine", key="silence_stderr", default=False)
+    set_config_default(CONFIG, "engine", "engine_pool", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "engine_pool", key="max_games", default=100)
+    set_config_default(CONFIG, "engine", "resource_scheduler", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "resource_scheduler", key="threads", default=0, force_empty_values=True)
+    set_config_default(CONFIG, "engine", "resource_scheduler", key="hash", default=0, force_empty_values=True)
+    set_config_default(CONFIG, "engine", "resource_scheduler", key="suspend_ponder", default=False)
+    set_config_default(CONFIG, "engine", "cpu_affinity", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "cpu_affinity", key="housekeeping_cores", default=1)
+    set_config_default(CONFIG, "engine", "early_stop", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "early_stop", key="stable_depths", default=6)
+    set_config_default(CONFIG, "engine", "early_stop", key="score_drop", default=30)
+    set_config_default(CONFIG, "engine", "early_stop", key="max_extension", default=3)
+    set_config_default(CONFIG, "engine", "early_stop", key="min_time_share", default=0.3)
+    set_config_default(CONFIG, "engine", "recovery", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "recovery", key="ping_timeout", default=2)
+    set_config_default(CONFIG, "engine", "recovery", key="standby_engine", default=None)
+    set_config_default(CONFIG, "engine", "fast_path", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "fast_path", key="pv_min_depth", default=12)
+    set_config_default(CONFIG, "engine", "fast_path", key="confirm_time", default=0)
+    set_config_default(CONFIG, "engine", "emergency_mode", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "emergency_mode", key="min_time", default=3000)
+    set_config_default(CONFIG, "engine", "emergency_mode", key="move_time", default=100)
+    set_config_default(CONFIG, "engine", "speculative_search", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "move_sources", key="order", force_empty_values=True,
+                       default=["polyglot", "syzygy", "gaviota", "online_egtb", "chessdb_book", "lichess_cloud_analysis"])
+    set_config_default(CONFIG, "engine", "move_sources", key="budgets", default={}, force_empty_values=True)
     set_config_default(CONFIG, "engine", "draw_or_resign", key="offer_draw_enabled", default=False)
     set_config_default(CONFIG, "engine", "draw_or_resign", key="offer_draw_for_egtb_zero", default=True)
     set_config_default(CONFIG, "engine", "draw_or_resign", key="resign_enabled", default=False)
@@ -98,11 +126,24 @@ def insert_default_values(CONFIG: CONFIG_DICT_TYPE) -> None:
     set_config_default(CONFIG, "engine", "draw_or_resign", key="offer_draw_pieces", default=10)
     set_config_default(CONFIG, "engine", "online_moves", key="max_out_of_book_moves", default=10)
     set_config_default(CONFIG, "engine", "online_moves", key="max_retries", default=2, force_empty_values=True)
+    set_config_default(CONFIG, "engine", "online_moves", "concurrent_lookups", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "online_moves", "concurrent_lookups", key="time_share", default=0.02)
+    set_config_default(CONFIG, "engine", "online_moves", "concurrent_lookups", key="max_time", default=5)
+    set_config_default(CONFIG, "engine", "online_moves", "cache", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "online_moves", "cache", key="path", default="online_cache.sqlite")
+    set_config_default(CONFIG, "engine", "online_moves", "cache", key="ttl", default=168)
+    set_config_default(CONFIG, "engine", "online_moves", "cache", key="negative_ttl", default=1)
+    set_config_default(CONFIG, "engine", "online_moves", "cache", key="max_entries", default=1000000)
+    set_config_default(CONFIG, "engine", "online_moves", "prefetch", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "online_moves", "prefetch", key="max_positions", default=3)
+    set_config_default(CONFIG, "engine", "online_moves", "prefetch", key="min_interval", default=1)
     set_config_default(CONFIG, "engine", "online_moves", "online_egtb", key="enabled", default=False)
     set_config_default(CONFIG, "engine", "online_moves", "online_egtb", key="source", default="lichess")
     set_config_default(CONFIG, "engine", "online_moves", "online_egtb", key="min_time", default=20)
     set_config_default(CONFIG, "engine", "online_moves", "online_egtb", key="max_pieces", default=7)
     set_config_default(CONFIG, "engine", "online_moves", "online_egtb", key="move_quality", default="best")
+    set_config_default(CONFIG, "engine", "online_moves", "online_egtb", key="url", default="http://tablebase.lichess.ovh",
+                       force_empty_values=True)
     set_config_default(CONFIG, "engine", "online_moves", "chessdb_book", key="enabled", default=False)
     set_config_default(CONFIG, "engine", "online_moves", "chessdb_book", key="min_time", default=20)
     set_config_default(CONFIG, "engine", "online_moves", "chessdb_book", key="move_quality", default="good")
@@ -117,10 +158,18 @@ def insert_default_values(CONFIG: CONFIG_DICT_TYPE) -> None:
     set_config_default(CONFIG, "engine", "lichess_bot_tbs", "syzygy", key="enabled", default=False)
     set_config_default(CONFIG, "engine", "lichess_bot_tbs", "syzygy", key="max_pieces", default=7)
     set_config_default(CONFIG, "engine", "lichess_bot_tbs", "syzygy", key="move_quality", default="best")
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "syzygy", key="max_open_files", default=128)
     set_config_default(CONFIG, "engine", "lichess_bot_tbs", "gaviota", key="enabled", default=False)
     set_config_default(CONFIG, "engine", "lichess_bot_tbs", "gaviota", key="max_pieces", default=5)
     set_config_default(CONFIG, "engine", "lichess_bot_tbs", "gaviota", key="move_quality", default="best")
     set_config_default(CONFIG, "engine", "lichess_bot_tbs", "gaviota", key="min_dtm_to_consider_as_wdl_1", default=120)
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "gaviota", key="max_open_files", default=32)
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "shared_cache", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "shared_cache", key="size", default=64)
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "prewarm", key="enabled", default=False)
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "prewarm", key="ram_budget", default=1024)
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "prewarm", key="interval", default=60)
+    set_config_default(CONFIG, "engine", "lichess_bot_tbs", "prewarm", key="probe_log", default="tablebase_probes.log")
     set_config_default(CONFIG, "engine", "polyglot", key="enabled", default=False)
     set_config_default(CONFIG, "engine", "polyglot", key="max_depth", default=8)
     set_config_default(CONFIG, "engine", "polyglot", key="selection", default="weighted_random")
@@ -137,6 +186,8 @@ def insert_default_values(CONFIG: CONFIG_DICT_TYPE) -> None:
     set_config_default(CONFIG, "challenge", key="min_days", default=1)
     set_config_default(CONFIG, "challenge", key="block_list", default=[], force_empty_values=True)
     set_config_default(CONFIG, "correspondence", key="checkin_period", default=600)
+    set_config_default(CONFIG, "correspondence", "keep_engines", key="enabled", default=False)
+    set_config_default(CONFIG, "correspondence", "keep_engines", key="max_engines", default=4)
     set_config_default(CONFIG, "correspondence", key="move_time", default=60, force_empty_values=True)
     set_config_default(CONFIG, "correspondence", key="disconnect_time", default=300)
     set_config_default(CONFIG, "matchmaking", key="challenge_timeout", default=30, force_empty_values=True)
@@ -192,6 +243,12 @@ def load_config(config_file: str) -> Configuration:
         check_config_section(CONFIG, "dir", str, "engine")
         check_config_section(CONFIG, "name", str, "engine")
 
+        config_assert(CONFIG.get("game_runner") in [None, "", "process", "thread"],
+                      f'`game_runner` must be "process" or "thread", not `{CONFIG.get("game_runner")}`.')
+        keep_engines_cfg = (CONFIG.get("correspondence") or {}).get("keep_engines") or {}
+        config_assert(not keep_engines_cfg.get("enabled") or CONFIG.get("game_runner") == "thread",
+                      '`keep_engines` in `correspondence` needs `game_runner: "thread"`, since the engines of a game '
+                      'process are lost when another process plays the next check-in of the game.')
         config_assert(CONFIG["token"] != "xxxxxxxxxxxxxxxx",
                       "Your config.yml has the default Lichess API token. This is probably wrong.")
         config_assert(os.path.isdir(CONFIG["engine"]["dir"]),
@@ -207,6 +264,12 @@ def load_config(config_file: str) -> Configuration:
         config_assert(os.access(engine, os.X_OK) or CONFIG["engine"]["protocol"] == "homemade",
                       f"The engine {engine} doesn't have execute (x) permission. Try: chmod +x {engine}")
 
+        move_sources = ["polyglot", "syzygy", "gaviota", "online_egtb", "chessdb_book", "lichess_cloud_analysis"]
+        move_sources_cfg = CONFIG["engine"].get("move_sources") or {}
+        for move_source in list(move_sources_cfg.get("order") or []) + list(move_sources_cfg.get("budgets") or {}):
+            config_assert(move_source in move_sources,
+                          f"`{move_source}` in `move_sources` is not one of the move sources {move_sources}.")
+
         if CONFIG["engine"]["protocol"] == "xboard":
             for section, subsection in (("online_moves", "online_egtb"),
                                         ("lichess_bot_tbs", "syzygy"),
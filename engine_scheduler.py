@@ -0,0 +1,194 @@
+"""Share the CPU threads and hash memory of the machine between the engines of concurrent games."""
+from __future__ import annotations
+import math
+import os
+import logging
+import threading
+import config
+import model
+from engine_wrapper import EngineWrapper
+from types import TracebackType
+from typing import Dict, List, MutableMapping, Optional, Tuple, Type
+RESOURCE_WEIGHTS_TYPE = MutableMapping[str, float]
+SEARCHING_GAMES_TYPE = MutableMapping[str, bool]
+
+# An engine only gets a new number of threads if it differs from its current number by at least this fraction.
+THREAD_CHANGE_THRESHOLD = 0.25
+
+# The cores this process may use before it pins itself to the housekeeping cores.
+AVAILABLE_CORES = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceScheduler:
+    """
+    Gives the engine of a game its share of the machine-wide thread and hash budget.
+
+    Every game writes its weight to a dictionary shared by all games (a `multiprocessing.Manager` dict), so each game
+    can compute its share without talking to the others. Games with less time per move get a larger weight, so a
+    bullet game under time pressure gets more threads than a rapid game with plenty of time. The time per move is
+    rounded to a power of two and an engine only gets a new number of threads when it changes by at least one thread
+    and `THREAD_CHANGE_THRESHOLD` of its current threads, since engines like Stockfish clear their hash when the
+    number of threads changes. The hash is split evenly and rounded down to a power of two, so it only changes when
+    the number of games does.
+
+    With `suspend_ponder`, the engine of this game stops pondering while the engine of another game is searching and
+    ponders again once no other game is searching, so that pondering doesn't slow down the engines that have to move.
+    """
+    def __init__(self, weights: RESOURCE_WEIGHTS_TYPE, searching_games: SEARCHING_GAMES_TYPE,
+                 scheduler_cfg: config.Configuration, game: model.Game) -> None:
+        self.weights = weights
+        self.searching_games = searching_games
+        self.enabled = bool(scheduler_cfg.enabled)
+        self.total_threads: int = scheduler_cfg.threads or os.cpu_count() or 1
+        self.total_hash: int = scheduler_cfg.hash
+        self.game = game
+        self.current_allocation: Tuple[int, int] = (0, 0)
+
+        self.suspend_ponder = bool(scheduler_cfg.suspend_ponder)
+        self.lock = threading.Lock()
+        self.pondering_engine: Optional[EngineWrapper] = None
+        self.ponder_suspended = False
+        self.finished = threading.Event()
+        self.ponder_watcher = threading.Thread(target=self.watch_ponder, name=f"ponder-{game.id}", daemon=True)
+
+    def __enter__(self) -> ResourceScheduler:
+        if self.suspend_ponder:
+            self.ponder_watcher.start()
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.finished.set()
+        if self.ponder_watcher.is_alive():
+            self.ponder_watcher.join()
+        self.weights.pop(self.game.id, None)
+        self.searching_games.pop(self.game.id, None)
+
+    def game_weight(self) -> float:
+        moves_to_go = 30
+        time_per_move = self.game.my_remaining_seconds() / moves_to_go + self.game.clock_increment / 1000
+        rounded_time_per_move = 2 ** round(math.log2(max(time_per_move, 0.1)))
+        return 1 / math.sqrt(rounded_time_per_move)
+
+    def allocate(self) -> Tuple[int, int]:
+        self.weights[self.game.id] = self.game_weight()
+        weights = dict(self.weights)
+        share = weights[self.game.id] / sum(weights.values())
+        threads = max(1, int(self.total_threads * share))
+        hash_share = self.total_hash // len(weights)
+        hash_size = 2 ** int(math.log2(hash_share)) if hash_share > 0 else 0
+        return threads, hash_size
+
+    def start_search(self, engine: EngineWrapper) -> None:
+        """Give the engine its resources before it searches for a move."""
+        with self.lock:
+            self.pondering_engine = None
+            self.ponder_suspended = False
+            if self.suspend_ponder:
+                self.searching_games[self.game.id] = True
+        self.configure_engine(engine)
+
+    def end_search(self, engine: EngineWrapper) -> None:
+        """Let the watcher know that the engine may be pondering now."""
+        with self.lock:
+            if self.suspend_ponder:
+                self.searching_games.pop(self.game.id, None)
+            self.pondering_engine = engine if engine.ponder_board is not None else None
+
+    def other_game_is_searching(self) -> bool:
+        return any(game_id != self.game.id for game_id in self.searching_games.keys())
+
+    def watch_ponder(self) -> None:
+        while not self.finished.wait(0.05):
+            if self.pondering_engine is None:
+                continue
+            other_game_is_searching = self.other_game_is_searching()
+            with self.lock:
+                engine = self.pondering_engine
+                if engine is None:
+                    continue
+                try:
+                    if other_game_is_searching and not self.ponder_suspended:
+                        logger.debug(f"Suspending pondering for game {self.game.id}")
+                        engine.suspend_ponder()
+                        self.ponder_suspended = True
+                    elif not other_game_is_searching and self.ponder_suspended:
+                        logger.debug(f"Resuming pondering for game {self.game.id}")
+                        engine.resume_ponder()
+                        self.ponder_suspended = False
+                except Exception:
+                    logger.exception(f"Could not change the pondering of the engine for game {self.game.id}")
+                    self.pondering_engine = None
+
+    def configure_engine(self, engine: EngineWrapper) -> None:
+        if not self.enabled:
+            return
+
+        threads, hash_size = self.allocate()
+        current_threads, current_hash_size = self.current_allocation
+        if abs(threads - current_threads) < max(1, current_threads * THREAD_CHANGE_THRESHOLD):
+            threads = current_threads
+        allocation = threads, hash_size
+        if allocation == self.current_allocation:
+            return
+
+        current_options = engine.resource_options(current_threads, current_hash_size)
+        options = {name: value for name, value in engine.resource_options(threads, hash_size).items()
+                   if current_options.get(name) != value}
+        if options:
+            logger.info(f"Engine resources for game {self.game.id}: {options}")
+            engine.configure(options)
+        self.current_allocation = allocation
+        engine.resources = allocation
+
+
+class CorePinner:
+    """
+    Gives every game its own set of CPU cores and pins the engine of the game to them.
+
+    The first `housekeeping_cores` cores are reserved for lichess-bot itself. The rest are split into one core set per
+    concurrent game. This runs in the main process, which hands out the core sets when games start.
+    """
+    def __init__(self, affinity_cfg: config.Configuration, max_games: int) -> None:
+        self.enabled = bool(affinity_cfg.enabled)
+        if self.enabled and not hasattr(os, "sched_setaffinity"):
+            logger.warning("CPU affinity is not supported on this platform.")
+            self.enabled = False
+
+        self.housekeeping_cores: List[int] = []
+        self.core_sets: List[List[int]] = []
+        self.games: Dict[str, int] = {}
+        if not self.enabled:
+            return
+
+        cores = AVAILABLE_CORES
+        housekeeping_count = min(affinity_cfg.housekeeping_cores, len(cores) - 1)
+        self.housekeeping_cores = cores[:housekeeping_count] or cores
+        game_cores = cores[housekeeping_count:]
+        cores_per_game = max(1, len(game_cores) // max(1, max_games))
+        for index in range(max(1, max_games)):
+            start = index * cores_per_game % len(game_cores)
+            self.core_sets.append(game_cores[start:start + cores_per_game])
+
+    def pin_housekeeping(self) -> None:
+        """Pin this process to the housekeeping cores. Processes started after this inherit them."""
+        if self.enabled:
+            os.sched_setaffinity(0, self.housekeeping_cores)
+            logger.info(f"Pinned lichess-bot to the cores {self.housekeeping_cores}.")
+
+    def assign(self, game_id: str) -> List[int]:
+        """Reserve a free core set for a game. An empty list means that the engine isn't pinned."""
+        if not self.enabled:
+            return []
+        used = set(self.games.values())
+        index = next((index for index in range(len(self.core_sets)) if index not in used), len(self.games))
+        self.games[game_id] = index
+        return self.core_sets[index % len(self.core_sets)]
+
+    def release(self, game_id: str) -> None:
+        self.games.pop(game_id, None)
+
+
+core_pinner = CorePinner(config.Configuration({"enabled": False}), 1)
@@ -1,20 +1,31 @@
 from __future__ import annotations
 import os
+import asyncio
+import concurrent.futures
 import chess.engine
 import chess.polyglot
 import chess.syzygy
 import chess.gaviota
 import subprocess
+import functools
 import logging
+import multiprocessing.util
+import signal
+import types
 import time
 import random
-from collections import Counter
+import json
+import threading
+from collections import Counter, defaultdict
 from contextlib import contextmanager
 import config
 import model
 import lichess
+import online_cache
+import background_requests
+import tablebases
 from config import Configuration
-from typing import Dict, Any, List, Optional, Union, Tuple, Generator, Callable, Type
+from typing import Dict, Any, List, Optional, Union, Tuple, Generator, Callable, Type, DefaultDict, Set, Iterable
 OPTIONS_TYPE = Dict[str, Any]
 MOVE_INFO_TYPE = Dict[str, Any]
 COMMANDS_TYPE = List[str]
@@ -24,11 +35,62 @@ MOVE = Union[chess.engine.PlayResult, List[chess.Move]]
 
 logger = logging.getLogger(__name__)
 
-out_of_online_opening_book_moves: Counter[str] = Counter()
+CHESSDB_URL = "https://www.chessdb.cn/cdb.php"
+LICHESS_CLOUD_URL = "https://lichess.org/api/cloud-eval"
+
+# The first move is searched for a fixed time (in ms), since Lichess aborts games without a first move after 30 seconds.
+FIRST_MOVE_TIME = 10000
+# The time (in seconds) that an engine may take beyond the time limit of a fixed-time search before it counts as hung.
+SEARCH_DEADLINE_MARGIN = 5
+
+emergency_moves: Counter[str] = Counter()
+emergency_mode_results: Counter[str] = Counter()
+
+# When set, engines are started on this event loop instead of each getting an event loop thread of their own.
+engine_event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def use_engine_event_loop(loop: Optional[asyncio.AbstractEventLoop]) -> None:
+    global engine_event_loop
+    engine_event_loop = loop
+
+
+def popen_engine(Protocol: Type[chess.engine.Protocol], commands: COMMANDS_TYPE, stderr: Optional[int],
+                 **popen_args: str) -> chess.engine.SimpleEngine:
+    timeout = 10.
+    if engine_event_loop is None:
+        return chess.engine.SimpleEngine.popen(Protocol, commands, timeout=timeout, debug=False, setpgrp=False,
+                                               stderr=stderr, **popen_args)
+
+    async def start_engine() -> chess.engine.SimpleEngine:
+        transport, protocol = await Protocol.popen(commands, setpgrp=False, stderr=stderr, **popen_args)
+        try:
+            await asyncio.wait_for(protocol.initialize(), timeout)
+        except BaseException:
+            transport.close()
+            raise
+        return chess.engine.SimpleEngine(transport, protocol, timeout=timeout)
+
+    return asyncio.run_coroutine_threadsafe(start_engine(), engine_event_loop).result()
 
 
 @contextmanager
-def create_engine(engine_config: config.Configuration) -> Generator[EngineWrapper, None, None]:
+def create_engine(engine_config: config.Configuration,
+                  game: Optional[model.Game] = None) -> Generator[EngineWrapper, None, None]:
+    engine = (correspondence_sessions.check_out(engine_config, game)
+              or engine_pool.check_out(engine_config)
+              or start_engine(engine_config))
+    try:
+        yield engine
+    finally:
+        if (not correspondence_sessions.check_in(engine_config, game, engine)
+                and not engine_pool.check_in(engine_config, engine)):
+            engine.stop()
+            engine.ping()
+            engine.quit()
+
+
+def start_engine(engine_config: config.Configuration) -> EngineWrapper:
     cfg = engine_config.engine
     engine_path = os.path.join(cfg.dir, cfg.name)
     engine_type = cfg.protocol
@@ -51,13 +113,168 @@ def create_engine(engine_config: config.Configuration) -> Generator[EngineWrappe
             f"    Invalid engine type: {engine_type}. Expected xboard, uci, or homemade.")
     options = remove_managed_options(cfg.lookup(f"{engine_type}_options") or config.Configuration({}))
     logger.debug(f"Starting engine: {commands}")
-    engine = Engine(commands, options, stderr, cfg.draw_or_resign, cwd=cfg.working_dir)
-    try:
-        yield engine
-    finally:
-        engine.stop()
-        engine.ping()
-        engine.quit()
+    return Engine(commands, options, stderr, cfg.draw_or_resign, cwd=cfg.working_dir)
+
+
+class EnginePool:
+    """
+    Engines that keep running between games, so that a game doesn't wait for its engine to start and allocate its hash.
+
+    Every process has its own pool, which starts empty and keeps the engines of the games that have ended. With the
+    process game runner, a game process keeps the engine of its last game for the next game it plays. With the thread
+    game runner, all games share the pool of the main process. An idle engine has to answer a ping before it is
+    reused. An engine is told about the new game by the `game` argument of `chess.engine.SimpleEngine.play`, which
+    makes python-chess send `ucinewgame` (UCI) or `new` (XBoard).
+    """
+    def __init__(self) -> None:
+        self.idle_engines: DefaultDict[str, List[EngineWrapper]] = defaultdict(list)
+        # The pool is closed by a signal handler, which may interrupt the thread that holds the lock.
+        self.lock = threading.RLock()
+
+    def is_used(self, engine_config: config.Configuration) -> bool:
+        return bool(engine_config.engine.engine_pool.enabled) and engine_config.engine.protocol != "homemade"
+
+    def key(self, engine_config: config.Configuration) -> str:
+        return json.dumps(engine_config.engine.config, sort_keys=True, default=str)
+
+    def check_out(self, engine_config: config.Configuration) -> Optional[EngineWrapper]:
+        if not self.is_used(engine_config):
+            return None
+
+        key = self.key(engine_config)
+        while True:
+            with self.lock:
+                idle_engines = self.idle_engines[key]
+                engine = idle_engines.pop() if idle_engines else None
+            if engine is None:
+                return None
+            # An engine can crash while it waits for its next game.
+            if engine.is_responsive(engine_config.engine.recovery.ping_timeout):
+                logger.debug(f"Reusing the engine with pid={engine.get_pid()}.")
+                return engine
+            logger.warning(f"Discarding the engine with pid={engine.get_pid()} since it stopped responding.")
+            self.discard(engine)
+
+    def check_in(self, engine_config: config.Configuration, engine: EngineWrapper) -> bool:
+        """Keep an engine for a later game. Returns False if the engine wasn't taken, so the caller should quit it."""
+        if not self.is_used(engine_config):
+            return False
+
+        engine.games_played += 1
+        key = self.key(engine_config)
+        with self.lock:
+            pool_is_full = len(self.idle_engines[key]) >= engine_config.challenge.concurrency
+        if pool_is_full or engine.games_played >= engine_config.engine.engine_pool.max_games:
+            return False
+
+        try:
+            engine.stop()
+            engine.ping()
+        except Exception:
+            logger.warning(f"Discarding the engine with pid={engine.get_pid()} since it stopped responding.")
+            self.discard(engine)
+            return True
+
+        with self.lock:
+            self.idle_engines[key].append(engine)
+        return True
+
+    def discard(self, engine: EngineWrapper) -> None:
+        try:
+            engine.quit()
+        except Exception:
+            engine.engine.close()
+
+    def close(self) -> None:
+        with self.lock:
+            engines = [engine for idle_engines in self.idle_engines.values() for engine in idle_engines]
+            self.idle_engines.clear()
+        for engine in engines:
+            self.discard(engine)
+
+
+engine_pool = EnginePool()
+
+
+class CorrespondenceSessions:
+    """
+    Engines of correspondence games that keep running between the check-ins of their game, so that the hash filled
+    by the searches of earlier check-ins is still there for the next one.
+
+    The sessions belong to the main process, so they need the thread game runner, with which every check-in of a game
+    finds its session. The game runner ends the remaining sessions when lichess-bot stops. A session also ends when its
+    game is over, when it hasn't been used for two check-in periods, or when it is the oldest of more than
+    `max_engines` sessions.
+    """
+    def __init__(self) -> None:
+        self.engines: Dict[str, Tuple[EngineWrapper, float]] = {}
+        self.lock = threading.Lock()
+
+    def is_used(self, engine_config: config.Configuration, game: Optional[model.Game]) -> bool:
+        return (bool(engine_config.correspondence.keep_engines.enabled)
+                and engine_config.engine.protocol != "homemade"
+                and game is not None
+                and game.speed == "correspondence")
+
+    def check_out(self, engine_config: config.Configuration, game: Optional[model.Game]) -> Optional[EngineWrapper]:
+        if game is None or not self.is_used(engine_config, game):
+            return None
+
+        self.end_expired_sessions(engine_config.correspondence.checkin_period * 2)
+        with self.lock:
+            engine, _ = self.engines.pop(game.id, (None, 0.))
+        if engine is not None:
+            logger.info(f"Resuming the engine session of game {game.id}.")
+        return engine
+
+    def check_in(self, engine_config: config.Configuration, game: Optional[model.Game], engine: EngineWrapper) -> bool:
+        """Keep the engine until the next check-in of its game. Returns False if the engine wasn't taken."""
+        if game is None or not self.is_used(engine_config, game) or game.state.get("status") != "started":
+            return False
+
+        try:
+            engine.stop_pondering()
+            engine.ping()
+        except Exception:
+            return False
+
+        with self.lock:
+            self.engines[game.id] = (engine, time.monotonic())
+            oldest_sessions = sorted(self.engines, key=lambda game_id: self.engines[game_id][1])
+            extra_sessions = max(0, len(oldest_sessions) - engine_config.correspondence.keep_engines.max_engines)
+            ended_sessions = [self.engines.pop(game_id)[0] for game_id in oldest_sessions[:extra_sessions]]
+        for ended_engine in ended_sessions:
+            engine_pool.discard(ended_engine)
+        return True
+
+    def end_expired_sessions(self, max_idle_time: float) -> None:
+        now = time.monotonic()
+        with self.lock:
+            expired_sessions = [game_id for game_id, (_, last_used) in self.engines.items()
+                                if now - last_used > max_idle_time]
+            engines = [self.engines.pop(game_id)[0] for game_id in expired_sessions]
+        for engine in engines:
+            engine_pool.discard(engine)
+
+    def close(self) -> None:
+        self.end_expired_sessions(-1)
+
+
+correspondence_sessions = CorrespondenceSessions()
+
+
+def quit_pooled_engines_at_exit() -> None:
+    """
+    Quit the engines of the pool when a game process ends. The process pool terminates its processes when lichess-bot
+    stops, which would leave their engines running.
+    """
+    multiprocessing.util.Finalize(engine_pool, engine_pool.close, exitpriority=10)
+    signal.signal(signal.SIGTERM, quit_pooled_engines_and_exit)
+
+
+def quit_pooled_engines_and_exit(signum: int, frame: Optional[types.FrameType]) -> None:
+    engine_pool.close()
+    os._exit(0)
 
 
 def remove_managed_options(config: config.Configuration) -> OPTIONS_TYPE:
@@ -97,13 +314,34 @@ PONDERPV_CHARACTERS = 6  # The length of ", PV: ".
 
 
 class EngineWrapper:
+    Protocol: Type[chess.engine.Protocol]
+
     def __init__(self, options: OPTIONS_TYPE, draw_or_resign: config.Configuration) -> None:
         self.engine: Union[chess.engine.SimpleEngine, FillerEngine]
+        self.start_args: Tuple[COMMANDS_TYPE, Optional[int], Dict[str, str]]
+        self.options = options
         self.scores: List[chess.engine.PovScore] = []
         self.draw_or_resign = draw_or_resign
         self.go_commands = config.Configuration(options.pop("go_commands", {}) or {})
         self.move_commentary: List[MOVE_INFO_TYPE] = []
         self.comment_start_index = -1
+        self.game_id: Optional[str] = None
+        self.games_played = 0
+        self.ponder_board: Optional[chess.Board] = None
+        self.ponder_analysis: Optional[chess.engine.SimpleAnalysisResult] = None
+        self.resources: Tuple[int, int] = (0, 0)
+        self.cores: List[int] = []
+        self.startup_time = 0.
+
+    def new_game(self, game: model.Game) -> None:
+        if self.game_id == game.id:
+            # A correspondence game that continues with the engine session of its last check-in.
+            return
+        self.game_id = game.id
+        self.ponder_board = None
+        self.scores = []
+        self.move_commentary = []
+        self.comment_start_index = -1
 
     def play_move(self,
                   board: chess.Board,
@@ -114,65 +352,160 @@ class EngineWrapper:
                   can_ponder: bool,
                   is_correspondence: bool,
                   correspondence_move_time: int,
-                  engine_cfg: config.Configuration) -> None:
-        polyglot_cfg = engine_cfg.polyglot
-        online_moves_cfg = engine_cfg.online_moves
-        draw_or_resign_cfg = engine_cfg.draw_or_resign
-        lichess_bot_tbs = engine_cfg.lichess_bot_tbs
-
-        best_move: MOVE
-        best_move = get_book_move(board, game, polyglot_cfg)
-
-        if best_move.move is None:
-            best_move = get_egtb_move(board,
-                                      game,
-                                      lichess_bot_tbs,
-                                      draw_or_resign_cfg)
-
-        if not isinstance(best_move, list) and best_move.move is None:
-            best_move = get_online_move(li,
-                                        board,
-                                        game,
-                                        online_moves_cfg,
-                                        draw_or_resign_cfg)
+                  engine_cfg: config.Configuration,
+                  move_sources: MoveSources) -> chess.engine.PlayResult:
+        """Find a move and send it to Lichess. The move is returned."""
+        # With almost no time left, skip the move sources that read files or wait for the network.
+        in_emergency = is_emergency(board, game, engine_cfg.emergency_mode)
+        search = functools.partial(self.search_for_move, board, game,
+                                   in_emergency=in_emergency,
+                                   draw_offered=check_for_draw_offer(game),
+                                   start_time=start_time,
+                                   move_overhead=move_overhead,
+                                   can_ponder=can_ponder,
+                                   is_correspondence=is_correspondence,
+                                   correspondence_move_time=correspondence_move_time,
+                                   engine_cfg=engine_cfg)
+        best_move = move_sources.choose_move(self, li, board, search, in_emergency, engine_cfg)
 
-        if isinstance(best_move, list) or best_move.move is None:
-            draw_offered = check_for_draw_offer(game)
+        self.add_comment(best_move, board)
+        self.print_stats()
+        try:
+            if best_move.resigned and len(board.move_stack) >= 2:
+                li.resign(game.id)
+            else:
+                game.clock.move_sent()
+                li.make_move(game.id, best_move)
+        finally:
+            move_sources.stop_unused_search(self)
+        return best_move
 
-            if len(board.move_stack) < 2:
-                best_move = choose_first_move(self,
-                                              board,
-                                              game,
-                                              draw_offered,
-                                              best_move)
-            elif is_correspondence:
-                best_move = choose_move_time(self,
+    def search_for_move(self, board: chess.Board, game: model.Game, root_moves: MOVE, in_emergency: bool,
+                        draw_offered: bool, start_time: int, move_overhead: int, can_ponder: bool, is_correspondence: bool,
+                        correspondence_move_time: int, engine_cfg: config.Configuration) -> chess.engine.PlayResult:
+        """Let the engine search for a move among `root_moves` with the time control of the game."""
+        def search_root_moves() -> chess.engine.PlayResult:
+            if in_emergency:
+                return choose_emergency_move(self,
                                              board,
                                              game,
-                                             correspondence_move_time,
-                                             start_time,
-                                             move_overhead,
-                                             can_ponder,
                                              draw_offered,
-                                             best_move)
-            else:
-                best_move = choose_move(self,
+                                             root_moves,
+                                             engine_cfg.emergency_mode)
+            elif len(board.move_stack) < 2:
+                return choose_first_move(self,
+                                         board,
+                                         game,
+                                         draw_offered,
+                                         root_moves)
+            elif is_correspondence:
+                return choose_move_time(self,
                                         board,
                                         game,
-                                        can_ponder,
-                                        draw_offered,
+                                        correspondence_move_time,
                                         start_time,
                                         move_overhead,
-                                        best_move)
-        else:
-            self.stop()
+                                        can_ponder,
+                                        draw_offered,
+                                        root_moves)
+            else:
+                return choose_move(self,
+                                   board,
+                                   game,
+                                   can_ponder,
+                                   draw_offered,
+                                   start_time,
+                                   move_overhead,
+                                   root_moves,
+                                   engine_cfg.early_stop)
+
+        def search_deadline() -> float:
+            # python-chess doesn't enforce the time limit of a search on an engine that hangs, so every search is
+            # watched. A search on the clock leaves enough time to start a new engine and search again.
+            if len(board.move_stack) < 2:
+                return FIRST_MOVE_TIME / 1000 + SEARCH_DEADLINE_MARGIN
+            elif is_correspondence:
+                return correspondence_move_time / 1000 + SEARCH_DEADLINE_MARGIN
+            else:
+                return game.clock.remaining_time() * 0.9 / 1000 - self.startup_time
 
-        self.add_comment(best_move, board)
-        self.print_stats()
-        if best_move.resigned and len(board.move_stack) >= 2:
-            li.resign(game.id)
-        else:
-            li.make_move(game.id, best_move)
+        self.stop_ponder_analysis()
+        return self.supervised_search(search_root_moves, game, engine_cfg, search_deadline)
+
+    def skip_search(self) -> None:
+        """Stop the pondering of the engine, since the move comes from another source."""
+        self.stop()
+        self.ponder_board = None
+
+    def supervised_search(self, search: Callable[[], chess.engine.PlayResult], game: model.Game,
+                          engine_cfg: config.Configuration, deadline: Callable[[], float]) -> chess.engine.PlayResult:
+        """
+        Run the search, restarting the engine if it has crashed or stops responding.
+
+        The engine is pinged before the search, and killed if it hasn't found a move after `deadline()` seconds.
+        A dead engine is replaced by a new process (or by the standby engine), which searches again with the time that
+        is left and under a new deadline. The game itself carries on in the same game stream with the same move
+        commentary.
+        """
+        recovery_cfg = engine_cfg.recovery
+        if not recovery_cfg.enabled or isinstance(self, MinimalEngine):
+            return search()
+
+        if self.ponder_board is None and not self.is_responsive(recovery_cfg.ping_timeout):
+            logger.warning(f"The engine for game {game.id} is not responding.")
+            self.recover(game, engine_cfg)
+
+        try:
+            return self.watched_search(search, deadline())
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, asyncio.TimeoutError):
+            logger.exception(f"The engine for game {game.id} failed while searching.")
+            self.recover(game, engine_cfg)
+            return self.watched_search(search, deadline())
+
+    def watched_search(self, search: Callable[[], chess.engine.PlayResult], deadline: float) -> chess.engine.PlayResult:
+        """Run the search and kill the engine if it hasn't found a move after `deadline` seconds."""
+        # The engine is looked up when the watchdog fires, since a restart replaces it.
+        watchdog = threading.Timer(max(1., deadline), lambda: self.engine.close())
+        watchdog.start()
+        try:
+            return search()
+        finally:
+            watchdog.cancel()
+
+    def start_speculative_search(self, search: Callable[[], chess.engine.PlayResult],
+                                 game: model.Game) -> concurrent.futures.Future[chess.engine.PlayResult]:
+        """Start the search in the background. Its move is used if none of the other move sources has a move."""
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"search-{game.id}")
+        speculative_search = executor.submit(search)
+        executor.shutdown(wait=False)
+        return speculative_search
+
+    def cancel_speculative_search(self, speculative_search: concurrent.futures.Future[chess.engine.PlayResult],
+                                  game: model.Game) -> None:
+        """Stop a search whose move isn't needed and wait until the engine is free for the next command."""
+        # The stop command is lost if it reaches the engine before the search has started, so it is repeated.
+        while not speculative_search.done():
+            self.stop()
+            concurrent.futures.wait([speculative_search], timeout=0.05)
+        error = speculative_search.exception()
+        if error is not None:
+            logger.debug(f"The cancelled search for game {game.id} failed: {error!r}")
+        logger.debug(f"Cancelled the search for game {game.id}.")
+
+    def is_responsive(self, timeout: float) -> bool:
+        ping = asyncio.wait_for(self.engine.protocol.ping(), timeout)
+        try:
+            asyncio.run_coroutine_threadsafe(ping, self.engine.protocol.loop).result()
+            return True
+        except Exception:
+            return False
+
+    def recover(self, game: model.Game, engine_cfg: config.Configuration) -> None:
+        standby_engine = engine_cfg.recovery.standby_engine
+        standby_commands = [os.path.join(engine_cfg.dir, standby_engine)] if standby_engine else None
+        logger.info(f"Restarting the engine for game {game.id}" + (f" with {standby_engine}." if standby_engine else "."))
+        self.restart(standby_commands)
+        self.get_opponent_info(game)
 
     def search_for(self, board: chess.Board, movetime: int, ponder: bool, draw_offered: bool,
                    root_moves: MOVE) -> chess.engine.PlayResult:
@@ -191,6 +524,70 @@ class EngineWrapper:
                                         black_inc=binc / 1000)
         return self.search(board, time_limit, ponder, draw_offered, root_moves)
 
+    def search_with_early_stop(self, board: chess.Board, wtime: int, btime: int, winc: int, binc: int, ponder: bool,
+                               root_moves: MOVE, early_stop_cfg: config.Configuration) -> chess.engine.PlayResult:
+        """
+        Search with our own time management by watching the info that the engine sends while it searches.
+
+        The search stops early when the best move has stayed the same for `stable_depths` depths, or for a third of the
+        depth if that is more, and the search has used at least `min_time_share` of the planned time. When the score
+        drops by `score_drop` centipawns or more from one depth to the next, the search gets twice as much time, up to
+        `max_extension` times the planned time.
+        """
+        my_time, my_increment = (wtime, winc) if board.turn == chess.WHITE else (btime, binc)
+        planned_time = min(my_time / 30 + my_increment * 3 / 4, my_time / 5)
+        max_time = min(planned_time * early_stop_cfg.max_extension, my_time / 3)
+        time_limit = self.add_go_commands(chess.engine.Limit(time=max_time / 1000))
+        deadline = planned_time
+        min_time = planned_time * early_stop_cfg.min_time_share
+        start_time = time.perf_counter()
+
+        best_move = None
+        stable_depths = 0
+        last_depth = 0
+        last_score = None
+        with self.engine.analysis(board,
+                                  time_limit,
+                                  game=self.game_id,
+                                  root_moves=root_moves if isinstance(root_moves, list) else None) as analysis:
+            timer = threading.Timer(deadline / 1000, analysis.stop)
+            timer.start()
+            try:
+                for info in analysis:
+                    depth = info.get("depth", 0)
+                    if "pv" not in info or depth <= last_depth:
+                        continue
+                    last_depth = depth
+
+                    move = info["pv"][0]
+                    stable_depths = stable_depths + 1 if move == best_move else 0
+                    best_move = move
+                    elapsed = (time.perf_counter() - start_time) * 1000
+                    if stable_depths >= max(early_stop_cfg.stable_depths, depth // 3) and elapsed >= min_time:
+                        logger.info(f"Best move stable for {stable_depths} depths. Stopping the search early.")
+                        break
+
+                    score = info["score"].relative.score(mate_score=40000) if "score" in info else None
+                    if (last_score is not None and score is not None and last_score - score >= early_stop_cfg.score_drop
+                            and deadline < max_time):
+                        deadline = min(deadline * 2, max_time)
+                        logger.info(f"Score dropped from {last_score} to {score}. Searching up to {deadline / 1000:.1f}s.")
+                        timer.cancel()
+                        timer = threading.Timer(max(0., deadline / 1000 - (time.perf_counter() - start_time)),
+                                                analysis.stop)
+                        timer.start()
+                    last_score = score
+            finally:
+                timer.cancel()
+            analysis.stop()
+            best = analysis.wait()
+            result = chess.engine.PlayResult(best.move, best.ponder, analysis.info)
+
+        result = self.handle_search_result(board, result, ponder)
+        if self.ponder_board is not None:
+            self.resume_ponder()
+        return result
+
     def add_go_commands(self, time_limit: chess.engine.Limit) -> chess.engine.Limit:
         movetime = self.go_commands.movetime
         if movetime is not None:
@@ -237,10 +634,20 @@ class EngineWrapper:
         result: chess.engine.PlayResult
         result = self.engine.play(board,
                                   time_limit,
+                                  game=self.game_id,
                                   info=chess.engine.INFO_ALL,
                                   ponder=ponder,
                                   draw_offered=draw_offered,
                                   root_moves=root_moves if isinstance(root_moves, list) else None)
+        return self.handle_search_result(board, result, ponder)
+
+    def handle_search_result(self, board: chess.Board, result: chess.engine.PlayResult,
+                             ponder: bool) -> chess.engine.PlayResult:
+        self.ponder_board = None
+        if ponder and result.move and result.ponder:
+            self.ponder_board = board.copy()
+            self.ponder_board.push(result.move)
+            self.ponder_board.push(result.ponder)
         # Use null_score to have no effect on draw/resign decisions
         null_score = chess.engine.PovScore(chess.engine.Mate(1), board.turn)
         self.scores.append(result.info.get("score", null_score))
@@ -356,6 +763,90 @@ class EngineWrapper:
     def stop(self) -> None:
         pass
 
+    def configure(self, options: OPTIONS_TYPE) -> None:
+        self.engine.configure(options)
+
+    def suspend_ponder(self) -> None:
+        """Stop pondering, so that the engines of other games can use the CPU."""
+        self.stop_ponder_analysis()
+        self.engine.ping()
+
+    def resume_ponder(self) -> None:
+        """Ponder again by analysing the expected position until it is stopped before the next search."""
+        if self.ponder_board is not None:
+            self.stop_ponder_analysis()
+            self.ponder_analysis = self.engine.analysis(self.ponder_board, game=self.game_id, info=chess.engine.INFO_NONE)
+
+    def stop_ponder_analysis(self) -> None:
+        ponder_analysis, self.ponder_analysis = self.ponder_analysis, None
+        try:
+            if ponder_analysis is not None:
+                ponder_analysis.stop()
+        except chess.engine.EngineTerminatedError:
+            # A closed engine doesn't ponder anymore.
+            pass
+
+    def start(self, commands: COMMANDS_TYPE, standby: bool = False) -> None:
+        """
+        Start the engine process and set it up: its options, the threads and hash it was given by the resource
+        scheduler and the cores it was pinned to. A restarted engine gets the same setup as the engine it replaces.
+        """
+        start_time = time.perf_counter()
+        _, stderr, popen_args = self.start_args
+        self.engine = popen_engine(self.Protocol, commands, stderr, **popen_args)
+        self.engine.configure(self.engine_options(standby))
+        if self.resources != (0, 0):
+            self.engine.configure(self.resource_options(*self.resources))
+        self.pin(self.cores)
+        self.startup_time = time.perf_counter() - start_time
+
+    def engine_options(self, standby: bool) -> OPTIONS_TYPE:
+        """The options of the engine. A standby engine only gets the options it has."""
+        if standby:
+            return {name: value for name, value in self.options.items() if name in self.engine.options}
+        return self.options
+
+    def restart(self, standby_commands: Optional[COMMANDS_TYPE] = None) -> None:
+        """
+        Replace a crashed or unresponsive engine process with a new one. The wrapper keeps the state of the game, and
+        the next search sends the whole game to the new engine.
+        """
+        self.engine.close()
+        commands, _, _ = self.start_args
+        self.start(standby_commands or commands, standby=bool(standby_commands))
+        self.ponder_board = None
+        self.ponder_analysis = None
+
+    def pin(self, cores: List[int]) -> None:
+        """Pin all threads of the engine process to the cores of the game. An empty list leaves the engine alone."""
+        self.cores = cores
+        pid = self.get_pid()
+        if not cores or not pid.isdigit():
+            return
+
+        try:
+            thread_ids = [int(thread_id) for thread_id in os.listdir(f"/proc/{pid}/task")]
+        except OSError:
+            thread_ids = [int(pid)]
+
+        try:
+            for thread_id in thread_ids:
+                os.sched_setaffinity(thread_id, cores)
+            logger.info(f"Pinned the engine for game {self.game_id} to the cores {cores}.")
+        except OSError:
+            logger.exception(f"Could not pin the engine for game {self.game_id} to the cores {cores}.")
+
+    def stop_pondering(self) -> None:
+        if self.ponder_board is not None:
+            self.suspend_ponder()
+            self.ponder_board = None
+        # The analysis of the last game's pondering isn't used by the next game.
+        self.stop_ponder_analysis()
+
+    def resource_options(self, threads: int, hash_size: int) -> OPTIONS_TYPE:
+        """The engine options that set the number of threads and the hash size (in MB). A hash_size of 0 is left alone."""
+        return {}
+
     def get_pid(self) -> str:
         pid = "?"
         if self.engine.transport is not None:
@@ -371,16 +862,25 @@ class EngineWrapper:
 
 
 class UCIEngine(EngineWrapper):
+    Protocol = chess.engine.UciProtocol
+
     def __init__(self, commands: COMMANDS_TYPE, options: OPTIONS_TYPE, stderr: Optional[int],
                  draw_or_resign: config.Configuration, **popen_args: str) -> None:
         super().__init__(options, draw_or_resign)
-        self.engine = chess.engine.SimpleEngine.popen_uci(commands, timeout=10., debug=False, setpgrp=False, stderr=stderr,
-                                                          **popen_args)
-        self.engine.configure(options)
+        self.start_args = (commands, stderr, popen_args)
+        self.start(commands)
 
     def stop(self) -> None:
         self.engine.protocol.send_line("stop")
 
+    def resource_options(self, threads: int, hash_size: int) -> OPTIONS_TYPE:
+        options: OPTIONS_TYPE = {}
+        if "Threads" in self.engine.options:
+            options["Threads"] = threads
+        if hash_size and "Hash" in self.engine.options:
+            options["Hash"] = hash_size
+        return options
+
     def get_opponent_info(self, game: model.Game) -> None:
         name = game.opponent.name
         if (name and isinstance(self.engine.protocol, chess.engine.UciProtocol) and
@@ -391,30 +891,37 @@ class UCIEngine(EngineWrapper):
             self.engine.configure({"UCI_Opponent": f"{title} {rating} {player_type} {name}"})
 
     def report_game_result(self, game: model.Game, board: chess.Board) -> None:
+        self.stop_pondering()
         if isinstance(self.engine.protocol, chess.engine.UciProtocol):
             self.engine.protocol._position(board)
 
 
 class XBoardEngine(EngineWrapper):
+    Protocol = chess.engine.XBoardProtocol
+
     def __init__(self, commands: COMMANDS_TYPE, options: OPTIONS_TYPE, stderr: Optional[int],
                  draw_or_resign: config.Configuration, **popen_args: str) -> None:
         super().__init__(options, draw_or_resign)
-        self.engine = chess.engine.SimpleEngine.popen_xboard(commands, timeout=10., debug=False, setpgrp=False,
-                                                             stderr=stderr, **popen_args)
-        egt_paths = options.pop("egtpath", {}) or {}
+        self.egt_paths: Dict[str, str] = options.pop("egtpath", {}) or {}
+        self.start_args = (commands, stderr, popen_args)
+        self.start(commands)
+
+    def engine_options(self, standby: bool) -> OPTIONS_TYPE:
+        options = dict(super().engine_options(standby))
         features = self.engine.protocol.features if isinstance(self.engine.protocol, chess.engine.XBoardProtocol) else {}
         egt_features = features.get("egt", "")
         if isinstance(egt_features, str):
             egt_types_from_engine = egt_features.split(",")
             egt_type: str
             for egt_type in filter(None, egt_types_from_engine):
-                if egt_type in egt_paths:
-                    options[f"egtpath {egt_type}"] = egt_paths[egt_type]
+                if egt_type in self.egt_paths:
+                    options[f"egtpath {egt_type}"] = self.egt_paths[egt_type]
                 else:
                     logger.debug(f"No paths found for egt type: {egt_type}.")
-        self.engine.configure(options)
+        return options
 
     def report_game_result(self, game: model.Game, board: chess.Board) -> None:
+        self.stop_pondering()
         # Send final moves, if any, to engine
         if isinstance(self.engine.protocol, chess.engine.XBoardProtocol):
             self.engine.protocol._new(board, None, {})
@@ -428,6 +935,14 @@ class XBoardEngine(EngineWrapper):
     def stop(self) -> None:
         self.engine.protocol.send_line("?")
 
+    def resource_options(self, threads: int, hash_size: int) -> OPTIONS_TYPE:
+        options: OPTIONS_TYPE = {}
+        if "cores" in self.engine.options:
+            options["cores"] = threads
+        if hash_size and "memory" in self.engine.options:
+            options["memory"] = hash_size
+        return options
+
     def get_opponent_info(self, game: model.Game) -> None:
         if (game.opponent.name and isinstance(self.engine.protocol, chess.engine.XBoardProtocol) and
                 self.engine.protocol.features.get("name", True)):
@@ -529,33 +1044,146 @@ def choose_move_time(engine: EngineWrapper, board: chess.Board, game: model.Game
 
 def choose_first_move(engine: EngineWrapper, board: chess.Board, game: model.Game,
                       draw_offered: bool, root_moves: MOVE) -> chess.engine.PlayResult:
-    # need to hardcode first movetime (10000 ms) since Lichess has 30 sec limit.
-    search_time = 10000
+    search_time = FIRST_MOVE_TIME
     logger.info(f"Searching for time {search_time} for game {game.id}")
     return engine.first_search(board, search_time, draw_offered, root_moves)
 
 
 def choose_move(engine: EngineWrapper, board: chess.Board, game: model.Game, ponder: bool, draw_offered: bool,
-                start_time: int, move_overhead: int, root_moves: MOVE) -> chess.engine.PlayResult:
+                start_time: int, move_overhead: int, root_moves: MOVE,
+                early_stop_cfg: config.Configuration) -> chess.engine.PlayResult:
     pre_move_time = int((time.perf_counter_ns() - start_time) / 1e6)
     overhead = pre_move_time + move_overhead
-    wb = "w" if board.turn == chess.WHITE else "b"
-    game.state[f"{wb}time"] = max(0, game.state[f"{wb}time"] - overhead)
-    logger.info("Searching for wtime {wtime} btime {btime}".format_map(game.state) + f" for game {game.id}")
-    return engine.search_with_ponder(board,
-                                     game.state["wtime"],
-                                     game.state["btime"],
-                                     game.state["winc"],
-                                     game.state["binc"],
-                                     ponder,
-                                     draw_offered,
+    # The search may run in another thread while the game state is updated, so the clocks are copied, not changed.
+    state = game.state
+    wtime: int = state["wtime"]
+    btime: int = state["btime"]
+    if board.turn == chess.WHITE:
+        wtime = max(0, wtime - overhead)
+    else:
+        btime = max(0, btime - overhead)
+    logger.info(f"Searching for wtime {wtime} btime {btime} for game {game.id}")
+    if early_stop_cfg.enabled and not isinstance(engine, MinimalEngine):
+        return engine.search_with_early_stop(board, wtime, btime, state["winc"], state["binc"], ponder, root_moves,
+                                             early_stop_cfg)
+    return engine.search_with_ponder(board, wtime, btime, state["winc"], state["binc"], ponder, draw_offered,
                                      root_moves)
 
 
+def is_emergency(board: chess.Board, game: model.Game, emergency_cfg: config.Configuration) -> bool:
+    if not emergency_cfg.enabled or len(board.move_stack) < 2 or game.speed == "correspondence":
+        return False
+    min_time: int = emergency_cfg.min_time
+    return game.clock.remaining_time() + game.clock.my_increment() < min_time
+
+
+def choose_emergency_move(engine: EngineWrapper, board: chess.Board, game: model.Game, draw_offered: bool,
+                          root_moves: MOVE, emergency_cfg: config.Configuration) -> chess.engine.PlayResult:
+    emergency_moves[game.id] += 1
+    search_time = max(1, min(emergency_cfg.move_time, game.clock.remaining_time() // 10))
+    logger.info(f"Searching for time {search_time} in emergency mode for game {game.id}")
+    return engine.search_for(board, search_time, False, draw_offered, root_moves)
+
+
+def log_emergency_mode_result(game: model.Game) -> None:
+    """Log whether a game that needed the emergency mode was lost on time, to see how often the mode saves a game."""
+    moves = emergency_moves.pop(game.id, 0)
+    if not moves:
+        return
+
+    lost_on_time = game.state.get("status") == model.Termination.TIMEOUT and game.state.get("winner") == game.opponent_color
+    emergency_mode_results["lost on time" if lost_on_time else "not lost on time"] += 1
+    logger.info(f"Played {moves} move(s) in emergency mode in game {game.id}, which was "
+                f"{'' if lost_on_time else 'not '}lost on time. Games with emergency moves: "
+                f"{emergency_mode_results['not lost on time']} not lost on time, "
+                f"{emergency_mode_results['lost on time']} lost on time.")
+
+
 def check_for_draw_offer(game: model.Game) -> bool:
     return game.state.get(f"{game.opponent_color[0]}draw", False)
 
 
+def get_fast_path_move(engine: EngineWrapper, board: chess.Board, game: model.Game,
+                       fast_path_cfg: config.Configuration) -> chess.engine.PlayResult:
+    """Find moves that don't need a book, a tablebase or a search, like the only legal move."""
+    no_move = chess.engine.PlayResult(None, None)
+    if not fast_path_cfg.enabled:
+        return no_move
+
+    for oracle in FAST_PATH_ORACLES:
+        result = oracle(engine, board, fast_path_cfg)
+        if result.move is not None:
+            logger.info(f"Got move {result.move} from the fast path ({oracle.__name__}) for game {game.id}")
+            return result
+
+    return no_move
+
+
+def only_legal_move(engine: EngineWrapper, board: chess.Board,
+                    fast_path_cfg: config.Configuration) -> chess.engine.PlayResult:
+    legal_moves = board.legal_moves
+    return chess.engine.PlayResult(next(iter(legal_moves)) if legal_moves.count() == 1 else None, None)
+
+
+def only_move_avoiding_mate(engine: EngineWrapper, board: chess.Board,
+                            fast_path_cfg: config.Configuration) -> chess.engine.PlayResult:
+    # Looking at every reply is only cheap enough with few legal moves, which is when a mate is usually threatened.
+    no_move = chess.engine.PlayResult(None, None)
+    if board.uci_variant != "chess" or board.legal_moves.count() > 10:
+        return no_move
+
+    def allows_mate_in_one(move: chess.Move) -> bool:
+        board.push(move)
+        try:
+            for reply in board.legal_moves:
+                if board.gives_check(reply):
+                    board.push(reply)
+                    is_checkmate = board.is_checkmate()
+                    board.pop()
+                    if is_checkmate:
+                        return True
+            return False
+        finally:
+            board.pop()
+
+    safe_moves = []
+    for move in board.legal_moves:
+        if not allows_mate_in_one(move):
+            safe_moves.append(move)
+            if len(safe_moves) > 1:
+                return no_move
+    return chess.engine.PlayResult(safe_moves[0], None) if safe_moves else no_move
+
+
+def predicted_pv_move(engine: EngineWrapper, board: chess.Board,
+                      fast_path_cfg: config.Configuration) -> chess.engine.PlayResult:
+    """Play on from the principal variation of our last search if the opponent made the move it predicted."""
+    no_move = chess.engine.PlayResult(None, None)
+    last_info = engine.comment_for_board_index(len(board.move_stack) - 2)
+    pv: List[chess.Move] = last_info.get("pv", [])
+    depth_left = last_info.get("depth", 0) - 2
+    if len(pv) < 3 or depth_left < fast_path_cfg.pv_min_depth or board.move_stack[-2:] != pv[:2]:
+        return no_move
+
+    move = pv[2]
+    if fast_path_cfg.confirm_time and not isinstance(engine, MinimalEngine):
+        confirmation = engine.engine.play(board, chess.engine.Limit(time=fast_path_cfg.confirm_time / 1000),
+                                          game=engine.game_id)
+        if confirmation.move != move:
+            return no_move
+
+    info: chess.engine.InfoDict = {"depth": depth_left, "pv": pv[2:]}
+    if "score" in last_info:
+        info["score"] = last_info["score"]
+    return chess.engine.PlayResult(move, pv[3] if len(pv) > 3 else None, info)
+
+
+FAST_PATH_ORACLES: List[Callable[[EngineWrapper, chess.Board, config.Configuration], chess.engine.PlayResult]] = [
+    only_legal_move,
+    only_move_avoiding_mate,
+    predicted_pv_move]
+
+
 def get_book_move(board: chess.Board, game: model.Game,
                   polyglot_cfg: config.Configuration) -> chess.engine.PlayResult:
     no_book_move = chess.engine.PlayResult(None, None)
@@ -590,71 +1218,407 @@ def get_book_move(board: chess.Board, game: model.Game,
     return no_book_move
 
 
-def get_online_move(li: lichess.Lichess, board: chess.Board, game: model.Game, online_moves_cfg: config.Configuration,
-                    draw_or_resign_cfg: config.Configuration) -> Union[chess.engine.PlayResult, List[chess.Move]]:
+def egtb_result(board: chess.Board, best_move: Union[chess.Move, List[chess.Move], None], wdl: int,
+                draw_or_resign_cfg: config.Configuration) -> MOVE:
+    """The move of a tablebase with a draw offer or resignation that depends on the result, or the moves to search."""
+    if not best_move:
+        return chess.engine.PlayResult(None, None)
+    if isinstance(best_move, list):
+        return best_move
+
+    can_offer_draw = draw_or_resign_cfg.offer_draw_enabled
+    offer_draw_for_zero = draw_or_resign_cfg.offer_draw_for_egtb_zero
+    offer_draw = bool(can_offer_draw and offer_draw_for_zero and wdl == 0)
+
+    can_resign = draw_or_resign_cfg.resign_enabled
+    resign_on_egtb_loss = draw_or_resign_cfg.resign_for_egtb_minus_two
+    resign = bool(can_resign and resign_on_egtb_loss and wdl == -2)
+    wdl_to_score = {2: 9900, 1: 500, 0: 0, -1: -500, -2: -9900}
+    comment: chess.engine.InfoDict = {"score": chess.engine.PovScore(chess.engine.Cp(wdl_to_score[wdl]), board.turn)}
+    return chess.engine.PlayResult(best_move, None, comment, draw_offered=offer_draw, resigned=resign)
+
+
+def has_move(move: MOVE) -> bool:
+    return isinstance(move, list) or move.move is not None
+
+
+class MoveSource:
+    """
+    A source of moves that are played without a search by the engine, like an opening book or a tablebase.
+
+    `get_move` returns `PlayResult(None, None)` when the source has no move for the position, and a list of moves when
+    the engine should only search these. Online sources get the time in seconds that they may take, if it is limited.
+    """
+    name = ""
+    # The source asks a server.
+    is_online = False
+    # The source knows the result of the position, so its move comes before the moves of books.
+    is_exact = False
+    # The source is an online opening book, which isn't asked after `max_out_of_book_moves` positions without a move.
+    is_opening_book = False
+
+    def __init__(self, engine_cfg: config.Configuration) -> None:
+        self.engine_cfg = engine_cfg
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game, max_time: Optional[float]) -> MOVE:
+        raise NotImplementedError
+
+
+class PolyglotBook(MoveSource):
+    name = "polyglot"
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game, max_time: Optional[float]) -> MOVE:
+        return get_book_move(board, game, self.engine_cfg.polyglot)
+
+
+class SyzygyTablebase(MoveSource):
+    name = "syzygy"
+    is_exact = True
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game, max_time: Optional[float]) -> MOVE:
+        best_move, wdl = get_syzygy(board, game, self.engine_cfg.lichess_bot_tbs.syzygy)
+        return egtb_result(board, best_move, wdl, self.engine_cfg.draw_or_resign)
+
+
+class GaviotaTablebase(MoveSource):
+    name = "gaviota"
+    is_exact = True
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game, max_time: Optional[float]) -> MOVE:
+        best_move, wdl = get_gaviota(board, game, self.engine_cfg.lichess_bot_tbs.gaviota)
+        return egtb_result(board, best_move, wdl, self.engine_cfg.draw_or_resign)
+
+
+class OnlineTablebase(MoveSource):
+    name = "online_egtb"
+    is_online = True
+    is_exact = True
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game, max_time: Optional[float]) -> MOVE:
+        best_move, wdl = get_online_egtb_move(li, board, game, self.engine_cfg.online_moves.online_egtb, max_time)
+        if isinstance(best_move, str):
+            return egtb_result(board, chess.Move.from_uci(best_move), wdl, self.engine_cfg.draw_or_resign)
+        return egtb_result(board, [chess.Move.from_uci(move) for move in best_move or []], wdl, self.engine_cfg.draw_or_resign)
+
+
+class ChessDBBook(MoveSource):
+    name = "chessdb_book"
+    is_online = True
+    is_opening_book = True
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game, max_time: Optional[float]) -> MOVE:
+        best_move, comment = get_chessdb_move(li, board, game, self.engine_cfg.online_moves.chessdb_book, max_time)
+        return chess.engine.PlayResult(chess.Move.from_uci(best_move) if best_move else None, None, comment or {})
+
+
+class LichessCloudAnalysis(MoveSource):
+    name = "lichess_cloud_analysis"
+    is_online = True
+    is_opening_book = True
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game, max_time: Optional[float]) -> MOVE:
+        lichess_cloud_cfg = self.engine_cfg.online_moves.lichess_cloud_analysis
+        best_move, comment = get_lichess_cloud_move(li, board, game, lichess_cloud_cfg, max_time)
+        return chess.engine.PlayResult(chess.Move.from_uci(best_move) if best_move else None, None, comment or {})
+
+
+MOVE_SOURCES: Dict[str, Type[MoveSource]] = {source.name: source for source in [PolyglotBook,
+                                                                                SyzygyTablebase,
+                                                                                GaviotaTablebase,
+                                                                                OnlineTablebase,
+                                                                                ChessDBBook,
+                                                                                LichessCloudAnalysis]}
+
+
+class MoveSourceStats:
+    """How often a move source had a move for a game, how long it took and how often it failed."""
+    def __init__(self) -> None:
+        self.lookups = 0
+        self.hits = 0
+        self.errors = 0
+        self.over_budget = 0
+        self.latencies: List[float] = []
+        self.hit_latency = 0.
+
+    def record(self, latency: float, hit: bool, error: bool, over_budget: bool) -> None:
+        self.lookups += 1
+        self.hits += hit
+        self.errors += error
+        self.over_budget += over_budget
+        self.latencies.append(latency)
+        if hit:
+            self.hit_latency += latency
+
+    def latency_percentile(self, percentile: int) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)] if latencies else 0.
+
+    def time_saved(self, search_time: float) -> float:
+        """The time saved by not searching with the engine, which takes `search_time` seconds for a move."""
+        return self.hits * search_time - self.hit_latency
+
+
+class SpeculativeSearch:
+    """
+    A search that the engine starts while the move sources are asked. Its move is used if none of the sources has one
+    and the tablebases allow it.
+    """
+    def __init__(self, engine: EngineWrapper, game: model.Game, search: Callable[..., chess.engine.PlayResult],
+                 enabled: bool) -> None:
+        self.engine = engine
+        self.game = game
+        self.search = search
+        self.scores_count = len(engine.scores)
+        self.future: Optional[concurrent.futures.Future[chess.engine.PlayResult]] = None
+        if enabled and not isinstance(engine, MinimalEngine):
+            # A search that is cancelled would start pondering on a line that isn't played.
+            self.future = engine.start_speculative_search(
+                lambda: search(chess.engine.PlayResult(None, None), can_ponder=False), game)
+
+    def cancel(self) -> None:
+        if self.future is not None:
+            self.engine.cancel_speculative_search(self.future, self.game)
+            del self.engine.scores[self.scores_count:]
+
+    def result(self, root_moves: MOVE) -> chess.engine.PlayResult:
+        """The move of the search, or of a new search if the tablebases only allow some moves and it found another."""
+        move = self.future.result() if self.future is not None else None
+        if move is not None and (not isinstance(root_moves, list) or move.move in root_moves):
+            return move
+        if move is not None:
+            logger.info(f"Searching again among the tablebase moves for game {self.game.id}.")
+            del self.engine.scores[self.scores_count:]
+        return self.search(root_moves)
+
+
+class MoveSources:
+    """
+    The move sources of a game, which are asked for a move in the configured order before the engine searches.
+
+    It keeps the state of the sources for the game and counts, for each source, how often it had a move, how long
+    it took and how often it failed, so that the order of the sources can be chosen based on these numbers. The
+    `budgets` limit the time in seconds that the online sources may take. With `concurrent_lookups`, the online
+    sources are asked at the same time, and the first move wins (after the moves of the exact sources).
+    """
+    def __init__(self, engine_cfg: config.Configuration, game: model.Game) -> None:
+        move_sources_cfg = engine_cfg.move_sources
+        self.sources = [MOVE_SOURCES[name](engine_cfg) for name in move_sources_cfg.order or []]
+        self.budgets: Dict[str, float] = dict(move_sources_cfg.budgets.items()) if move_sources_cfg.budgets else {}
+        self.online_moves_cfg = engine_cfg.online_moves
+        self.max_out_of_book_moves: int = engine_cfg.online_moves.max_out_of_book_moves
+        self.game = game
+        self.out_of_book_moves = 0
+        self.stats = {source.name: MoveSourceStats() for source in self.sources}
+        self.stats_lock = threading.Lock()
+        self.search_times: List[float] = []
+        self.unused_search: Optional[SpeculativeSearch] = None
+
+    def use_opening_books(self) -> bool:
+        return self.out_of_book_moves < self.max_out_of_book_moves
+
+    def choose_move(self, engine: EngineWrapper, li: lichess.Lichess, board: chess.Board,
+                    search: Callable[..., chess.engine.PlayResult], in_emergency: bool,
+                    engine_cfg: config.Configuration) -> chess.engine.PlayResult:
+        """
+        The move of the fast path or of the first source that has one. Otherwise, the engine searches, only among the
+        moves that the tablebases allow if they only allow some. With `speculative_search`, the engine starts
+        searching while the sources are asked. In an emergency, the engine searches right away.
+
+        Stopping the engine waits for its move, so a search that isn't needed is only stopped by `stop_unused_search`
+        after the move of the source has been sent.
+        """
+        fast_path_move = get_fast_path_move(engine, board, self.game, engine_cfg.fast_path)
+        if fast_path_move.move is not None:
+            engine.skip_search()
+            return fast_path_move
+
+        search_start_time = time.perf_counter()
+        if in_emergency:
+            best_move = search(chess.engine.PlayResult(None, None))
+        else:
+            speculative_search = SpeculativeSearch(engine, self.game, search, bool(engine_cfg.speculative_search.enabled))
+            try:
+                source_move = self.get_move(li, board)
+            except BaseException:
+                speculative_search.cancel()
+                raise
+            if isinstance(source_move, chess.engine.PlayResult) and source_move.move is not None:
+                self.unused_search = speculative_search
+                return source_move
+            best_move = speculative_search.result(source_move)
+        self.record_search(time.perf_counter() - search_start_time)
+        return best_move
+
+    def stop_unused_search(self, engine: EngineWrapper) -> None:
+        """Stop the search and the pondering of the engine when the move came from a source."""
+        if self.unused_search is not None:
+            self.unused_search.cancel()
+            self.unused_search = None
+            engine.skip_search()
+
+    def get_move(self, li: lichess.Lichess, board: chess.Board) -> MOVE:
+        """The move of the first source that has one, or `PlayResult(None, None)` if none has."""
+        use_opening_books = self.use_opening_books()
+        sources = [source for source in self.sources if use_opening_books or not source.is_opening_book]
+        race_online_sources = self.online_moves_cfg.concurrent_lookups.enabled
+        raced = False
+        for source in sources:
+            if race_online_sources and source.is_online:
+                if raced:
+                    continue
+                raced = True
+                best_move = self.race([source for source in sources if source.is_online], li, board)
+            else:
+                best_move = self.ask(source, li, board, self.budgets.get(source.name))
+            if has_move(best_move):
+                return best_move
+
+        if use_opening_books and any(source.is_opening_book for source in sources):
+            self.out_of_book_moves += 1
+            if not self.use_opening_books():
+                logger.info(f"Will stop using online opening books for game {self.game.id}.")
+        return chess.engine.PlayResult(None, None)
+
+    def ask(self, source: MoveSource, li: lichess.Lichess, board: chess.Board, max_time: Optional[float]) -> MOVE:
+        start_time = time.perf_counter()
+        best_move: MOVE = chess.engine.PlayResult(None, None)
+        error = False
+        try:
+            best_move = source.get_move(li, board, self.game, max_time)
+        except Exception as exception:
+            logger.debug(f"The move source {source.name} failed for game {self.game.id}: {exception!r}")
+            error = True
+        latency = time.perf_counter() - start_time
+        over_budget = max_time is not None and latency > max_time
+        with self.stats_lock:
+            self.stats[source.name].record(latency, has_move(best_move), error, over_budget)
+        return best_move
+
+    def race(self, sources: List[MoveSource], li: lichess.Lichess, board: chess.Board) -> MOVE:
+        """
+        Ask the online sources at the same time and take the first move that one of them has. The move of a book is
+        only taken once the exact sources before it have no move. Sources that haven't answered in time are ignored.
+        """
+        no_move = chess.engine.PlayResult(None, None)
+        max_time = online_lookup_time(self.game, self.online_moves_cfg.concurrent_lookups)
+        if max_time <= 0 or not sources:
+            return no_move
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix=f"online-{self.game.id}")
+        lookups = [(source, executor.submit(self.ask, source, li, board, self.race_time(source, max_time)))
+                   for source in sources]
+        executor.shutdown(wait=False)
+
+        end_time = time.monotonic() + max_time
+        pending: Set[concurrent.futures.Future[MOVE]] = {lookup for _, lookup in lookups}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=max(0., end_time - time.monotonic()),
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                logger.info(f"The online sources didn't answer within {max_time:.1f} seconds for game {self.game.id}.")
+                break
+            for source, lookup in lookups:
+                if not lookup.done():
+                    if source.is_exact:
+                        break
+                    continue
+                best_move = lookup.result()
+                if has_move(best_move):
+                    return best_move
+
+        return no_move
+
+    def race_time(self, source: MoveSource, max_time: float) -> float:
+        return min(max_time, self.budgets.get(source.name, max_time))
+
+    def record_search(self, search_time: float) -> None:
+        """Record how long the engine took to find a move, which is the time that a source with a move saves."""
+        self.search_times.append(search_time)
+
+    def log_stats(self) -> None:
+        search_time = sum(self.search_times) / len(self.search_times) if self.search_times else 0.
+        for name, stats in self.stats.items():
+            if stats.lookups == 0:
+                continue
+            logger.info(f"Move source {name} for game {self.game.id}: {stats.hits}/{stats.lookups} hits, "
+                        f"latency p50 {stats.latency_percentile(50) * 1000:.0f} ms, "
+                        f"p99 {stats.latency_percentile(99) * 1000:.0f} ms, {stats.errors} errors, "
+                        f"{stats.over_budget} over budget, {stats.time_saved(search_time):.1f} s saved")
+
+
+def prefetch_online_replies(li: lichess.Lichess, board: chess.Board, online_moves_cfg: config.Configuration,
+                            use_opening_books: bool) -> None:
+    """
+    Put the replies of the online sources for a position into the cache without choosing a move, so that
+    the online move sources find them there. Errors are raised to the caller.
+    """
     online_egtb_cfg = online_moves_cfg.online_egtb
     chessdb_cfg = online_moves_cfg.chessdb_book
     lichess_cloud_cfg = online_moves_cfg.lichess_cloud_analysis
-    max_out_of_book_moves = online_moves_cfg.max_out_of_book_moves
-    offer_draw = False
-    resign = False
-    comment: Optional[chess.engine.InfoDict] = None
-    best_move, wdl = get_online_egtb_move(li, board, game, online_egtb_cfg)
-    if best_move is not None:
-        can_offer_draw = draw_or_resign_cfg.offer_draw_enabled
-        offer_draw_for_zero = draw_or_resign_cfg.offer_draw_for_egtb_zero
-        if can_offer_draw and offer_draw_for_zero and wdl == 0:
-            offer_draw = True
-
-        can_resign = draw_or_resign_cfg.resign_enabled
-        resign_on_egtb_loss = draw_or_resign_cfg.resign_for_egtb_minus_two
-        if can_resign and resign_on_egtb_loss and wdl == -2:
-            resign = True
-
-        wdl_to_score = {2: 9900, 1: 500, 0: 0, -1: -500, -2: -9900}
-        comment = {"score": chess.engine.PovScore(chess.engine.Cp(wdl_to_score[wdl]), board.turn)}
-    elif out_of_online_opening_book_moves[game.id] < max_out_of_book_moves:
-        best_move, comment = get_chessdb_move(li, board, game, chessdb_cfg)
-
-    if best_move is None and out_of_online_opening_book_moves[game.id] < max_out_of_book_moves:
-        best_move, comment = get_lichess_cloud_move(li, board, game, lichess_cloud_cfg)
-
-    if best_move:
-        if isinstance(best_move, str):
-            return chess.engine.PlayResult(chess.Move.from_uci(best_move),
-                                           None,
-                                           comment,
-                                           draw_offered=offer_draw,
-                                           resigned=resign)
-        return [chess.Move.from_uci(move) for move in best_move]
-    out_of_online_opening_book_moves[game.id] += 1
-    used_opening_books = chessdb_cfg.enabled or lichess_cloud_cfg.enabled
-    if out_of_online_opening_book_moves[game.id] == max_out_of_book_moves and used_opening_books:
-        logger.info(f"Will stop using online opening books for game {game.id}.")
-    return chess.engine.PlayResult(None, None)
-
-
-def get_chessdb_move(li: lichess.Lichess, board: chess.Board, game: model.Game,
-                     chessdb_cfg: config.Configuration) -> Tuple[Optional[str], Optional[chess.engine.InfoDict]]:
+    variant = "standard" if board.uci_variant == "chess" else str(board.uci_variant)
+    pieces = chess.popcount(board.occupied)
+
+    if online_egtb_cfg.enabled and pieces <= online_egtb_cfg.max_pieces and not board.castling_rights:
+        source = online_egtb_cfg.source
+        max_lichess_pieces = 7 if board.uci_variant == "chess" else 6
+        if source == "lichess" and board.uci_variant in ["chess", "antichess", "atomic"] and pieces <= max_lichess_pieces:
+            online_cache.lichess_tablebase_get(li, board, variant, None, False, online_egtb_cfg.url)
+            return
+        elif source == "chessdb" and board.uci_variant == "chess":
+            action = "querypv" if online_egtb_cfg.move_quality == "best" else "queryall"
+            online_cache.chessdb_tablebase_get(li, board, action, None, False)
+            return
+
+    if not use_opening_books:
+        return
+    if chessdb_cfg.enabled and board.uci_variant == "chess":
+        online_cache.online_book_get(li, CHESSDB_URL, chessdb_book_params(board, chessdb_cfg.move_quality))
+    if lichess_cloud_cfg.enabled:
+        online_cache.online_book_get(li, LICHESS_CLOUD_URL, lichess_cloud_params(board, lichess_cloud_cfg.move_quality))
+
+
+def online_lookup_time(game: model.Game, concurrent_lookups_cfg: config.Configuration) -> float:
+    """The time (in seconds) that the online sources get to answer: a share of our clock, but no more than `max_time`."""
+    time_share: float = concurrent_lookups_cfg.time_share * game.clock.remaining_time() / 1000
+    max_time: float = concurrent_lookups_cfg.max_time
+    return max(0., min(time_share, max_time))
+
+
+def chessdb_book_params(board: chess.Board, quality: str) -> Dict[str, Any]:
+    action = {"best": "querypv",
+              "good": "querybest",
+              "all": "query"}
+    return {"action": action[quality],
+            "board": board.fen(),
+            "json": 1}
+
+
+def lichess_cloud_params(board: chess.Board, quality: str) -> Dict[str, Any]:
+    multipv = 1 if quality == "best" else 5
+    variant = "standard" if board.uci_variant == "chess" else board.uci_variant
+    return {"fen": board.fen(),
+            "multiPv": multipv,
+            "variant": variant}
+
+
+def get_chessdb_move(li: lichess.Lichess, board: chess.Board, game: model.Game, chessdb_cfg: config.Configuration,
+                     max_time: Optional[float] = None) -> Tuple[Optional[str], Optional[chess.engine.InfoDict]]:
     wb = "w" if board.turn == chess.WHITE else "b"
     use_chessdb = chessdb_cfg.enabled
     time_left = game.state[f"{wb}time"]
     min_time = chessdb_cfg.min_time * 1000
-    if not use_chessdb or time_left < min_time or board.uci_variant != "chess":
+    # A time limit for the lookup replaces the fixed minimum time.
+    enough_time = max_time is not None or time_left >= min_time
+    if not use_chessdb or not enough_time or board.uci_variant != "chess":
         return None, None
 
     move = None
     comment: chess.engine.InfoDict = {}
-    site = "https://www.chessdb.cn/cdb.php"
+    site = CHESSDB_URL
     quality = chessdb_cfg.move_quality
-    action = {"best": "querypv",
-              "good": "querybest",
-              "all": "query"}
+    params = chessdb_book_params(board, quality)
     try:
-        params = {"action": action[quality],
-                  "board": board.fen(),
-                  "json": 1}
-        data = li.online_book_get(site, params=params)
+        data = online_cache.online_book_get(li, site, params, max_time)
         if data["status"] == "ok":
             if quality == "best":
                 depth = data["depth"]
@@ -668,77 +1632,69 @@ def get_chessdb_move(li: lichess.Lichess, board: chess.Board, game: model.Game,
             else:
                 move = data["move"]
                 logger.info(f"Got move {move} from chessdb.cn for game {game.id}")
-
+    finally:
+        # The position is worth analyzing for chessdb.cn even if the lookup failed or timed out.
         if chessdb_cfg.contribute:
-            params["action"] = "queue"
-            li.online_book_get(site, params=params)
-    except Exception:
-        pass
+            background_requests.send_in_background(li, site, {**params, "action": "queue"})
 
     return move, comment
 
 
 def get_lichess_cloud_move(li: lichess.Lichess, board: chess.Board, game: model.Game,
-                           lichess_cloud_cfg: config.Configuration) -> Tuple[Optional[str], Optional[chess.engine.InfoDict]]:
+                           lichess_cloud_cfg: config.Configuration,
+                           max_time: Optional[float] = None) -> Tuple[Optional[str], Optional[chess.engine.InfoDict]]:
     wb = "w" if board.turn == chess.WHITE else "b"
     time_left = game.state[f"{wb}time"]
     min_time = lichess_cloud_cfg.min_time * 1000
     use_lichess_cloud = lichess_cloud_cfg.enabled
-    if not use_lichess_cloud or time_left < min_time:
+    enough_time = max_time is not None or time_left >= min_time
+    if not use_lichess_cloud or not enough_time:
         return None, None
 
     move = None
     comment: chess.engine.InfoDict = {}
 
     quality = lichess_cloud_cfg.move_quality
-    multipv = 1 if quality == "best" else 5
-    variant = "standard" if board.uci_variant == "chess" else board.uci_variant
 
-    try:
-        data = li.online_book_get("https://lichess.org/api/cloud-eval",
-                                  params={"fen": board.fen(),
-                                          "multiPv": multipv,
-                                          "variant": variant})
-        if "error" not in data:
-            depth = data["depth"]
-            knodes = data["knodes"]
-            min_depth = lichess_cloud_cfg.min_depth
-            min_knodes = lichess_cloud_cfg.min_knodes
-            if depth >= min_depth and knodes >= min_knodes:
-                if quality == "best":
-                    pv = data["pvs"][0]
+    data = online_cache.online_book_get(li, LICHESS_CLOUD_URL, lichess_cloud_params(board, quality), max_time)
+    if "error" not in data:
+        depth = data["depth"]
+        knodes = data["knodes"]
+        min_depth = lichess_cloud_cfg.min_depth
+        min_knodes = lichess_cloud_cfg.min_knodes
+        if depth >= min_depth and knodes >= min_knodes:
+            if quality == "best":
+                pv = data["pvs"][0]
+            else:
+                best_eval = data["pvs"][0]["cp"]
+                pvs = data["pvs"]
+                max_difference = lichess_cloud_cfg.max_score_difference
+                if wb == "w":
+                    pvs = list(filter(lambda pv: pv["cp"] >= best_eval - max_difference, pvs))
                 else:
-                    best_eval = data["pvs"][0]["cp"]
-                    pvs = data["pvs"]
-                    max_difference = lichess_cloud_cfg.max_score_difference
-                    if wb == "w":
-                        pvs = list(filter(lambda pv: pv["cp"] >= best_eval - max_difference, pvs))
-                    else:
-                        pvs = list(filter(lambda pv: pv["cp"] <= best_eval + max_difference, pvs))
-                    pv = random.choice(pvs)
-                move = pv["moves"].split()[0]
-                score = pv["cp"] if wb == "w" else -pv["cp"]
-                comment["score"] = chess.engine.PovScore(chess.engine.Cp(score), board.turn)
-                comment["depth"] = data["depth"]
-                comment["nodes"] = data["knodes"] * 1000
-                comment["pv"] = list(map(chess.Move.from_uci, pv["moves"].split()))
-                logger.info(f"Got move {move} from lichess cloud analysis (depth: {depth}, score: {score}, knodes: {knodes})"
-                            f" for game {game.id}")
-    except Exception:
-        pass
+                    pvs = list(filter(lambda pv: pv["cp"] <= best_eval + max_difference, pvs))
+                pv = random.choice(pvs)
+            move = pv["moves"].split()[0]
+            score = pv["cp"] if wb == "w" else -pv["cp"]
+            comment["score"] = chess.engine.PovScore(chess.engine.Cp(score), board.turn)
+            comment["depth"] = data["depth"]
+            comment["nodes"] = data["knodes"] * 1000
+            comment["pv"] = list(map(chess.Move.from_uci, pv["moves"].split()))
+            logger.info(f"Got move {move} from lichess cloud analysis (depth: {depth}, score: {score}, knodes: {knodes})"
+                        f" for game {game.id}")
 
     return move, comment
 
 
-def get_online_egtb_move(li: lichess.Lichess, board: chess.Board, game: model.Game,
-                         online_egtb_cfg: config.Configuration) -> Tuple[Union[str, List[str], None], int]:
+def get_online_egtb_move(li: lichess.Lichess, board: chess.Board, game: model.Game, online_egtb_cfg: config.Configuration,
+                         max_time: Optional[float] = None) -> Tuple[Union[str, List[str], None], int]:
     use_online_egtb = online_egtb_cfg.enabled
     wb = "w" if board.turn == chess.WHITE else "b"
     pieces = chess.popcount(board.occupied)
     source = online_egtb_cfg.source
     minimum_time = online_egtb_cfg.min_time * 1000
+    enough_time = max_time is not None or game.state[f"{wb}time"] >= minimum_time
     if (not use_online_egtb
-            or game.state[f"{wb}time"] < minimum_time
             or board.uci_variant not in ["chess", "antichess", "atomic"]
             and source == "lichess"
             or board.uci_variant != "chess"
@@ -750,41 +1706,26 @@ def get_online_egtb_move(li: lichess.Lichess, board: chess.Board, game: model.Ga
 
     quality = online_egtb_cfg.move_quality
     variant = "standard" if board.uci_variant == "chess" else str(board.uci_variant)
+    # Without enough time to ask the tablebase, the positions that are in the cache are still answered.
+    cache_only = not enough_time
 
-    try:
-        if source == "lichess":
-            return get_lichess_egtb_move(li, game, board, quality, variant)
-        elif source == "chessdb":
-            return get_chessdb_egtb_move(li, game, board, quality)
-    except Exception:
-        pass
+    if source == "lichess":
+        return get_lichess_egtb_move(li, game, board, quality, variant, max_time, cache_only, online_egtb_cfg.url)
+    elif source == "chessdb":
+        return get_chessdb_egtb_move(li, game, board, quality, max_time, cache_only)
 
     return None, -3
 
 
-def get_egtb_move(board: chess.Board, game: model.Game, lichess_bot_tbs: config.Configuration,
-                  draw_or_resign_cfg: config.Configuration) -> Union[chess.engine.PlayResult, List[chess.Move]]:
-    best_move, wdl = get_syzygy(board, game, lichess_bot_tbs.syzygy)
-    if best_move is None:
-        best_move, wdl = get_gaviota(board, game, lichess_bot_tbs.gaviota)
-    if best_move:
-        can_offer_draw = draw_or_resign_cfg.offer_draw_enabled
-        offer_draw_for_zero = draw_or_resign_cfg.offer_draw_for_egtb_zero
-        offer_draw = bool(can_offer_draw and offer_draw_for_zero and wdl == 0)
-
-        can_resign = draw_or_resign_cfg.resign_enabled
-        resign_on_egtb_loss = draw_or_resign_cfg.resign_for_egtb_minus_two
-        resign = bool(can_resign and resign_on_egtb_loss and wdl == -2)
-        wdl_to_score = {2: 9900, 1: 500, 0: 0, -1: -500, -2: -9900}
-        comment: chess.engine.InfoDict = {"score": chess.engine.PovScore(chess.engine.Cp(wdl_to_score[wdl]), board.turn)}
-        if isinstance(best_move, chess.Move):
-            return chess.engine.PlayResult(best_move, None, comment, draw_offered=offer_draw, resigned=resign)
-        return best_move
-    return chess.engine.PlayResult(None, None)
+def opposite_distance(distance: Optional[int]) -> Optional[int]:
+    """The dtz or dtm of tablebase.lichess.ovh for the other side. It is None if the tables don't have it."""
+    return -distance if distance else distance
 
 
-def get_lichess_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Board, quality: str,
-                          variant: str) -> Tuple[Union[str, List[str], None], int]:
+def get_lichess_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Board, quality: str, variant: str,
+                          max_time: Optional[float] = None,
+                          cache_only: bool = False,
+                          url: str = online_cache.LICHESS_TABLEBASE_URL) -> Tuple[Union[str, List[str], None], int]:
     name_to_wld = {"loss": -2,
                    "maybe-loss": -1,
                    "blessed-loss": -1,
@@ -794,16 +1735,13 @@ def get_lichess_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Bo
                    "win": 2}
     pieces = chess.popcount(board.occupied)
     max_pieces = 7 if board.uci_variant == "chess" else 6
-    if pieces <= max_pieces:
-        data = li.online_book_get(f"http://tablebase.lichess.ovh/{variant}",
-                                  params={"fen": board.fen()})
+    data = online_cache.lichess_tablebase_get(li, board, variant, max_time, cache_only, url) if pieces <= max_pieces else None
+    if data is not None:
         if quality == "best":
             move = data["moves"][0]["uci"]
             wdl = name_to_wld[data["moves"][0]["category"]] * -1
-            dtz = data["moves"][0]["dtz"] * -1
-            dtm = data["moves"][0]["dtm"]
-            if dtm:
-                dtm *= -1
+            dtz = opposite_distance(data["moves"][0]["dtz"])
+            dtm = opposite_distance(data["moves"][0]["dtm"])
             logger.info(f"Got move {move} from tablebase.lichess.ovh (wdl: {wdl}, dtz: {dtz}, dtm: {dtm}) for game {game.id}")
         elif quality == "suggest":
             best_wdl = name_to_wld[data["moves"][0]["category"]]
@@ -820,10 +1758,8 @@ def get_lichess_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Bo
                 best_move = possible_moves[0]
                 move = best_move["uci"]
                 wdl = name_to_wld[best_move["category"]] * -1
-                dtz = best_move["dtz"] * -1
-                dtm = best_move["dtm"]
-                if dtm:
-                    dtm *= -1
+                dtz = opposite_distance(best_move["dtz"])
+                dtm = opposite_distance(best_move["dtm"])
                 logger.info(f"Got move {move} from tablebase.lichess.ovh (wdl: {wdl}, dtz: {dtz}, dtm: {dtm})"
                             f" for game {game.id}")
         else:
@@ -835,18 +1771,17 @@ def get_lichess_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Bo
             random_move = random.choice(possible_moves)
             move = random_move["uci"]
             wdl = name_to_wld[random_move["category"]] * -1
-            dtz = random_move["dtz"] * -1
-            dtm = random_move["dtm"]
-            if dtm:
-                dtm *= -1
+            dtz = opposite_distance(random_move["dtz"])
+            dtm = opposite_distance(random_move["dtm"])
             logger.info(f"Got move {move} from tablebase.lichess.ovh (wdl: {wdl}, dtz: {dtz}, dtm: {dtm}) for game {game.id}")
 
         return move, wdl
     return None, -3
 
 
-def get_chessdb_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Board,
-                          quality: str) -> Tuple[Union[str, List[str], None], int]:
+def get_chessdb_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Board, quality: str,
+                          max_time: Optional[float] = None,
+                          cache_only: bool = False) -> Tuple[Union[str, List[str], None], int]:
     def score_to_wdl(score: int) -> int:
         return piecewise_function([(-20001, 2),
                                    (-1, -1),
@@ -860,9 +1795,8 @@ def get_chessdb_egtb_move(li: lichess.Lichess, game: model.Game, board: chess.Bo
                                    (20000, 20000 - score)], 30000 - score, score)
 
     action = "querypv" if quality == "best" else "queryall"
-    data = li.online_book_get("https://www.chessdb.cn/cdb.php",
-                              params={"action": action, "board": board.fen(), "json": 1})
-    if data["status"] == "ok":
+    data = online_cache.chessdb_tablebase_get(li, board, action, max_time, cache_only)
+    if data is not None and data["status"] == "ok":
         if quality == "best":
             score = data["score"]
             move = data["pv"][0]
@@ -912,12 +1846,16 @@ def get_syzygy(board: chess.Board, game: model.Game,
         return None, -3
     move: Union[chess.Move, List[chess.Move]]
     move_quality = syzygy_cfg.move_quality
-    with chess.syzygy.open_tablebase(syzygy_cfg.paths[0]) as tablebase:
-        for path in syzygy_cfg.paths[1:]:
-            tablebase.add_directory(path)
+    with tablebases.tablebases.syzygy(syzygy_cfg, type(board)) as tablebase:
+        # The moves are made on one copy of the board and taken back, which is cheaper than a copy for every move.
+        position = board.copy(stack=False)
+        try:
+            wdls = score_syzygy_moves(position, syzygy_wdl_scorer, tablebase, list(position.legal_moves))
+        except KeyError:
+            return None, -3
 
         try:
-            moves = score_syzygy_moves(board, dtz_scorer, tablebase)
+            moves = score_best_syzygy_moves(position, wdls, tablebase)
 
             best_wdl = max(map(dtz_to_wdl, moves.values()))
             good_moves = [(move, dtz) for move, dtz in moves.items() if dtz_to_wdl(dtz) == best_wdl]
@@ -936,26 +1874,43 @@ def get_syzygy(board: chess.Board, game: model.Game,
                 logger.info(f"Got move {move.uci()} from syzygy (wdl: {best_wdl}, dtz: {best_dtz}) for game {game.id}")
                 return move, best_wdl
         except KeyError:
-            # Attempt to only get the WDL score. It returns a move of quality="good", even if quality is set to "best".
-            try:
-                moves = score_syzygy_moves(board, lambda tablebase, b: -tablebase.probe_wdl(b), tablebase)
-                best_wdl = max(moves.values())
-                good_chess_moves = [chess_move for chess_move, wdl in moves.items() if wdl == best_wdl]
-                logger.debug("Found a move using 'move_quality'='good'. We didn't find an '.rtbz' file for this endgame."
-                             if move_quality == "best" else "")
-                if move_quality == "suggest" and len(good_chess_moves) > 1:
-                    move = good_chess_moves
-                    logger.info(f"Suggesting moves from syzygy (wdl: {best_wdl}) for game {game.id}")
-                else:
-                    move = random.choice(good_chess_moves)
-                    logger.info(f"Got move {move.uci()} from syzygy (wdl: {best_wdl}) for game {game.id}")
-                return move, best_wdl
-            except KeyError:
-                return None, -3
+            # Only use the WDL score. It returns a move of quality="good", even if quality is set to "best".
+            best_wdl = max(wdls.values())
+            good_chess_moves = [chess_move for chess_move, wdl in wdls.items() if wdl == best_wdl]
+            logger.debug("Found a move using 'move_quality'='good'. We didn't find an '.rtbz' file for this endgame."
+                         if move_quality == "best" else "")
+            if move_quality == "suggest" and len(good_chess_moves) > 1:
+                move = good_chess_moves
+                logger.info(f"Suggesting moves from syzygy (wdl: {best_wdl}) for game {game.id}")
+            else:
+                move = random.choice(good_chess_moves)
+                logger.info(f"Got move {move.uci()} from syzygy (wdl: {best_wdl}) for game {game.id}")
+            return move, best_wdl
+
+
+def score_best_syzygy_moves(board: chess.Board, wdls: Dict[chess.Move, int],
+                            tablebase: chess.syzygy.Tablebase) -> Dict[chess.Move, int]:
+    """
+    The dtz scores of the moves that can be the best, given their wdl scores. The halfmove clock can turn a win into a
+    cursed win and a loss into a blessed loss, so the moves of the next wdl class are scored too while their best
+    dtz class is as good as the best one found.
+    """
+    best_dtz_wdl = {2: 2, 1: 1, 0: 0, -1: -1, -2: -1}
+    moves: Dict[chess.Move, int] = {}
+    for wdl in sorted(set(wdls.values()), reverse=True):
+        if moves and max(map(dtz_to_wdl, moves.values())) > best_dtz_wdl[wdl]:
+            break
+        moves.update(score_syzygy_moves(board, dtz_scorer, tablebase, [move for move in wdls if wdls[move] == wdl]))
+    # The moves keep the order of the legal moves.
+    return {move: moves[move] for move in wdls if move in moves}
+
+
+def syzygy_wdl_scorer(tablebase: chess.syzygy.Tablebase, board: chess.Board) -> int:
+    return -tablebases.probe_cache.probe("syzygy wdl", board, tablebase.probe_wdl)
 
 
 def dtz_scorer(tablebase: chess.syzygy.Tablebase, board: chess.Board) -> int:
-    dtz = -tablebase.probe_dtz(board)
+    dtz = -tablebases.probe_cache.probe("syzygy dtz", board, tablebase.probe_dtz)
     return dtz + (1 if dtz > 0 else -1) * board.halfmove_clock * (0 if dtz == 0 else 1)
 
 
@@ -978,15 +1933,14 @@ def get_gaviota(board: chess.Board, game: model.Game,
     # guarantees that all moves have a syzygy wdl=2/-2. Setting min_dtm_to_consider_as_wdl_1 to 100 will disable it
     # because dtm >= dtz, so if abs(dtm) < 100 => abs(dtz) < 100, so wdl=2/-2.
     min_dtm_to_consider_as_wdl_1 = gaviota_cfg.min_dtm_to_consider_as_wdl_1
-    with chess.gaviota.open_tablebase(gaviota_cfg.paths[0]) as tablebase:
-        for path in gaviota_cfg.paths[1:]:
-            tablebase.add_directory(path)
-
+    with tablebases.tablebases.gaviota(gaviota_cfg) as tablebase:
         try:
-            moves = score_gaviota_moves(board, dtm_scorer, tablebase)
-
-            best_wdl = max(map(dtm_to_gaviota_wdl, moves.values()))
-            good_moves = [(move, dtm) for move, dtm in moves.items() if dtm_to_gaviota_wdl(dtm) == best_wdl]
+            # The dtm is only needed for the moves with the best result.
+            position = board.copy(stack=False)
+            wdls = score_gaviota_moves(position, gaviota_wdl_scorer, tablebase, list(position.legal_moves))
+            best_wdl = max(wdls.values())
+            good_moves = list(score_gaviota_moves(position, dtm_scorer, tablebase,
+                                                  [move for move in wdls if wdls[move] == best_wdl]).items())
             best_dtm = min([dtm for move, dtm in good_moves])
 
             pseudo_wdl = dtm_to_wdl(best_dtm, min_dtm_to_consider_as_wdl_1)
@@ -1013,8 +1967,21 @@ def get_gaviota(board: chess.Board, game: model.Game,
             return None, -3
 
 
+def gaviota_wdl_scorer(tablebase: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase],
+                       board: chess.Board) -> int:
+    if board.is_checkmate():
+        # The tables give a mated position a dtm of 0, as if it were a draw.
+        return 1
+    if isinstance(tablebase, chess.gaviota.PythonTablebase):
+        # The Python tables find the wdl through the dtm, so the dtm is kept for scoring the best moves.
+        return dtm_to_gaviota_wdl(-tablebases.probe_cache.probe("gaviota dtm", board, tablebase.probe_dtm))
+    return -tablebases.probe_cache.probe("gaviota wdl", board, tablebase.probe_wdl)
+
+
 def dtm_scorer(tablebase: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase], board: chess.Board) -> int:
-    dtm = -tablebase.probe_dtm(board)
+    if board.is_checkmate():
+        return 1
+    dtm = -tablebases.probe_cache.probe("gaviota dtm", board, tablebase.probe_dtm)
     return dtm + (1 if dtm > 0 else -1) * board.halfmove_clock * (0 if dtm == 0 else 1)
 
 
@@ -1095,23 +2062,29 @@ def piecewise_function(range_definitions: List[Tuple[int, int]], last_value: int
 
 
 def score_syzygy_moves(board: chess.Board, scorer: Callable[[chess.syzygy.Tablebase, chess.Board], int],
-                       tablebase: chess.syzygy.Tablebase) -> Dict[chess.Move, int]:
-    moves = {}
-    for move in board.legal_moves:
-        board_copy = board.copy()
-        board_copy.push(move)
-        moves[move] = scorer(tablebase, board_copy)
-    return moves
+                       tablebase: chess.syzygy.Tablebase, moves: Iterable[chess.Move]) -> Dict[chess.Move, int]:
+    """The scores of the positions after `moves`. The moves are made on `board` and taken back."""
+    scores = {}
+    for move in moves:
+        board.push(move)
+        try:
+            scores[move] = scorer(tablebase, board)
+        finally:
+            board.pop()
+    return scores
 
 
 def score_gaviota_moves(board: chess.Board,
                         scorer: Callable[[Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase],
                                           chess.Board], int],
-                        tablebase: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase]
-                        ) -> Dict[chess.Move, int]:
-    moves = {}
-    for move in board.legal_moves:
-        board_copy = board.copy()
-        board_copy.push(move)
-        moves[move] = scorer(tablebase, board_copy)
-    return moves
+                        tablebase: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase],
+                        moves: Iterable[chess.Move]) -> Dict[chess.Move, int]:
+    """The scores of the positions after `moves`. The moves are made on `board` and taken back."""
+    scores = {}
+    for move in moves:
+        board.push(move)
+        try:
+            scores[move] = scorer(tablebase, board)
+        finally:
+            board.pop()
+    return scores
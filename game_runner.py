@@ -0,0 +1,68 @@
+from __future__ import annotations
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+import chess.engine
+import engine_wrapper
+from types import TracebackType
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadGameRunner:
+    """
+    Plays games in threads of the main process instead of in a pool of processes.
+
+    Every game runs in a thread of its own, which blocks on the game stream, the `requests` calls and the searches
+    of its engine like a game process does. The engines of all games share one asyncio event loop (the protocols of
+    `chess.engine`) in another thread instead of each engine starting an event loop thread of its own. No game pays
+    for a new interpreter, re-imported modules or its own HTTP sessions.
+
+    It has the same interface as `multiprocessing.pool.Pool` as far as `lichess_bot_main` is concerned.
+    """
+    def __init__(self, max_games: int) -> None:
+        if not isinstance(asyncio.get_event_loop_policy(), chess.engine.EventLoopPolicy):
+            asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.run_loop, name="engine-event-loop", daemon=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_games + 1, thread_name_prefix="game")
+        self.games: List[concurrent.futures.Future[None]] = []
+
+    def __enter__(self) -> ThreadGameRunner:
+        self.loop_thread.start()
+        engine_wrapper.use_engine_event_loop(self.loop)
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        # Unlike processes, threads can't be killed, so let the games that are still running finish.
+        self.games = [game for game in self.games if not game.done()]
+        if self.games:
+            logger.info(f"Waiting for {len(self.games)} game(s) to finish.")
+        self.executor.shutdown()
+        engine_wrapper.correspondence_sessions.close()
+        engine_wrapper.engine_pool.close()
+        engine_wrapper.use_engine_event_loop(None)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    def run_loop(self) -> None:
+        # The event loop policy of `chess.engine` needs the loop to be the current loop of its thread to start engines.
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def apply_async(self, func: Callable[..., None], kwds: Dict[str, Any],
+                    error_callback: Callable[[BaseException], None], args: Tuple[Any, ...] = ()) -> None:
+        self.games = [running_game for running_game in self.games if not running_game.done()]
+        game = self.executor.submit(func, *args, **kwds)
+        game.add_done_callback(functools.partial(self.report_error, error_callback))
+        self.games.append(game)
+
+    def report_error(self, error_callback: Callable[[BaseException], None], game: concurrent.futures.Future[None]) -> None:
+        error = game.exception()
+        if error is not None:
+            error_callback(error)
@@ -2,9 +2,14 @@
 import argparse
 import chess
 import chess.pgn
-from chess.variant import find_variant
 import engine_wrapper
+import engine_scheduler
+import game_runner
 import model
+import online_cache
+import online_prefetch
+import tablebases
+import tablebase_prewarm
 import json
 import lichess
 import logging
@@ -16,7 +21,6 @@ import time
 import backoff
 import os
 import io
-import copy
 import math
 import sys
 import yaml
@@ -40,7 +44,7 @@ CONTROL_QUEUE_TYPE = "Queue[EVENT_TYPE]"
 CORRESPONDENCE_QUEUE_TYPE = "Queue[str]"
 LOGGING_QUEUE_TYPE = "Queue[logging.LogRecord]"
 MULTIPROCESSING_LIST_TYPE = List[model.Challenge]
-POOL_TYPE = Pool
+POOL_TYPE = Union[Pool, game_runner.ThreadGameRunner]
 
 logger = logging.getLogger(__name__)
 
@@ -142,6 +146,8 @@ def game_error_handler(error: BaseException) -> None:
 def start(li: lichess.Lichess, user_profile: USER_PROFILE_TYPE, config: Configuration, logging_level: int,
           log_filename: Optional[str], one_game: bool = False) -> None:
     logger.info(f"You're now connected to {config.url} and awaiting challenges.")
+    engine_scheduler.core_pinner = engine_scheduler.CorePinner(config.engine.cpu_affinity, config.challenge.concurrency)
+    engine_scheduler.core_pinner.pin_housekeeping()
     manager = multiprocessing.Manager()
     challenge_queue: MULTIPROCESSING_LIST_TYPE = manager.list()  # type: ignore[assignment]
     control_queue: CONTROL_QUEUE_TYPE = manager.Queue()
@@ -152,6 +158,8 @@ def start(li: lichess.Lichess, user_profile: USER_PROFILE_TYPE, config: Configur
                                                           config.correspondence.checkin_period))
     correspondence_pinger.start()
     correspondence_queue: CORRESPONDENCE_QUEUE_TYPE = manager.Queue()
+    resource_weights: engine_scheduler.RESOURCE_WEIGHTS_TYPE = manager.dict()
+    searching_games: engine_scheduler.SEARCHING_GAMES_TYPE = manager.dict()
 
     logging_queue = manager.Queue()
     logging_listener = multiprocessing.Process(target=logging_listener_proc,
@@ -159,6 +167,9 @@ def start(li: lichess.Lichess, user_profile: USER_PROFILE_TYPE, config: Configur
                                                      logging_level,
                                                      log_filename))
     logging_listener.start()
+    tablebase_cache = tablebases.create_shared_cache(config.engine.lichess_bot_tbs.shared_cache)
+    tablebase_prewarmer = tablebase_prewarm.TablebasePrewarmer(config.engine.lichess_bot_tbs)
+    tablebase_prewarmer.start()
 
     try:
         lichess_bot_main(li,
@@ -169,8 +180,13 @@ def start(li: lichess.Lichess, user_profile: USER_PROFILE_TYPE, config: Configur
                          control_queue,
                          correspondence_queue,
                          logging_queue,
+                         resource_weights,
+                         searching_games,
+                         tablebase_cache,
                          one_game)
     finally:
+        tablebase_prewarmer.stop()
+        tablebases.close_shared_cache()
         control_stream.terminate()
         control_stream.join()
         correspondence_pinger.terminate()
@@ -192,6 +208,9 @@ def lichess_bot_main(li: lichess.Lichess,
                      control_queue: CONTROL_QUEUE_TYPE,
                      correspondence_queue: CORRESPONDENCE_QUEUE_TYPE,
                      logging_queue: LOGGING_QUEUE_TYPE,
+                     resource_weights: engine_scheduler.RESOURCE_WEIGHTS_TYPE,
+                     searching_games: engine_scheduler.SEARCHING_GAMES_TYPE,
+                     tablebase_cache: Optional[str],
                      one_game: bool) -> None:
     global restart
 
@@ -218,11 +237,14 @@ def lichess_bot_main(li: lichess.Lichess,
                       "challenge_queue": challenge_queue,
                       "correspondence_queue": correspondence_queue,
                       "logging_queue": logging_queue,
+                      "resource_weights": resource_weights,
+                      "searching_games": searching_games,
+                      "tablebase_cache": tablebase_cache,
                       "logging_level": logging_level}
 
     recent_bot_challenges: DefaultDict[str, List[Timer]] = defaultdict(list)
 
-    with multiprocessing.pool.Pool(max_games + 1) as pool:
+    with create_game_pool(config, max_games) as pool:
         while not (terminated or (one_game and one_game_completed) or restart):
             event = next_event(control_queue)
             if not event:
@@ -234,6 +256,7 @@ def lichess_bot_main(li: lichess.Lichess,
                 break
             elif event["type"] in ["local_game_done", "gameFinish"]:
                 active_games.discard(event["game"]["id"])
+                engine_scheduler.core_pinner.release(event["game"]["id"])
                 matchmaker.last_game_ended_delay.reset()
                 log_proc_count("Freed", active_games)
                 one_game_completed = True
@@ -270,6 +293,14 @@ def lichess_bot_main(li: lichess.Lichess,
     logger.info("Terminated")
 
 
+def create_game_pool(config: Configuration, max_games: int) -> POOL_TYPE:
+    if config.game_runner == "thread":
+        return game_runner.ThreadGameRunner(max_games)
+    # Only the processes that keep engines in the pool need to quit them when the pool terminates them.
+    initializer = engine_wrapper.quit_pooled_engines_at_exit if config.engine.engine_pool.enabled else None
+    return multiprocessing.pool.Pool(max_games + 1, initializer=initializer)
+
+
 def next_event(control_queue: CONTROL_QUEUE_TYPE) -> EVENT_TYPE:
     try:
         event: EVENT_TYPE = control_queue.get()  # type: ignore[attr-defined]
@@ -363,6 +394,7 @@ def start_game_thread(active_games: Set[str], game_id: str, play_game_args: PLAY
     active_games.add(game_id)
     log_proc_count("Used", active_games)
     play_game_args["game_id"] = game_id
+    play_game_args["engine_cores"] = engine_scheduler.core_pinner.assign(game_id)
     pool.apply_async(play_game,
                      kwds=play_game_args,
                      error_callback=game_error_handler)
@@ -432,9 +464,13 @@ def play_game(li: lichess.Lichess,
               challenge_queue: MULTIPROCESSING_LIST_TYPE,
               correspondence_queue: CORRESPONDENCE_QUEUE_TYPE,
               logging_queue: LOGGING_QUEUE_TYPE,
-              logging_level: int) -> None:
+              resource_weights: engine_scheduler.RESOURCE_WEIGHTS_TYPE,
+              searching_games: engine_scheduler.SEARCHING_GAMES_TYPE,
+              tablebase_cache: Optional[str],
+              logging_level: int,
+              engine_cores: List[int]) -> None:
 
-    game_logging_configurer(logging_queue, logging_level)
+    set_up_game(config, logging_queue, logging_level, tablebase_cache)
     logger = logging.getLogger(__name__)
 
     response = li.get_game_stream(game_id)
@@ -445,10 +481,16 @@ def play_game(li: lichess.Lichess,
     logger.debug(f"Initial state: {initial_state}")
     abort_time = config.abort_time
     game = model.Game(initial_state, user_profile["username"], li.baseUrl, abort_time)
+    resource_scheduler = engine_scheduler.ResourceScheduler(resource_weights, searching_games,
+                                                            config.engine.resource_scheduler, game)
+    move_sources = engine_wrapper.MoveSources(config.engine, game)
+    prefetcher = online_prefetch.OnlinePrefetcher(li, config.engine, game, move_sources)
 
-    with engine_wrapper.create_engine(config) as engine:
+    with engine_wrapper.create_engine(config, game) as engine, resource_scheduler, prefetcher:
+        engine.new_game(game)
         engine.get_opponent_info(game)
         logger.debug(f"The engine for game {game_id} has pid={engine.get_pid()}")
+        engine.pin(engine_cores)
         conversation = Conversation(game, engine, li, __version__, challenge_queue)
 
         logger.info(f"+++ {game}")
@@ -461,7 +503,6 @@ def play_game(li: lichess.Lichess,
         engine_cfg = config.engine
         ponder_cfg = correspondence_cfg if is_correspondence else engine_cfg
         can_ponder = ponder_cfg.uci_ponder or ponder_cfg.ponder
-        move_overhead = config.move_overhead
         delay_seconds = config.rate_limiting_delay/1000
 
         keyword_map: DefaultDict[str, str] = defaultdict(str, me=game.me.name, opponent=game.opponent.name)
@@ -472,7 +513,8 @@ def play_game(li: lichess.Lichess,
 
         disconnect_time = correspondence_disconnect_time if not game.state.get("moves") else 0
         prior_game = None
-        board = chess.Board()
+        board_tracker = model.BoardTracker(game)
+        board = board_tracker.board
         upd: Dict[str, Any] = game.state
         while not terminated:
             move_attempted = False
@@ -482,35 +524,41 @@ def play_game(li: lichess.Lichess,
                 if u_type == "chatLine":
                     conversation.react(ChatLine(upd), game)
                 elif u_type == "gameState":
-                    game.state = upd
-                    board = setup_board(game)
+                    game.update_state(upd)
+                    board = board_tracker.update()
                     if not is_game_over(game) and is_engine_move(game, prior_game, board):
                         disconnect_time = correspondence_disconnect_time
                         say_hello(conversation, hello, hello_spectators, board)
-                        start_time = time.perf_counter_ns()
+                        start_time = game.clock.arrival_time
                         fake_thinking(config, board, game)
                         print_move_number(board)
+                        prefetcher.cancel()
+                        resource_scheduler.start_search(engine)
                         move_attempted = True
-                        engine.play_move(board,
-                                         game,
-                                         li,
-                                         start_time,
-                                         move_overhead,
-                                         can_ponder,
-                                         is_correspondence,
-                                         correspondence_move_time,
-                                         engine_cfg)
+                        best_move = engine.play_move(board,
+                                                     game,
+                                                     li,
+                                                     start_time,
+                                                     get_move_overhead(config, game),
+                                                     can_ponder,
+                                                     is_correspondence,
+                                                     correspondence_move_time,
+                                                     engine_cfg,
+                                                     move_sources)
+                        resource_scheduler.end_search(engine)
+                        prefetcher.prefetch(board, best_move)
                         time.sleep(delay_seconds)
                     elif is_game_over(game):
                         engine.report_game_result(game, board)
                         tell_user_game_result(game, board)
+                        record_game_stats(config, game, move_sources)
                         conversation.send_message("player", goodbye)
                         conversation.send_message("spectator", goodbye_spectators)
 
                     wb = "w" if board.turn == chess.WHITE else "b"
                     terminate_time = (upd[f"{wb}time"] + upd[f"{wb}inc"]) / 1000 + 60
                     game.ping(abort_time, terminate_time, disconnect_time)
-                    prior_game = copy.deepcopy(game)
+                    prior_game = game.snapshot()
                 elif u_type == "ping" and should_exit_game(board, game, prior_game, li, is_correspondence):
                     break
             except (HTTPError,
@@ -531,6 +579,31 @@ def play_game(li: lichess.Lichess,
     final_queue_entries(control_queue, correspondence_queue, game, is_correspondence)
 
 
+def set_up_game(config: Configuration, logging_queue: LOGGING_QUEUE_TYPE, logging_level: int,
+                tablebase_cache: Optional[str]) -> None:
+    """Set up the logging and the caches for a game, which may be played in a process of its own."""
+    if multiprocessing.parent_process() is not None:
+        # Games played by the thread game runner share the logging of the main process.
+        game_logging_configurer(logging_queue, logging_level)
+    online_cache.use_cache(config.engine.online_moves.cache)
+    tablebases.use_shared_cache(tablebase_cache)
+    tablebases.probe_cache.count_endgames = bool(config.engine.lichess_bot_tbs.prewarm.enabled)
+
+
+def get_move_overhead(config: Configuration, game: model.Game) -> int:
+    move_overhead: int = config.move_overhead
+    return game.clock.move_overhead(move_overhead) if config.adaptive_move_overhead else move_overhead
+
+
+def record_game_stats(config: Configuration, game: model.Game, move_sources: engine_wrapper.MoveSources) -> None:
+    """Log the statistics of a game that is over and save its tablebase probes for the prewarmer."""
+    engine_wrapper.log_emergency_mode_result(game)
+    move_sources.log_stats()
+    prewarm_cfg = config.engine.lichess_bot_tbs.prewarm
+    if prewarm_cfg.enabled:
+        tablebases.probe_cache.save_endgame_probes(prewarm_cfg.probe_log)
+
+
 def get_greeting(greeting: str, greeting_cfg: Configuration, keyword_map: DefaultDict[str, str]) -> str:
     greeting_text: str = greeting_cfg.lookup(greeting)
     return greeting_text.format_map(keyword_map)
@@ -563,25 +636,7 @@ def next_update(lines: Iterator[bytes]) -> GAME_EVENT_TYPE:
     return upd
 
 
-def setup_board(game: model.Game) -> chess.Board:
-    if game.variant_name.lower() == "chess960":
-        board = chess.Board(game.initial_fen, chess960=True)
-    elif game.variant_name == "From Position":
-        board = chess.Board(game.initial_fen)
-    else:
-        VariantBoard = find_variant(game.variant_name)
-        board = VariantBoard()
-
-    for move in game.state["moves"].split():
-        try:
-            board.push_uci(move)
-        except ValueError:
-            logger.exception(f"Ignoring illegal move {move} on board {board.fen()}")
-
-    return board
-
-
-def is_engine_move(game: model.Game, prior_game: Optional[model.Game], board: chess.Board) -> bool:
+def is_engine_move(game: model.Game, prior_game: Optional[model.GameSnapshot], board: chess.Board) -> bool:
     return game_changed(game, prior_game) and game.is_white == (board.turn == chess.WHITE)
 
 
@@ -590,7 +645,7 @@ def is_game_over(game: model.Game) -> bool:
     return status != "started"
 
 
-def should_exit_game(board: chess.Board, game: model.Game, prior_game: Optional[model.Game], li: lichess.Lichess,
+def should_exit_game(board: chess.Board, game: model.Game, prior_game: Optional[model.GameSnapshot], li: lichess.Lichess,
                      is_correspondence: bool) -> bool:
     if (is_correspondence
             and not is_engine_move(game, prior_game, board)
@@ -620,13 +675,11 @@ def final_queue_entries(control_queue: CONTROL_QUEUE_TYPE, correspondence_queue:
     control_queue.put_nowait({"type": "local_game_done", "game": {"id": game.id}})  # type: ignore[attr-defined]
 
 
-def game_changed(current_game: model.Game, prior_game: Optional[model.Game]) -> bool:
+def game_changed(current_game: model.Game, prior_game: Optional[model.GameSnapshot]) -> bool:
     if prior_game is None:
         return True
 
-    current_game_moves_str: str = current_game.state["moves"]
-    prior_game_moves_str: str = prior_game.state["moves"]
-    return current_game_moves_str != prior_game_moves_str
+    return current_game.ply_count != prior_game.ply_count or current_game.last_move != prior_game.last_move
 
 
 def tell_user_game_result(game: model.Game, board: chess.Board) -> None:
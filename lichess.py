@@ -1,4 +1,6 @@
 import json
+import contextlib
+import threading
 import requests
 from urllib.parse import urljoin
 from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
@@ -7,7 +9,7 @@ import backoff
 import logging
 from collections import defaultdict
 from timer import Timer
-from typing import Optional, Dict, Union, Any, List, DefaultDict
+from typing import Optional, Dict, Union, Any, List, DefaultDict, Iterator
 import chess.engine
 JSON_REPLY_TYPE = Dict[str, Any]
 REQUESTS_PAYLOAD_TYPE = Dict[str, Any]
@@ -37,6 +39,9 @@ logger = logging.getLogger(__name__)
 
 MAX_CHAT_MESSAGE_LEN = 140  # The maximum characters in a chat message.
 
+# Guards the idle online sessions of the Lichess objects. It isn't an attribute, since Lichess objects are pickled.
+online_sessions_lock = threading.Lock()
+
 
 class RateLimited(RuntimeError):
     pass
@@ -60,7 +65,7 @@ class Lichess:
         self.baseUrl = url
         self.session = requests.Session()
         self.session.headers.update(self.header)
-        self.other_session = requests.Session()
+        self.online_sessions: List[requests.Session] = [requests.Session()]
         self.set_user_agent("?")
         self.logging_level = logging_level
         self.max_retries = max_retries
@@ -232,20 +237,50 @@ class Lichess:
     def cancel(self, challenge_id: str) -> JSON_REPLY_TYPE:
         return self.api_post("cancel", challenge_id, raise_for_status=False)
 
-    def online_book_get(self, path: str, params: Optional[Dict[str, Any]] = None) -> JSON_REPLY_TYPE:
+    def online_book_get(self, path: str, params: Optional[Dict[str, Any]] = None, max_time: Optional[float] = None,
+                        session: Optional[requests.Session] = None) -> JSON_REPLY_TYPE:
+        """
+        Get a reply from an online move source. `max_time` (in seconds) bounds the request and its retries.
+
+        The request uses `session`, or an idle session of this object if there is none.
+        """
+        if session is None:
+            with self.online_session() as online_session:
+                return self.online_book_get(path, params, max_time, online_session)
+
+        time_limit = 60 if max_time is None else max_time
+
         @backoff.on_exception(backoff.constant,
                               (RemoteDisconnected, ConnectionError, HTTPError, ReadTimeout),
-                              max_time=60,
+                              max_time=time_limit,
                               max_tries=self.max_retries,
                               interval=0.1,
                               giveup=is_final,
                               backoff_log_level=logging.DEBUG,
                               giveup_log_level=logging.DEBUG)
         def online_book_get() -> JSON_REPLY_TYPE:
-            json_response: JSON_REPLY_TYPE = self.other_session.get(path, timeout=2, params=params).json()
+            response = session.get(path, timeout=min(2, time_limit), params=params)
+            # The replies to rate limited or failed requests say nothing about the position.
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            json_response: JSON_REPLY_TYPE = response.json()
             return json_response
         return online_book_get()
 
+    @contextlib.contextmanager
+    def online_session(self) -> Iterator[requests.Session]:
+        """
+        Borrow an HTTP session for the online sources. A `requests.Session` can't be used by several threads at once,
+        so lookups that run at the same time (e.g. the online sources that race for a move) get sessions of their own.
+        """
+        with online_sessions_lock:
+            session = self.online_sessions.pop() if self.online_sessions else requests.Session()
+        try:
+            yield session
+        finally:
+            with online_sessions_lock:
+                self.online_sessions.append(session)
+
     def is_online(self, user_id: str) -> bool:
         user = self.api_get_list("status", params={"ids": user_id})
         return bool(user and user[0].get("online"))
@@ -2,15 +2,25 @@ import math
 from urllib.parse import urljoin
 import logging
 import datetime
+import time
+import chess
+from chess.variant import find_variant
 from enum import Enum
 from timer import Timer
 from config import Configuration
-from typing import Dict, Any, Tuple, List, DefaultDict
+from typing import Dict, Any, Tuple, List, DefaultDict, NamedTuple
 
 logger = logging.getLogger(__name__)
 
+# The adaptive move overhead stays between these multiples of the configured move overhead.
+MIN_OVERHEAD_FACTOR = 0.25
+MAX_OVERHEAD_FACTOR = 4
+
 
 class Challenge:
+    __slots__ = ("id", "rated", "variant", "perf_name", "speed", "increment", "base", "days", "challenger", "opponent",
+                 "from_self")
+
     def __init__(self, c_info: Dict[str, Any], user_profile: Dict[str, Any]) -> None:
         self.id = c_info["id"]
         self.rated = c_info["rated"]
@@ -111,7 +121,94 @@ class Termination(str, Enum):
     DRAW = "draw"
 
 
+class GameSnapshot(NamedTuple):
+    """The parts of a game's state needed to tell whether it changed between two updates."""
+    ply_count: int
+    last_move: str
+    wtime: int
+    btime: int
+    status: str
+
+
+class ClockModel:
+    """
+    Extrapolates our clock between the updates of a game and measures the lag between us and Lichess.
+
+    Each update is timestamped when it arrives, so the time spent since then can be taken off the clock that Lichess
+    reported. When our move comes back from Lichess, the clock that Lichess reports is compared with the clock we
+    expected when we sent the move. The difference is the lag: the time the opponent's move took to reach us plus
+    the time our move took to reach Lichess.
+    """
+    __slots__ = ("game", "arrival_time", "reported_time", "expected_time", "sent_ply", "lag", "lag_deviation",
+                 "lag_samples")
+
+    def __init__(self, game: "Game") -> None:
+        self.game = game
+        self.arrival_time = time.perf_counter_ns()
+        self.reported_time = 0
+        self.expected_time = 0
+        self.sent_ply = -1
+        self.lag = 0.0
+        self.lag_deviation = 0.0
+        self.lag_samples = 0
+
+    def my_time(self) -> int:
+        my_time: int = self.game.state.get("wtime" if self.game.is_white else "btime", 0)
+        return my_time
+
+    def my_increment(self) -> int:
+        increment: int = self.game.state.get("winc" if self.game.is_white else "binc", 0)
+        return increment
+
+    def update(self) -> None:
+        """Record the arrival of a new game state and measure the lag if it contains the move we sent."""
+        self.arrival_time = time.perf_counter_ns()
+        if 0 <= self.sent_ply < self.game.ply_count:
+            self.add_lag_sample(self.expected_time - self.my_time())
+            self.sent_ply = -1
+        self.reported_time = self.my_time()
+
+    def remaining_time(self) -> int:
+        """Our remaining time (in ms) right now."""
+        return self.reported_time - int((time.perf_counter_ns() - self.arrival_time) / 1e6)
+
+    def move_sent(self) -> None:
+        # The clocks start running after both players have made their first move.
+        if self.game.ply_count >= 2:
+            self.expected_time = self.remaining_time() + self.my_increment()
+            self.sent_ply = self.game.ply_count
+
+    def add_lag_sample(self, lag: int) -> None:
+        # Lichess gives back some of the lag, so our clock can be higher than expected.
+        lag = max(0, lag)
+        if self.lag_samples == 0:
+            self.lag = lag
+            self.lag_deviation = lag / 2
+        else:
+            self.lag_deviation += (abs(lag - self.lag) - self.lag_deviation) / 4
+            self.lag += (lag - self.lag) / 4
+        self.lag_samples += 1
+        logger.debug(f"Measured a lag of {lag} ms (average {self.lag:.0f} ms) for game {self.game.id}")
+
+    def move_overhead(self, default_overhead: int) -> int:
+        """
+        The time (in ms) to keep in reserve for the lag. The default is used until the lag has been measured.
+
+        A few quick moves can make the measured lag almost zero, and a single slow move can make it huge, so the
+        overhead stays between `MIN_OVERHEAD_FACTOR` and `MAX_OVERHEAD_FACTOR` times the default.
+        """
+        if self.lag_samples == 0:
+            return default_overhead
+        overhead = int(self.lag + 4 * self.lag_deviation)
+        return min(max(overhead, int(default_overhead * MIN_OVERHEAD_FACTOR)), int(default_overhead * MAX_OVERHEAD_FACTOR))
+
+
 class Game:
+    __slots__ = ("username", "id", "speed", "clock_initial", "clock_increment", "perf_name", "variant_name", "mode",
+                 "white", "black", "initial_fen", "_state", "ply_count", "last_move", "is_white", "my_color",
+                 "opponent_color", "me", "opponent", "base_url", "game_start", "abort_time", "terminate_time",
+                 "disconnect_time", "clock")
+
     def __init__(self, json: Dict[str, Any], username: str, base_url: str, abort_time: int) -> None:
         self.username = username
         self.id: str = json["id"]
@@ -126,7 +223,7 @@ class Game:
         self.white = Player(json["white"])
         self.black = Player(json["black"])
         self.initial_fen = json.get("initialFen")
-        self.state: Dict[str, Any] = json["state"]
+        self.state = json["state"]
         self.is_white = (self.white.name or "").lower() == username.lower()
         self.my_color = "white" if self.is_white else "black"
         self.opponent_color = "black" if self.is_white else "white"
@@ -137,6 +234,8 @@ class Game:
         self.abort_time = Timer(abort_time)
         self.terminate_time = Timer((self.clock_initial + self.clock_increment) / 1000 + abort_time + 60)
         self.disconnect_time = Timer(0)
+        self.clock = ClockModel(self)
+        self.clock.update()
 
     def url(self) -> str:
         return f"{self.short_url()}/{self.my_color}"
@@ -153,10 +252,32 @@ class Game:
     def time_control(self) -> str:
         return f"{int(self.clock_initial/1000)}+{int(self.clock_increment/1000)}"
 
+    @property
+    def state(self) -> Dict[str, Any]:
+        return self._state
+
+    @state.setter
+    def state(self, state: Dict[str, Any]) -> None:
+        # Cache the ply count and last move so that callers don't have to scan the move string on every update.
+        self._state = state
+        moves: str = state.get("moves", "")
+        self.ply_count = moves.count(" ") + 1 if moves else 0
+        self.last_move = moves[moves.rfind(" ") + 1:]
+
+    def update_state(self, state: Dict[str, Any]) -> None:
+        """Take a state from the game stream and timestamp it if it is new."""
+        # The initial state was timestamped when the game stream opened, before the engine started.
+        if state is not self._state:
+            self.state = state
+            self.clock.update()
+
+    def snapshot(self) -> GameSnapshot:
+        return GameSnapshot(self.ply_count, self.last_move, self.state.get("wtime", 0), self.state.get("btime", 0),
+                            self.state.get("status", ""))
+
     def is_abortable(self) -> bool:
-        # Moves are separated by spaces. A game is abortable when less
-        # than two moves (one from each player) have been played.
-        return " " not in self.state["moves"]
+        # A game is abortable when less than two moves (one from each player) have been played.
+        return self.ply_count < 2
 
     def ping(self, abort_in: int, terminate_in: int, disconnect_in: int) -> None:
         if self.is_abortable():
@@ -207,6 +328,8 @@ class Game:
 
 
 class Player:
+    __slots__ = ("name", "title", "is_bot", "rating", "provisional", "aiLevel")
+
     def __init__(self, json: Dict[str, Any]) -> None:
         self.name: str = json.get("name", "")
         self.title = json.get("title")
@@ -224,3 +347,48 @@ class Player:
 
     def __repr__(self) -> str:
         return self.__str__()
+
+
+class BoardTracker:
+    """Keeps a board in sync with the moves of a game by only pushing the moves added since the last update."""
+    def __init__(self, game: Game) -> None:
+        self.game = game
+        self.board = self.new_board()
+        self.moves = ""
+
+    def new_board(self) -> chess.Board:
+        if self.game.variant_name.lower() == "chess960":
+            return chess.Board(self.game.initial_fen, chess960=True)
+        elif self.game.variant_name == "From Position":
+            return chess.Board(self.game.initial_fen)
+        else:
+            VariantBoard = find_variant(self.game.variant_name)
+            return VariantBoard()
+
+    def update(self) -> chess.Board:
+        moves: str = self.game.state["moves"]
+        applied_length = len(self.moves)
+        if not moves.startswith(self.moves) or moves[applied_length:applied_length + 1] not in ["", " "]:
+            # The game diverged from the board (e.g. a takeback), so start again from the initial position.
+            return self.rebuild()
+
+        for move in moves[applied_length:].split():
+            try:
+                self.board.push_uci(move)
+            except ValueError:
+                # The board may be out of sync, so replay the whole game.
+                return self.rebuild()
+
+        self.moves = moves
+        return self.board
+
+    def rebuild(self) -> chess.Board:
+        self.board = self.new_board()
+        self.moves = self.game.state["moves"]
+        for move in self.moves.split():
+            try:
+                self.board.push_uci(move)
+            except ValueError:
+                logger.exception(f"Ignoring illegal move {move} on board {self.board.fen()}")
+
+        return self.board
@@ -0,0 +1,201 @@
+"""Keep the replies of the online move sources on disk, so that positions that come up again are answered locally."""
+from __future__ import annotations
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import chess
+import config
+import lichess
+from typing import Any, Dict, Optional, Tuple
+JSON_REPLY_TYPE = Dict[str, Any]
+
+# The parameters of the online sources that hold the position.
+FEN_PARAMETERS = ["fen", "board"]
+
+LICHESS_TABLEBASE_URL = "http://tablebase.lichess.ovh"
+
+# The order of the categories of tablebase.lichess.ovh for the side that moves into the position: best first.
+LICHESS_CATEGORIES = ["loss", "unknown", "maybe-loss", "blessed-loss", "draw", "cursed-win", "maybe-win", "win"]
+
+# The kinds of replies, which are kept for different times.
+ANSWER = "answer"
+UNKNOWN = "unknown"
+ERROR = "error"
+# The statuses of chessdb.cn that answer the request, and those that say that it doesn't know the position.
+CHESSDB_ANSWERS = ["ok", "checkmate", "stalemate"]
+CHESSDB_UNKNOWN = ["unknown", "nobestmove"]
+
+logger = logging.getLogger(__name__)
+
+
+class OnlineCache:
+    """
+    A cache of the replies of chessdb.cn, the lichess cloud analysis and the online tablebases.
+
+    The replies are kept in an SQLite database, which the processes of all games can share. Replies expire after `ttl`
+    hours. Replies that only say that the source doesn't know the position (e.g. chessdb.cn's "unknown") expire after
+    `negative_ttl` hours, since the source may know it soon, and error replies aren't kept at all. The least recently
+    used replies are removed when there are more than `max_entries`.
+    """
+    def __init__(self, cache_cfg: config.Configuration) -> None:
+        self.enabled = bool(cache_cfg.enabled)
+        self.path: str = cache_cfg.path or ""
+        self.ttl: float = (cache_cfg.ttl or 0) * 3600
+        self.negative_ttl: float = (cache_cfg.negative_ttl or 0) * 3600
+        self.max_entries: int = cache_cfg.max_entries or 0
+        self.settings = (self.enabled, self.path, self.ttl, self.negative_ttl, self.max_entries)
+        self.lock = threading.Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+        self.pid = 0
+        self.stores = 0
+
+    def connect(self) -> sqlite3.Connection:
+        # An SQLite connection can't be used by the processes forked from the process that opened it.
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(replies)")]
+            if columns and "expires" not in columns:
+                # The replies of an older cache don't say when they expire.
+                self.connection.execute("DROP TABLE replies")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS replies "
+                                    "(key TEXT PRIMARY KEY, reply TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS replies_by_use ON replies (used)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def load(self, key: str) -> Optional[JSON_REPLY_TYPE]:
+        """The reply stored under `key`, or None if there is none or it has expired."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self.lock:
+                connection = self.connect()
+                row = connection.execute("SELECT reply FROM replies WHERE key = ? AND expires > ?", (key, now)).fetchone()
+                if row is None:
+                    return None
+                connection.execute("UPDATE replies SET used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            logger.exception(f"Could not read from the online cache {self.path}.")
+            return None
+        reply: JSON_REPLY_TYPE = json.loads(row[0])
+        return reply
+
+    def time_to_live(self, reply: JSON_REPLY_TYPE) -> float:
+        """The time (in seconds) to keep a reply. 0 for error replies, which are never kept."""
+        reply_type = classify_reply(reply)
+        return self.ttl if reply_type == ANSWER else self.negative_ttl if reply_type == UNKNOWN else 0
+
+    def store(self, key: str, reply: JSON_REPLY_TYPE) -> None:
+        time_to_live = self.time_to_live(reply)
+        if not self.enabled or time_to_live <= 0:
+            return
+        now = time.time()
+        try:
+            with self.lock:
+                connection = self.connect()
+                connection.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)",
+                                   (key, json.dumps(reply), now + time_to_live, now))
+                self.stores += 1
+                if self.stores >= 100:
+                    self.stores = 0
+                    self.evict(connection, now)
+        except sqlite3.Error:
+            logger.exception(f"Could not write to the online cache {self.path}.")
+
+    def evict(self, connection: sqlite3.Connection, now: float) -> None:
+        connection.execute("DELETE FROM replies WHERE expires <= ?", (now,))
+        connection.execute("DELETE FROM replies WHERE key IN "
+                           "(SELECT key FROM replies ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                self.connection.close()
+            self.connection = None
+
+
+cache = OnlineCache(config.Configuration({"enabled": False}))
+
+
+def classify_reply(reply: JSON_REPLY_TYPE) -> str:
+    """
+    Whether a reply answers the request (`ANSWER`), says that the source doesn't know the position (`UNKNOWN`), or
+    is an error (`ERROR`), e.g. because of a rate limit or a bad request.
+    """
+    if "status" in reply:
+        status = reply["status"]
+        return ANSWER if status in CHESSDB_ANSWERS else UNKNOWN if status in CHESSDB_UNKNOWN else ERROR
+    if "error" in reply:
+        return UNKNOWN if reply["error"] == "Not found" else ERROR
+    return UNKNOWN if reply.get("category") == "unknown" else ANSWER
+
+
+def use_cache(cache_cfg: config.Configuration) -> None:
+    """Cache the online replies with these settings. The cache is kept if the settings haven't changed."""
+    global cache
+    new_cache = OnlineCache(cache_cfg)
+    if new_cache.settings != cache.settings:
+        cache.close()
+        cache = new_cache
+
+
+def cache_key(path: str, params: Dict[str, Any], keep_halfmove_clock: bool) -> str:
+    """
+    The key of a request. The move counters are removed from the FEN, so that the same position reached at another
+    move number is found. The tablebases keep the halfmove clock, because it decides whether a win is a win.
+    """
+    def normalize(name: str, value: Any) -> Tuple[str, str]:
+        if name in FEN_PARAMETERS:
+            fields = str(value).split()
+            value = " ".join(fields[:-1] if keep_halfmove_clock else fields[:-2])
+        return name, str(value)
+
+    normalized_params = sorted(normalize(name, value) for name, value in params.items())
+    return path + "?" + "&".join(f"{name}={value}" for name, value in normalized_params)
+
+
+def online_book_get(li: lichess.Lichess, path: str, params: Dict[str, Any], max_time: Optional[float] = None,
+                    keep_halfmove_clock: bool = False) -> JSON_REPLY_TYPE:
+    """Get the reply of an online source from the cache, or from the source if it isn't cached."""
+    key = cache_key(path, params, keep_halfmove_clock)
+    reply = cache.load(key)
+    if reply is None:
+        reply = li.online_book_get(path, params=params, max_time=max_time)
+        if isinstance(reply, dict):
+            cache.store(key, reply)
+    return reply
+
+
+def lichess_move_order(move_result: JSON_REPLY_TYPE) -> Tuple[int, int, int]:
+    """The order of the moves in a reply of tablebase.lichess.ovh: win fast and lose slowly."""
+    return (LICHESS_CATEGORIES.index(move_result["category"]), -(move_result.get("dtz") or 0),
+            -(move_result.get("dtm") or 0))
+
+
+def tablebase_get(li: lichess.Lichess, path: str, params: Dict[str, Any], max_time: Optional[float],
+                  cache_only: bool) -> Optional[JSON_REPLY_TYPE]:
+    """The reply of an online tablebase. None if `cache_only` and the position isn't cached."""
+    if cache_only:
+        return cache.load(cache_key(path, params, True))
+    return online_book_get(li, path, params, max_time, keep_halfmove_clock=True)
+
+
+def lichess_tablebase_get(li: lichess.Lichess, board: chess.Board, variant: str, max_time: Optional[float],
+                          cache_only: bool, url: str = LICHESS_TABLEBASE_URL) -> Optional[JSON_REPLY_TYPE]:
+    """
+    The reply of tablebase.lichess.ovh (or of a server at `url` that answers like it) for the position. None if
+    `cache_only` and the position isn't cached.
+    """
+    return tablebase_get(li, f"{url}/{variant}", {"fen": board.fen()}, max_time, cache_only)
+
+
+def chessdb_tablebase_get(li: lichess.Lichess, board: chess.Board, action: str, max_time: Optional[float],
+                          cache_only: bool) -> Optional[JSON_REPLY_TYPE]:
+    """The reply of chessdb.cn to a `querypv` or `queryall` for an endgame. None if `cache_only` and it isn't cached."""
+    params = {"action": action, "board": board.fen(), "json": 1}
+    return tablebase_get(li, "https://www.chessdb.cn/cdb.php", params, max_time, cache_only)
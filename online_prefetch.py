@@ -0,0 +1,169 @@
+"""Look up the online moves for the likeliest replies of the opponent while the opponent thinks."""
+from __future__ import annotations
+import logging
+import threading
+import time
+import chess
+import chess.engine
+import chess.polyglot
+import config
+import engine_wrapper
+import lichess
+import model
+import online_cache
+from requests.exceptions import HTTPError
+from types import TracebackType
+from typing import List, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+
+class OnlinePrefetcher:
+    """
+    Fills the online cache with the replies of the online sources for the positions that the opponent is likely to
+    leave us, so that our next online lookup is answered locally.
+
+    The likely replies of the opponent are the move that the engine expects (its ponder move), the moves in the
+    polyglot books and the moves of the lichess cloud analysis. The positions are looked up one at a time, at least
+    `min_interval` seconds apart. After a "429 Too Many Requests" reply, nothing is looked up for a minute.
+    """
+    def __init__(self, li: lichess.Lichess, engine_cfg: config.Configuration, game: model.Game,
+                 move_sources: engine_wrapper.MoveSources) -> None:
+        online_moves_cfg = engine_cfg.online_moves
+        prefetch_cfg = online_moves_cfg.prefetch
+        self.enabled = bool(prefetch_cfg.enabled and online_moves_cfg.cache.enabled)
+        self.max_positions: int = prefetch_cfg.max_positions
+        self.min_interval: float = prefetch_cfg.min_interval
+        self.li = li
+        self.online_moves_cfg = online_moves_cfg
+        self.polyglot_cfg = engine_cfg.polyglot
+        self.game = game
+        self.move_sources = move_sources
+
+        self.lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.finished = False
+        self.request: Optional[Tuple[chess.Board, chess.engine.PlayResult]] = None
+        self.generation = 0
+        self.next_lookup_time = 0.
+        self.paused_until = 0.
+        self.thread = threading.Thread(target=self.run, name=f"prefetch-{game.id}", daemon=True)
+
+    def __enter__(self) -> OnlinePrefetcher:
+        if self.enabled:
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.finished = True
+        self.cancel()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def prefetch(self, board: chess.Board, move: chess.engine.PlayResult) -> None:
+        """Start looking up the positions after the likely replies to the move that we have just played."""
+        if not self.enabled or move.move is None or move.resigned:
+            return
+        position = board.copy()
+        position.push(move.move)
+        with self.lock:
+            self.generation += 1
+            self.request = (position, move)
+        self.wake_up.set()
+
+    def cancel(self) -> None:
+        """Stop looking up positions, because the opponent has moved."""
+        with self.lock:
+            self.generation += 1
+            self.request = None
+        self.wake_up.set()
+
+    def is_current(self, generation: int) -> bool:
+        return generation == self.generation and not self.finished
+
+    def run(self) -> None:
+        while not self.finished:
+            self.wake_up.wait()
+            self.wake_up.clear()
+            with self.lock:
+                request, self.request = self.request, None
+                generation = self.generation
+            if request is None:
+                continue
+
+            board, move = request
+            try:
+                self.prefetch_replies(board, move, generation)
+            except HTTPError as error:
+                if error.response is not None and error.response.status_code == 429:
+                    logger.info(f"Prefetching pauses for a minute after being rate limited for game {self.game.id}.")
+                    self.paused_until = time.monotonic() + 60
+                else:
+                    logger.debug(f"Prefetching the online moves failed for game {self.game.id}: {error!r}")
+            except Exception as error:
+                logger.debug(f"Prefetching the online moves failed for game {self.game.id}: {error!r}")
+
+    def wait_for_turn(self, generation: int) -> bool:
+        """Wait until the next lookup is allowed. False if the lookups for this position are no longer needed."""
+        delay = max(self.next_lookup_time, self.paused_until) - time.monotonic()
+        if delay > 0:
+            self.wake_up.wait(delay)
+        self.next_lookup_time = time.monotonic() + self.min_interval
+        return self.is_current(generation)
+
+    def prefetch_replies(self, board: chess.Board, move: chess.engine.PlayResult, generation: int) -> None:
+        replies = self.likely_replies(board, move, generation)
+        for reply in replies:
+            if not self.wait_for_turn(generation):
+                return
+            board.push(reply)
+            use_opening_books = self.move_sources.use_opening_books()
+            engine_wrapper.prefetch_online_replies(self.li, board, self.online_moves_cfg, use_opening_books)
+            board.pop()
+        if replies:
+            replies_san = [board.san(reply) for reply in replies]
+            logger.debug(f"Prefetched the online moves after {replies_san} for game {self.game.id}")
+
+    def likely_replies(self, board: chess.Board, move: chess.engine.PlayResult, generation: int) -> List[chess.Move]:
+        replies: List[chess.Move] = []
+
+        def add_reply(reply: chess.Move) -> None:
+            if reply in board.legal_moves and reply not in replies:
+                replies.append(reply)
+
+        pv = move.info.get("pv", [])
+        ponder_move = move.ponder or (pv[1] if len(pv) > 1 else None)
+        if ponder_move is not None:
+            add_reply(ponder_move)
+
+        for book_move in self.book_moves(board):
+            add_reply(book_move)
+
+        lichess_cloud_cfg = self.online_moves_cfg.lichess_cloud_analysis
+        if lichess_cloud_cfg.enabled and len(replies) < self.max_positions and self.wait_for_turn(generation):
+            # The same parameters as the lookups of the moves, so that this reply is in the cache for them too.
+            params = engine_wrapper.lichess_cloud_params(board, lichess_cloud_cfg.move_quality)
+            data = online_cache.online_book_get(self.li, engine_wrapper.LICHESS_CLOUD_URL, params)
+            for cloud_pv in data.get("pvs", []):
+                add_reply(chess.Move.from_uci(cloud_pv["moves"].split()[0]))
+
+        return replies[:self.max_positions]
+
+    def book_moves(self, board: chess.Board) -> List[chess.Move]:
+        """The moves of the polyglot books for the position, with the most played moves first."""
+        max_game_length = self.polyglot_cfg.max_depth * 2 - 1
+        if not self.polyglot_cfg.enabled or len(board.move_stack) > max_game_length:
+            return []
+
+        variant = "standard" if board.uci_variant == "chess" else str(board.uci_variant)
+        config.change_value_to_list(self.polyglot_cfg.config, "book", key=variant)
+        moves: List[chess.Move] = []
+        for book in self.polyglot_cfg.book.lookup(variant) or []:
+            try:
+                with chess.polyglot.open_reader(book) as reader:
+                    entries = sorted(reader.find_all(board), key=lambda entry: entry.weight, reverse=True)
+                    moves.extend(entry.move for entry in entries)
+            except OSError:
+                continue
+        return moves
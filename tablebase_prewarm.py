@@ -0,0 +1,182 @@
+"""Keep the most probed tablebase files in the page cache, so that the first probe of an endgame doesn't wait for the disk."""
+from __future__ import annotations
+import ctypes
+import logging
+import mmap
+import os
+import threading
+import time
+import chess.syzygy
+import config
+import tablebases
+from collections import Counter
+from typing import List, Optional, Tuple
+
+SYZYGY_SUFFIXES = [".rtbw", ".rtbz", ".atbw", ".atbz", ".gtbw", ".gtbz", ".stbw", ".stbz"]
+GAVIOTA_SUFFIX = ".gtb.cp4"
+
+logger = logging.getLogger(__name__)
+
+
+def load_libc() -> Optional[ctypes.CDLL]:
+    """The C library, if it has mincore, which tells which pages of a mapping are in memory. Windows has neither."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (OSError, TypeError):
+        return None
+    return libc if hasattr(libc, "mincore") else None
+
+
+libc = load_libc()
+
+
+class TablebasePrewarmer:
+    """
+    Reads the tablebase files of the endgames that are probed most often into the page cache, at the start and then
+    every `interval` minutes, as long as they fit into `ram_budget` megabytes.
+
+    The endgames are ranked by the probe log that the games write (see `tablebases.ProbeCache`). Endgames that
+    haven't been probed come after them, with the smaller endgames first. The files are read ahead by the operating
+    system (`madvise` or `posix_fadvise`), so the bot doesn't wait for them. The log reports how much of the chosen
+    files was still in the page cache before they were read again.
+    """
+    def __init__(self, lichess_bot_tbs: config.Configuration) -> None:
+        prewarm_cfg = lichess_bot_tbs.prewarm
+        self.enabled = bool(prewarm_cfg.enabled and (lichess_bot_tbs.syzygy.enabled or lichess_bot_tbs.gaviota.enabled))
+        self.ram_budget: int = (prewarm_cfg.ram_budget or 0) * 1024 * 1024
+        self.interval: float = (prewarm_cfg.interval or 0) * 60
+        self.probe_log: str = prewarm_cfg.probe_log
+        self.lichess_bot_tbs = lichess_bot_tbs
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="tablebase-prewarm", daemon=True)
+
+    def start(self) -> None:
+        if self.enabled:
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.prewarm()
+            except Exception:
+                logger.exception("Could not read the tablebase files into the page cache.")
+            if self.interval <= 0:
+                return
+            self.stopped.wait(self.interval)
+
+    def prewarm(self) -> None:
+        start_time = time.monotonic()
+        files = self.choose_files(self.tablebase_files(), load_probe_log(self.probe_log))
+        chosen_size = resident_size = 0
+        for path, size in files:
+            if self.stopped.is_set():
+                return
+            resident = resident_bytes(path, size)
+            resident_size += size if resident is None else resident
+            chosen_size += size
+            if resident is None or resident < size:
+                read_ahead(path, size)
+        megabyte = 1024 * 1024
+        residency = f"{resident_size * 100 // chosen_size}%" if chosen_size and libc is not None else "unknown"
+        logger.info(f"Reading {len(files)} tablebase files ({chosen_size // megabyte} MB of a budget of "
+                    f"{self.ram_budget // megabyte} MB) into the page cache. {residency} of them were already there. "
+                    f"This took {time.monotonic() - start_time:.1f} seconds.")
+
+    def tablebase_files(self) -> List[Tuple[str, str, int]]:
+        """The endgame, path and size of every tablebase file with at most `max_pieces` pieces."""
+        files = []
+        for section, suffixes in [("syzygy", SYZYGY_SUFFIXES), ("gaviota", [GAVIOTA_SUFFIX])]:
+            tablebase_cfg = self.lichess_bot_tbs.lookup(section)
+            if not tablebase_cfg.enabled:
+                continue
+            for directory in tablebase_cfg.paths or []:
+                for entry in os.scandir(directory):
+                    suffix = next((suffix for suffix in suffixes if entry.name.endswith(suffix)), None)
+                    if suffix is None or not entry.is_file():
+                        continue
+                    endgame = file_endgame(entry.name[:-len(suffix)], section == "gaviota")
+                    if endgame is not None and len(endgame) - 1 <= tablebase_cfg.max_pieces:
+                        files.append((endgame, entry.path, entry.stat().st_size))
+        return files
+
+    def choose_files(self, files: List[Tuple[str, str, int]], endgame_probes: Counter[str]) -> List[Tuple[str, int]]:
+        """The files that fit into the budget, with the most probed endgames first and the wdl tables before the dtz."""
+        def priority(file: Tuple[str, str, int]) -> Tuple[int, int, bool, int]:
+            endgame, path, size = file
+            return -endgame_probes[endgame], len(endgame), path.endswith("z"), size
+
+        chosen = []
+        budget_left = self.ram_budget
+        for _, path, size in sorted(files, key=priority):
+            if size <= budget_left:
+                chosen.append((path, size))
+                budget_left -= size
+        return chosen
+
+
+def file_endgame(name: str, is_gaviota: bool) -> Optional[str]:
+    """The endgame of a tablebase file in the form of the syzygy tables (e.g. "KRPvKR"), or None for other files."""
+    if is_gaviota:
+        # The gaviota files are named like "krpkr".
+        name = name.upper()
+        second_king = name.find("K", 1)
+        if second_king < 0:
+            return None
+        name = f"{name[:second_king]}v{name[second_king:]}"
+    if not chess.syzygy.is_tablename(name, normalized=False):
+        return None
+    return chess.syzygy.normalize_tablename(name)
+
+
+def load_probe_log(path: str) -> Counter[str]:
+    """The probes of each endgame in the probe log. The log is written again with one line per endgame."""
+    endgame_probes: Counter[str] = Counter()
+    with tablebases.locked_probe_log(path):
+        try:
+            with open(path) as probe_log:
+                for line in probe_log:
+                    endgame, _, count = line.partition(" ")
+                    if chess.syzygy.is_tablename(endgame, normalized=False) and count.strip().isdigit():
+                        endgame_probes[chess.syzygy.normalize_tablename(endgame)] += int(count)
+        except FileNotFoundError:
+            return endgame_probes
+        with open(path, "w") as probe_log:
+            probe_log.write("".join(f"{endgame} {count}\n" for endgame, count in endgame_probes.most_common()))
+    return endgame_probes
+
+
+def read_ahead(path: str, size: int) -> None:
+    """Ask the operating system to read the file into the page cache in the background."""
+    if size == 0:
+        return
+    with open(path, "rb") as file:
+        if hasattr(mmap, "MADV_WILLNEED"):
+            with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as mapping:
+                mapping.madvise(mmap.MADV_WILLNEED)
+        elif hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(file.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+        else:
+            while file.read(1024 * 1024):
+                pass
+
+
+def resident_bytes(path: str, size: int) -> Optional[int]:
+    """How much of the file is in the page cache, or None if it can't be told."""
+    if libc is None:
+        return None
+    if size == 0:
+        return 0
+    page_size = mmap.PAGESIZE
+    pages = (size + page_size - 1) // page_size
+    in_memory = (ctypes.c_ubyte * pages)()
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), size, access=mmap.ACCESS_COPY) as mapping:
+        start = ctypes.c_char.from_buffer(mapping)
+        result = libc.mincore(ctypes.c_void_p(ctypes.addressof(start)), ctypes.c_size_t(size), in_memory)
+        # The mapping can only be closed once nothing points into it.
+        del start
+    if result != 0:
+        return None
+    return sum(page & 1 for page in in_memory) * page_size
@@ -0,0 +1,236 @@
+"""
+Serve the local syzygy and gaviota tablebases in the format of tablebase.lichess.ovh.
+
+Usage: python tablebase_server.py --config config.yml --port 9000
+
+The tables are the ones in `lichess_bot_tbs` of the config. Positions that are only in the gaviota tables are answered
+from their dtm, without a dtz. Bots on the same host use the server by setting
+`online_egtb: url` to "http://127.0.0.1:9000" with `source: "lichess"`, so they share one process with the tables
+open, one probe cache and one page cache, and don't need the network.
+"""
+from __future__ import annotations
+import argparse
+import concurrent.futures
+import contextlib
+import http.server
+import json
+import logging
+import socket
+import threading
+import chess
+import chess.gaviota
+import chess.syzygy
+import chess.variant
+import config
+import online_cache
+import tablebases
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+from typing import Any, Dict, Optional, Tuple, Type, Union
+JSON_REPLY_TYPE = Dict[str, Any]
+
+# The variants that tablebase.lichess.ovh serves.
+VARIANTS: Dict[str, Type[chess.Board]] = {"standard": chess.Board,
+                                          "atomic": chess.variant.AtomicBoard,
+                                          "antichess": chess.variant.AntichessBoard}
+# The most replies that the server keeps.
+MAX_CACHED_REPLIES = 100000
+
+logger = logging.getLogger(__name__)
+
+
+class TablebaseServer(http.server.HTTPServer):
+    """An HTTP server that serves the connections from a pool of `threads` threads."""
+    def __init__(self, address: Tuple[str, int], lichess_bot_tbs: config.Configuration, threads: int) -> None:
+        super().__init__(address, TablebaseRequestHandler)
+        self.syzygy_cfg = lichess_bot_tbs.syzygy
+        self.gaviota_cfg = lichess_bot_tbs.gaviota
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="tablebase")
+        # Each variant has its own syzygy tables, so the tables of one variant are kept open for each.
+        self.tablebases = {variant: tablebases.Tablebases() for variant in VARIANTS}
+        self.replies_lock = threading.Lock()
+        self.replies: OrderedDict[str, bytes] = OrderedDict()
+
+    def process_request(self, request: Union[socket.socket, Tuple[bytes, socket.socket]],
+                        client_address: Tuple[str, int]) -> None:
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request: Union[socket.socket, Tuple[bytes, socket.socket]],
+                               client_address: Tuple[str, int]) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+    def reply(self, variant: str, fen: str) -> Tuple[int, bytes]:
+        """The status and the JSON reply for the position, which is cached without the fullmove number."""
+        if variant not in VARIANTS:
+            return 404, error_reply(f"The variant {variant} is not served.")
+        try:
+            board = VARIANTS[variant](fen)
+        except ValueError:
+            return 400, error_reply(f"{fen} is not a valid FEN.")
+        if not board.is_valid():
+            return 400, error_reply(f"{fen} is not a legal position.")
+
+        key = f"{variant} {board.fen().rsplit(' ', 1)[0]}"
+        with self.replies_lock:
+            reply = self.replies.get(key)
+            if reply is not None:
+                self.replies.move_to_end(key)
+                return 200, reply
+
+        try:
+            reply = json.dumps(self.probe(variant, board)).encode()
+        except KeyError:
+            return 404, error_reply(f"{fen} is not in the tablebases.")
+        with self.replies_lock:
+            self.replies[key] = reply
+            if len(self.replies) > MAX_CACHED_REPLIES:
+                self.replies.popitem(last=False)
+        return 200, reply
+
+    def probe(self, variant: str, board: chess.Board) -> JSON_REPLY_TYPE:
+        """The results of the position and of the positions after every move. A KeyError if a table is missing."""
+        pieces = chess.popcount(board.occupied)
+        use_syzygy = bool(self.syzygy_cfg.enabled and pieces <= self.syzygy_cfg.max_pieces)
+        use_gaviota = bool(self.gaviota_cfg.enabled and variant == "standard" and pieces <= self.gaviota_cfg.max_pieces
+                           and not board.castling_rights)
+        if not use_syzygy and not use_gaviota:
+            raise KeyError(board.fen())
+        variant_tablebases = self.tablebases[variant]
+        with contextlib.ExitStack() as stack:
+            syzygy = stack.enter_context(variant_tablebases.syzygy(self.syzygy_cfg, VARIANTS[variant])) if use_syzygy else None
+            gaviota = stack.enter_context(variant_tablebases.gaviota(self.gaviota_cfg)) if use_gaviota else None
+            return self.probe_moves(board, syzygy, gaviota)
+
+    def probe_moves(self, board: chess.Board, syzygy: Optional[chess.syzygy.Tablebase],
+                    gaviota: Optional[tablebases.GAVIOTA_TABLEBASE]) -> JSON_REPLY_TYPE:
+        moves = []
+        for move in board.legal_moves:
+            move_result = {"uci": move.uci(), "san": board.san(move), "zeroing": board.is_zeroing(move)}
+            board.push(move)
+            try:
+                move_result.update(self.position_result(board, syzygy, gaviota))
+            finally:
+                board.pop()
+            moves.append(move_result)
+        moves.sort(key=online_cache.lichess_move_order)
+        return {**self.position_result(board, syzygy, gaviota), "moves": moves}
+
+    def position_result(self, board: chess.Board, syzygy: Optional[chess.syzygy.Tablebase],
+                        gaviota: Optional[tablebases.GAVIOTA_TABLEBASE]) -> JSON_REPLY_TYPE:
+        """The result for the side to move, in the words of tablebase.lichess.ovh."""
+        result = {"checkmate": board.is_checkmate(),
+                  "stalemate": board.is_stalemate(),
+                  "variant_win": board.is_variant_win(),
+                  "variant_loss": board.is_variant_loss(),
+                  "insufficient_material": board.is_insufficient_material()}
+        if result["checkmate"] or result["variant_loss"]:
+            return {**result, "category": "loss", "dtz": 0, "dtm": 0}
+        if result["variant_win"]:
+            return {**result, "category": "win", "dtz": 0, "dtm": 0}
+        if result["stalemate"] or result["insufficient_material"]:
+            return {**result, "category": "draw", "dtz": 0, "dtm": 0}
+
+        dtm = self.dtm(board, gaviota)
+        if syzygy is None:
+            if dtm is None:
+                raise KeyError(board.fen())
+            return {**result, "category": dtm_category(dtm, board.halfmove_clock), "dtz": None, "dtm": dtm}
+
+        wdl = tablebases.probe_cache.probe("syzygy wdl", board, syzygy.probe_wdl)
+        dtz = tablebases.probe_cache.probe("syzygy dtz", board, syzygy.probe_dtz)
+        return {**result, "category": category(wdl, dtz, board.halfmove_clock), "dtz": dtz, "dtm": dtm}
+
+    def dtm(self, board: chess.Board, gaviota: Optional[tablebases.GAVIOTA_TABLEBASE]) -> Optional[int]:
+        if gaviota is None:
+            return None
+        try:
+            return tablebases.probe_cache.probe("gaviota dtm", board, gaviota.probe_dtm)
+        except KeyError:
+            return None
+
+
+class TablebaseRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answers `GET /<variant>?fen=<fen>` like tablebase.lichess.ovh."""
+    server: TablebaseServer
+    # The bots keep their connections open between the requests. A connection holds a thread of the pool, so it is
+    # closed after some seconds without a request.
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        fen = parse_qs(url.query).get("fen", [""])[0].replace("_", " ")
+        status, reply = self.server.reply(url.path.strip("/"), fen)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+def category(wdl: int, dtz: int, halfmove_clock: int) -> str:
+    """
+    The category of tablebase.lichess.ovh. A win or loss that the 50-move rule turns into a draw is cursed or blessed.
+    The dtz of the syzygy tables can be off by one, so a win or loss that is decided within a ply of the 50-move rule
+    may be either.
+    """
+    if wdl == 0:
+        return "draw"
+    plies = abs(dtz) + halfmove_clock
+    if abs(wdl) == 2 and plies < 99:
+        return "win" if wdl > 0 else "loss"
+    if abs(wdl) == 2 and plies <= 101:
+        return "maybe-win" if wdl > 0 else "maybe-loss"
+    return "cursed-win" if wdl > 0 else "blessed-loss"
+
+
+def dtm_category(dtm: int, halfmove_clock: int) -> str:
+    """
+    The category of a position that is only in the gaviota tables. The dtm is at least the dtz, so a win or loss
+    within the 50-move rule by the dtm is one by the dtz too. Otherwise, the dtz isn't known.
+    """
+    if dtm == 0:
+        return "draw"
+    if abs(dtm) + halfmove_clock <= 100:
+        return "win" if dtm > 0 else "loss"
+    return "maybe-win" if dtm > 0 else "maybe-loss"
+
+
+def error_reply(message: str) -> bytes:
+    return json.dumps({"error": message}).encode()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve the local tablebases in the format of tablebase.lichess.ovh.")
+    parser.add_argument("--config", "-c", default="./config.yml", help="The config whose `lichess_bot_tbs` are served.")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=9000, help="The port to listen on.")
+    parser.add_argument("--threads", type=int, default=8, help="The number of connections that are served at once.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    CONFIG = config.load_config(args.config)
+    server = TablebaseServer((args.host, args.port), CONFIG.engine.lichess_bot_tbs, args.threads)
+    logger.info(f"Serving the tablebases at http://{args.host}:{args.port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Keep the local tablebases open between moves and games, so that a move only costs the probes."""
+from __future__ import annotations
+import contextlib
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+import chess
+import chess.gaviota
+import chess.polyglot
+import chess.syzygy
+import config
+from collections import Counter, OrderedDict
+from multiprocessing import shared_memory
+from typing import Callable, Generator, Optional, Tuple, Type, Union
+GAVIOTA_TABLEBASE = Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase]
+SYZYGY_KEY = Tuple[Tuple[str, ...], int, Type[chess.Board]]
+GAVIOTA_KEY = Tuple[Tuple[str, ...], int]
+
+# The most probe results that a process keeps.
+MAX_CACHED_PROBES = 200000
+# A slot of the shared probe cache: the key of the position, the result and a check of both.
+SLOT = struct.Struct("<QiI")
+CHECK_SALT = 0x9E3779B9
+# A lock of the probe log that is older than this (in seconds) was left behind by a process that ended while holding it.
+STALE_LOCK_TIME = 10
+
+logger = logging.getLogger(__name__)
+
+
+class Tablebases:
+    """
+    The syzygy and gaviota tablebases of a process. They are opened by the first probe and stay open, and they are
+    opened again when the configured paths change. At most `max_open_files` table files of each kind are kept open:
+    the least recently used syzygy tables and the first opened gaviota tables are closed.
+
+    The games of the thread game runner share the tablebases, so each is probed by one game at a time. A process
+    forked from this one opens its own tablebases, because it can't share the file positions of the gaviota tables.
+    """
+    def __init__(self) -> None:
+        self.syzygy_lock = threading.Lock()
+        self.syzygy_tablebase: Optional[chess.syzygy.Tablebase] = None
+        self.syzygy_key: Optional[SYZYGY_KEY] = None
+        self.syzygy_pid = 0
+        self.gaviota_lock = threading.Lock()
+        self.gaviota_tablebase: Optional[GAVIOTA_TABLEBASE] = None
+        self.gaviota_key: Optional[GAVIOTA_KEY] = None
+        self.gaviota_pid = 0
+        self.max_gaviota_files = 0
+
+    @contextlib.contextmanager
+    def syzygy(self, syzygy_cfg: config.Configuration,
+               VariantBoard: Type[chess.Board]) -> Generator[chess.syzygy.Tablebase, None, None]:
+        """The syzygy tablebase in `syzygy_cfg.paths` for the variant of `VariantBoard`, to probe inside the `with`."""
+        key = (tuple(syzygy_cfg.paths), syzygy_cfg.max_open_files, VariantBoard)
+        with self.syzygy_lock:
+            if self.syzygy_tablebase is None or self.syzygy_key != key or self.syzygy_pid != os.getpid():
+                self.close_syzygy()
+                tablebase = chess.syzygy.Tablebase(max_fds=syzygy_cfg.max_open_files, VariantBoard=VariantBoard)
+                tables = sum(tablebase.add_directory(path) for path in syzygy_cfg.paths)
+                logger.info(f"Opened {tables} syzygy tables in {syzygy_cfg.paths}.")
+                self.syzygy_tablebase, self.syzygy_key, self.syzygy_pid = tablebase, key, os.getpid()
+            yield self.syzygy_tablebase
+
+    @contextlib.contextmanager
+    def gaviota(self, gaviota_cfg: config.Configuration) -> Generator[GAVIOTA_TABLEBASE, None, None]:
+        """The gaviota tablebase in `gaviota_cfg.paths`, to probe inside the `with`."""
+        key = (tuple(gaviota_cfg.paths), gaviota_cfg.max_open_files)
+        with self.gaviota_lock:
+            if self.gaviota_tablebase is None or self.gaviota_key != key or self.gaviota_pid != os.getpid():
+                self.close_gaviota()
+                tablebase = chess.gaviota.open_tablebase(gaviota_cfg.paths[0])
+                for path in gaviota_cfg.paths[1:]:
+                    tablebase.add_directory(path)
+                logger.info(f"Opened the gaviota tables in {gaviota_cfg.paths}.")
+                self.gaviota_tablebase, self.gaviota_key, self.gaviota_pid = tablebase, key, os.getpid()
+                self.max_gaviota_files = gaviota_cfg.max_open_files
+            try:
+                yield self.gaviota_tablebase
+            finally:
+                self.limit_gaviota_files()
+
+    def limit_gaviota_files(self) -> None:
+        # The native library manages its own files. The Python tablebase keeps every table that it has read open,
+        # in the order in which they were opened. The table files that were opened first are closed.
+        tablebase = self.gaviota_tablebase
+        if isinstance(tablebase, chess.gaviota.PythonTablebase):
+            while len(tablebase.streams) > self.max_gaviota_files:
+                egkey = next(iter(tablebase.streams))
+                tablebase.streams.pop(egkey).close()
+
+    def close_syzygy(self) -> None:
+        # The files of a tablebase that was opened by the parent process are closed by the parent.
+        if self.syzygy_tablebase is not None and self.syzygy_pid == os.getpid():
+            self.syzygy_tablebase.close()
+        self.syzygy_tablebase = None
+        self.syzygy_key = None
+
+    def close_gaviota(self) -> None:
+        if self.gaviota_tablebase is not None and self.gaviota_pid == os.getpid():
+            self.gaviota_tablebase.close()
+        self.gaviota_tablebase = None
+        self.gaviota_key = None
+
+
+tablebases = Tablebases()
+
+
+def probe_key(table: str, board: chess.Board) -> int:
+    """The Zobrist hash of the position, mixed with the kind of probe (e.g. "syzygy dtz") and the variant."""
+    salt = zlib.crc32(f"{table} {board.uci_variant}".encode()) * 0x9E3779B97F4A7C15
+    return (chess.polyglot.zobrist_hash(board) ^ salt) & 0xFFFFFFFFFFFFFFFF
+
+
+class SharedProbeCache:
+    """
+    A hash table of probe results in shared memory, which the processes of all games read and write, so a position
+    that one game has probed isn't probed again by another.
+
+    Each slot holds one result, which is replaced by the next result whose key falls into the same slot. There are no
+    locks. Every slot holds a check of its key and result, so a slot that is read while another process writes it
+    fails the check and counts as a miss.
+    """
+    def __init__(self, memory: shared_memory.SharedMemory, owner: bool) -> None:
+        self.memory = memory
+        self.buffer = memory.buf if memory.buf is not None else memoryview(bytearray())
+        self.owner = owner
+        self.slots = memory.size // SLOT.size
+
+    @classmethod
+    def create(cls, size: int) -> SharedProbeCache:
+        """A new cache of `size` megabytes."""
+        return cls(shared_memory.SharedMemory(create=True, size=max(1, size) * 1024 * 1024), True)
+
+    @classmethod
+    def attach(cls, name: str) -> SharedProbeCache:
+        return cls(shared_memory.SharedMemory(name=name), False)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @staticmethod
+    def check(key: int, result: int) -> int:
+        return (key ^ (key >> 32) ^ result ^ CHECK_SALT) & 0xFFFFFFFF
+
+    def load(self, key: int) -> Optional[int]:
+        slot_key, result, check = SLOT.unpack_from(self.buffer, key % self.slots * SLOT.size)
+        return result if slot_key == key and check == self.check(key, result) else None
+
+    def store(self, key: int, result: int) -> None:
+        SLOT.pack_into(self.buffer, key % self.slots * SLOT.size, key, result, self.check(key, result))
+
+    def close(self) -> None:
+        del self.buffer
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+shared_cache: Optional[SharedProbeCache] = None
+
+
+def create_shared_cache(shared_cache_cfg: config.Configuration) -> Optional[str]:
+    """Create the shared probe cache in the main process. Its name is given to the games with `use_shared_cache`."""
+    global shared_cache
+    if not shared_cache_cfg.enabled:
+        return None
+    shared_cache = SharedProbeCache.create(shared_cache_cfg.size)
+    logger.info(f"Created a shared tablebase cache of {shared_cache_cfg.size} MB.")
+    return shared_cache.name
+
+
+def use_shared_cache(name: Optional[str]) -> None:
+    """Use the shared probe cache `name` in this process. A forked process already has it."""
+    global shared_cache
+    if name is not None and (shared_cache is None or shared_cache.name != name):
+        shared_cache = SharedProbeCache.attach(name)
+
+
+def close_shared_cache() -> None:
+    global shared_cache
+    if shared_cache is not None:
+        shared_cache.close()
+        shared_cache = None
+
+
+class ProbeCache:
+    """
+    The results of tablebase probes, keyed by the Zobrist hash of the position. They are kept across moves and games,
+    so the positions after the moves of the last position aren't probed again. When there are more than `max_entries`
+    results, the least recently used ones are dropped. Results that aren't kept here are looked up in the shared
+    cache of all games, if there is one.
+
+    With `count_endgames`, the probes that go to the tablebase files are counted by endgame (e.g. "KRPvKR"), so that
+    the tables that are probed most often can be kept in the page cache (see `tablebase_prewarm`).
+    """
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.results: OrderedDict[int, int] = OrderedDict()
+        self.count_endgames = False
+        self.endgame_probes: Counter[str] = Counter()
+
+    def probe(self, table: str, board: chess.Board, probe: Callable[[chess.Board], int]) -> int:
+        """The result of `probe(board)`, where `table` names the kind of probe (e.g. "syzygy dtz")."""
+        key = probe_key(table, board)
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                return result
+
+        shared = shared_cache
+        result = shared.load(key) if shared is not None else None
+        endgame: Optional[str] = None
+        if result is None:
+            result = probe(board)
+            if shared is not None:
+                shared.store(key, result)
+            if self.count_endgames:
+                endgame = chess.syzygy.normalize_tablename(chess.syzygy.calc_key(board))
+        with self.lock:
+            if endgame is not None:
+                self.endgame_probes[endgame] += 1
+            self.results[key] = result
+            if len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+        return result
+
+    def save_endgame_probes(self, path: str) -> None:
+        """Add the probes counted since the last save to the probe log, one endgame and count per line."""
+        with self.lock:
+            endgame_probes, self.endgame_probes = self.endgame_probes, Counter()
+        if endgame_probes:
+            with locked_probe_log(path), open(path, "a") as probe_log:
+                probe_log.write("".join(f"{endgame} {count}\n" for endgame, count in endgame_probes.items()))
+
+
+probe_cache = ProbeCache(MAX_CACHED_PROBES)
+
+
+@contextlib.contextmanager
+def locked_probe_log(path: str) -> Generator[None, None, None]:
+    """
+    Keep the processes of the other games and the prewarmer away from the probe log at `path`. The lock is a file next
+    to the log, which works on every platform.
+    """
+    lock_path = f"{path}.lock"
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_TIME:
+                    os.remove(lock_path)
+            except OSError:
+                # The lock was released in the meantime.
+                pass
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
@@ -0,0 +1,105 @@
+"""
+Time the scoring of the root moves with the local tablebases.
+
+Usage: python test_bot/benchmark_tablebases.py --syzygy engines/syzygy --gaviota engines/gaviota
+
+It compares scoring every move on a copy of the board (the way lichess-bot used to do it) with the scorer of
+`get_syzygy` and `get_gaviota`, once with an empty probe cache and once with the results of the last run cached.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+import chess
+import chess.gaviota
+import chess.syzygy
+from typing import Callable, List, Union, cast
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config  # noqa: E402
+import engine_wrapper  # noqa: E402
+import model  # noqa: E402
+import tablebases  # noqa: E402
+
+# Endgames with 5 to 7 pieces.
+POSITIONS = ["8/8/8/4k3/8/8/2KQ4/7r w - - 0 1",
+             "8/2k5/8/8/3P4/2K5/8/3R3r w - - 0 1",
+             "8/8/2k5/8/1P1K4/8/8/1r5B w - - 0 1",
+             "6k1/5p2/8/8/8/8/5PP1/3R2K1 w - - 0 1",
+             "8/5pk1/8/8/8/8/5PPK/3R3r w - - 0 1",
+             "8/8/1p3k2/8/3P4/2K5/5N2/3b4 w - - 0 1",
+             "2r5/8/8/3k4/8/3K4/2Q5/5B2 b - - 0 1"]
+
+
+class Game:
+    id = "benchmark"
+
+
+GAME = cast(model.Game, Game())
+
+
+def copy_per_move(board: chess.Board, scorer: Callable[[chess.Board], int]) -> None:
+    for move in board.legal_moves:
+        board_copy = board.copy()
+        board_copy.push(move)
+        scorer(board_copy)
+
+
+def benchmark(name: str, boards: List[chess.Board], score: Callable[[chess.Board], object], rounds: int) -> None:
+    if not boards:
+        print(f"{name:<40} no position is in the tables")
+        return
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for board in boards:
+            score(board)
+    milliseconds = (time.perf_counter() - start) * 1000 / (rounds * len(boards))
+    print(f"{name:<40} {milliseconds:8.3f} ms per position")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--syzygy", help="A directory with syzygy tables.")
+    parser.add_argument("--gaviota", help="A directory with gaviota tables.")
+    parser.add_argument("--rounds", type=int, default=20, help="How often each position is scored.")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    boards = [chess.Board(fen) for fen in POSITIONS]
+
+    if args.syzygy:
+        syzygy_cfg = config.Configuration({"enabled": True, "paths": [args.syzygy], "max_pieces": 7,
+                                           "move_quality": "best", "max_open_files": 128})
+        with chess.syzygy.open_tablebase(args.syzygy) as syzygy:
+            boards_in_tables = [board for board in boards if syzygy.get_dtz(board) is not None]
+            benchmark("syzygy: copy per move, dtz of every move", boards_in_tables,
+                      lambda board: copy_per_move(board, syzygy.probe_dtz), args.rounds)
+
+        def get_syzygy(board: chess.Board) -> None:
+            tablebases.probe_cache.results.clear()
+            engine_wrapper.get_syzygy(board, GAME, syzygy_cfg)
+
+        benchmark("syzygy: root scorer", boards_in_tables, get_syzygy, args.rounds)
+        benchmark("syzygy: root scorer, cached", boards_in_tables,
+                  lambda board: engine_wrapper.get_syzygy(board, GAME, syzygy_cfg), args.rounds)
+
+    if args.gaviota:
+        gaviota_cfg = config.Configuration({"enabled": True, "paths": [args.gaviota], "max_pieces": 5, "move_quality": "best",
+                                            "min_dtm_to_consider_as_wdl_1": 120, "max_open_files": 32})
+        gaviota: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase]
+        with chess.gaviota.open_tablebase(args.gaviota) as gaviota:
+            boards_in_tables = [board for board in boards if gaviota.get_dtm(board) is not None]
+            benchmark("gaviota: copy per move, dtm of every move", boards_in_tables,
+                      lambda board: copy_per_move(board, gaviota.probe_dtm), args.rounds)
+
+        def get_gaviota(board: chess.Board) -> None:
+            tablebases.probe_cache.results.clear()
+            engine_wrapper.get_gaviota(board, GAME, gaviota_cfg)
+
+        benchmark("gaviota: root scorer", boards_in_tables, get_gaviota, args.rounds)
+        benchmark("gaviota: root scorer, cached", boards_in_tables,
+                  lambda board: engine_wrapper.get_gaviota(board, GAME, gaviota_cfg), args.rounds)
+
+
+if __name__ == "__main__":
+    main()
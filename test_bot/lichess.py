@@ -2,6 +2,7 @@ import time
 import chess
 import chess.engine
 import json
+import requests
 from typing import Dict, Union, List, Optional, Generator
 
 
@@ -175,7 +176,8 @@ class Lichess:
     def cancel(self, challenge_id: str) -> None:
         return
 
-    def online_book_get(self, path: str, params: Optional[Dict[str, str]] = None) -> None:
+    def online_book_get(self, path: str, params: Optional[Dict[str, str]] = None, max_time: Optional[float] = None,
+                        session: Optional[requests.Session] = None) -> None:
         return
 
     def is_online(self, user_id: str) -> bool:
@@ -0,0 +1,125 @@
+"""
+A UCI engine for the tests, which plays the first legal move and can be told to hang or to be slow to stop.
+
+Usage: python scripted_engine.py [--hang-file PATH] [--think-time SECONDS] [--stop-delay SECONDS] [--log PATH]
+
+The hang file holds the number of searches that hang: the engine stops reading its input, like a deadlocked engine,
+and only a kill ends it. The count is shared by all the engines that are started with the same file, so an engine
+that replaces a hung one knows how many hangs are left. A search takes `--think-time` seconds, or lasts until `stop`
+if it is an infinite search or pondering, and the engine takes `--stop-delay` seconds to answer `stop`. The commands
+that the engine gets are written to the log.
+"""
+import argparse
+import sys
+import threading
+import time
+import chess
+from typing import List, Optional, TextIO
+
+
+class ScriptedEngine:
+    def __init__(self, hang_file: Optional[str], think_time: float, stop_delay: float, log: Optional[TextIO]) -> None:
+        self.hang_file = hang_file
+        self.think_time = think_time
+        self.stop_delay = stop_delay
+        self.log = log
+        self.board = chess.Board()
+        self.stopped = threading.Event()
+        self.search: Optional[threading.Thread] = None
+        self.output_lock = threading.Lock()
+
+    def send(self, line: str) -> None:
+        with self.output_lock:
+            print(line, flush=True)
+
+    def hangs(self) -> bool:
+        if not self.hang_file:
+            return False
+        with open(self.hang_file) as file:
+            hangs = int(file.read() or 0)
+        if hangs <= 0:
+            return False
+        with open(self.hang_file, "w") as file:
+            file.write(str(hangs - 1))
+        return True
+
+    def set_position(self, arguments: List[str]) -> None:
+        moves_index = arguments.index("moves") if "moves" in arguments else len(arguments)
+        if arguments[0] == "startpos":
+            self.board = chess.Board()
+        else:
+            self.board = chess.Board(" ".join(arguments[1:moves_index]))
+        for move in arguments[moves_index + 1:]:
+            self.board.push_uci(move)
+
+    def go(self, arguments: List[str]) -> None:
+        self.stopped.clear()
+        searches_until_stop = "infinite" in arguments or "ponder" in arguments or not arguments
+        self.search = threading.Thread(target=self.think, args=(self.board.copy(), searches_until_stop))
+        self.search.start()
+
+    def think(self, board: chess.Board, searches_until_stop: bool) -> None:
+        if searches_until_stop:
+            self.stopped.wait()
+        elif self.stopped.wait(self.think_time):
+            time.sleep(self.stop_delay)
+        moves = sorted(board.legal_moves, key=lambda move: move.uci())
+        if not moves:
+            self.send("bestmove (none)")
+            return
+        board.push(moves[0])
+        replies = sorted(board.legal_moves, key=lambda move: move.uci())
+        self.send(f"info depth 1 score cp 0 pv {moves[0].uci()}")
+        self.send(f"bestmove {moves[0].uci()}" + (f" ponder {replies[0].uci()}" if replies else ""))
+
+    def wait_for_search(self) -> None:
+        if self.search is not None:
+            self.search.join()
+            self.search = None
+
+    def run(self, commands: TextIO) -> None:
+        for line in commands:
+            if self.log is not None:
+                self.log.write(line)
+                self.log.flush()
+            if line.split() and not self.handle(*line.split()):
+                break
+
+    def handle(self, command: str, *arguments: str) -> bool:
+        """Carry out the command. Returns False when the engine should quit."""
+        if command == "uci":
+            self.send("id name Scripted Engine")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "position":
+            self.wait_for_search()
+            self.set_position(list(arguments))
+        elif command == "go":
+            self.wait_for_search()
+            if self.hangs():
+                while True:
+                    time.sleep(60)
+            self.go(list(arguments))
+        elif command in ["stop", "ponderhit"]:
+            self.stopped.set()
+        return command != "quit"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="A UCI engine for the tests.")
+    parser.add_argument("--hang-file", help="A file with the number of searches that hang.")
+    parser.add_argument("--think-time", type=float, default=0.05, help="The time of a search in seconds.")
+    parser.add_argument("--stop-delay", type=float, default=0, help="The time to answer a stop in seconds.")
+    parser.add_argument("--log", help="A file for the commands of the engine.")
+    args = parser.parse_args()
+    log = open(args.log, "a") if args.log else None
+    try:
+        ScriptedEngine(args.hang_file, args.think_time, args.stop_delay, log).run(sys.stdin)
+    finally:
+        if log is not None:
+            log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import pytest
+import chess
+import chess.engine
+import config
+import engine_wrapper
+import lichess
+import model
+from typing import Any, Dict, List, Optional, Tuple, cast
+from test_bot.test_model import new_game
+from test_bot.test_move_sources import fake_source, move_sources
+
+SCRIPTED_ENGINE = os.path.join(os.path.dirname(__file__), "scripted_engine.py")
+
+
+def scripted_engine(*args: str) -> engine_wrapper.UCIEngine:
+    draw_or_resign = config.Configuration({"offer_draw_enabled": False, "offer_draw_moves": 10, "offer_draw_score": 0,
+                                           "offer_draw_pieces": 10, "resign_enabled": False, "resign_moves": 3,
+                                           "resign_score": -1000})
+    return engine_wrapper.UCIEngine([sys.executable, SCRIPTED_ENGINE, *args], {}, None, draw_or_resign)
+
+
+def engine_config(**sections: Dict[str, Any]) -> config.Configuration:
+    engine_cfg: Dict[str, Any] = {"dir": ".",
+                                  "recovery": {"enabled": True, "ping_timeout": 1, "standby_engine": None},
+                                  "early_stop": {"enabled": False},
+                                  "emergency_mode": {"enabled": False},
+                                  "fast_path": {"enabled": False},
+                                  "speculative_search": {"enabled": False}}
+    engine_cfg.update(sections)
+    return config.Configuration(engine_cfg)
+
+
+def hang_file(tmp_path: Any, hangs: int) -> str:
+    path = str(tmp_path / "hangs")
+    with open(path, "w") as file:
+        file.write(str(hangs))
+    return path
+
+
+def search(engine: engine_wrapper.EngineWrapper, game: model.Game, engine_cfg: config.Configuration,
+           can_ponder: bool = False) -> chess.engine.PlayResult:
+    board = model.BoardTracker(game).update()
+    return engine.search_for_move(board, game, chess.engine.PlayResult(None, None), in_emergency=False, draw_offered=False,
+                                  start_time=time.perf_counter_ns(), move_overhead=0, can_ponder=can_ponder,
+                                  is_correspondence=False, correspondence_move_time=1000, engine_cfg=engine_cfg)
+
+
+def test_recovery_after_hang(tmp_path: Any) -> None:
+    engine = scripted_engine("--hang-file", hang_file(tmp_path, 1))
+    try:
+        start_time = time.monotonic()
+        best_move = search(engine, new_game("e2e4 e7e5", wtime=3000), engine_config())
+        assert best_move.move is not None
+        assert time.monotonic() - start_time < 5
+    finally:
+        engine.engine.close()
+
+
+def test_watchdog_after_restart(tmp_path: Any) -> None:
+    """The engine that replaces a hung engine is watched too."""
+    engine = scripted_engine("--hang-file", hang_file(tmp_path, 2))
+    try:
+        start_time = time.monotonic()
+        with pytest.raises(chess.engine.EngineTerminatedError):
+            search(engine, new_game("e2e4 e7e5", wtime=3000), engine_config())
+        assert time.monotonic() - start_time < 6
+    finally:
+        engine.engine.close()
+
+
+def test_watchdog_of_fixed_time_search(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """python-chess doesn't stop an engine that hangs in a search with a time limit, so the watchdog does."""
+    monkeypatch.setattr(engine_wrapper, "FIRST_MOVE_TIME", 100)
+    monkeypatch.setattr(engine_wrapper, "SEARCH_DEADLINE_MARGIN", 0.5)
+    engine = scripted_engine("--hang-file", hang_file(tmp_path, 1))
+    try:
+        start_time = time.monotonic()
+        best_move = search(engine, new_game(""), engine_config())
+        assert best_move.move is not None
+        assert time.monotonic() - start_time < 5
+    finally:
+        engine.engine.close()
+
+
+class FakeLichess:
+    def __init__(self) -> None:
+        self.moves: List[Tuple[float, chess.Move]] = []
+
+    def make_move(self, game_id: str, move: chess.engine.PlayResult) -> None:
+        assert move.move is not None
+        self.moves.append((time.monotonic(), move.move))
+
+
+def play_move(engine: engine_wrapper.EngineWrapper, game: model.Game, li: FakeLichess, book_move: Optional[str],
+              monkeypatch: pytest.MonkeyPatch) -> chess.engine.PlayResult:
+    sources = move_sources(monkeypatch, [fake_source("polyglot", book_move)])
+    engine_cfg = engine_config(recovery={"enabled": False}, speculative_search={"enabled": True})
+    board = model.BoardTracker(game).update()
+    return engine.play_move(board, game, cast(lichess.Lichess, li), time.perf_counter_ns(), 0, can_ponder=True,
+                            is_correspondence=False, correspondence_move_time=1000, engine_cfg=engine_cfg,
+                            move_sources=sources)
+
+
+def test_speculative_search_is_stopped_after_the_book_move_is_sent(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    log = str(tmp_path / "engine.log")
+    engine = scripted_engine("--think-time", "5", "--stop-delay", "1", "--log", log)
+    li = FakeLichess()
+    try:
+        start_time = time.monotonic()
+        best_move = play_move(engine, new_game("e2e4 e7e5"), li, "g1f3", monkeypatch)
+        assert best_move.move == chess.Move.from_uci("g1f3")
+        [(sent_time, sent_move)] = li.moves
+        assert sent_move == chess.Move.from_uci("g1f3")
+        # The move is sent without waiting for the engine to stop.
+        assert sent_time - start_time < 0.5
+        assert time.monotonic() - start_time >= 1
+        engine.ping()
+    finally:
+        engine.engine.close()
+
+    with open(log) as engine_log:
+        commands = engine_log.read()
+    assert "go wtime" in commands
+    # The cancelled search doesn't start pondering.
+    assert "go ponder" not in commands
+
+
+def test_speculative_search_move(monkeypatch: pytest.MonkeyPatch) -> None:
+    engine = scripted_engine()
+    li = FakeLichess()
+    try:
+        best_move = play_move(engine, new_game("e2e4 e7e5"), li, None, monkeypatch)
+        # The scripted engine plays the first legal move in UCI order.
+        assert best_move.move == chess.Move.from_uci("a2a3")
+        assert [move for _, move in li.moves] == [chess.Move.from_uci("a2a3")]
+    finally:
+        engine.engine.close()
+
+
+def test_ponder_analysis_is_stopped(tmp_path: Any) -> None:
+    log = str(tmp_path / "engine.log")
+    engine = scripted_engine("--log", log)
+    try:
+        game = new_game("e2e4 e7e5")
+        engine.ponder_board = model.BoardTracker(game).update().copy()
+        engine.resume_ponder()
+        assert engine.ponder_analysis is not None
+        engine.suspend_ponder()
+        assert engine.ponder_analysis is None
+
+        # The analysis is stopped before the next search too.
+        engine.resume_ponder()
+        assert search(engine, game, engine_config()).move is not None
+        assert engine.ponder_analysis is None
+    finally:
+        engine.engine.close()
+
+    with open(log) as engine_log:
+        commands = engine_log.read().splitlines()
+    assert commands.count("go infinite") == 2
+    assert commands.count("stop") >= 2
@@ -0,0 +1,93 @@
+import chess
+import model
+from typing import Dict, Any
+
+
+def game_json(moves: str, wtime: int = 60000, variant: str = "Standard", initial_fen: str = "startpos") -> Dict[str, Any]:
+    return {"id": "zzzzzzzz",
+            "speed": "blitz",
+            "clock": {"initial": 60000, "increment": 2000},
+            "perf": {"name": "Blitz"},
+            "variant": {"key": "standard", "name": variant},
+            "rated": False,
+            "createdAt": 1600000000000,
+            "white": {"name": "bo", "id": "bo", "rating": 3000, "title": "BOT"},
+            "black": {"name": "b", "id": "b", "rating": 3000, "title": "BOT"},
+            "initialFen": initial_fen,
+            "state": {"type": "gameState", "moves": moves, "wtime": wtime, "btime": 60000, "winc": 2000, "binc": 2000,
+                      "status": "started"}}
+
+
+def new_game(moves: str, **kwargs: Any) -> model.Game:
+    return model.Game(game_json(moves, **kwargs), "bo", "https://lichess.org/", 20)
+
+
+def replay(moves: str) -> chess.Board:
+    board = chess.Board()
+    for move in moves.split():
+        board.push_uci(move)
+    return board
+
+
+def test_board_tracker_pushes_new_moves() -> None:
+    game = new_game("e2e4 e7e5")
+    tracker = model.BoardTracker(game)
+    board = tracker.update()
+    assert board == replay("e2e4 e7e5")
+
+    game.update_state(dict(game.state, moves="e2e4 e7e5 g1f3 b8c6"))
+    assert tracker.update() is board
+    assert board == replay("e2e4 e7e5 g1f3 b8c6")
+    assert len(board.move_stack) == 4
+
+
+def test_board_tracker_rebuilds_after_takeback() -> None:
+    game = new_game("e2e4 e7e5 g1f3")
+    tracker = model.BoardTracker(game)
+    tracker.update()
+
+    game.update_state(dict(game.state, moves="e2e4 e7e5"))
+    assert tracker.update() == replay("e2e4 e7e5")
+
+    # A takeback followed by another move.
+    game.update_state(dict(game.state, moves="e2e4 e7e6"))
+    assert tracker.update() == replay("e2e4 e7e6")
+
+
+def test_board_tracker_from_position() -> None:
+    fen = "8/8/8/4k3/8/8/2KQ4/8 w - - 0 1"
+    game = new_game("d2d4", variant="From Position", initial_fen=fen)
+    board = model.BoardTracker(game).update()
+    expected = chess.Board(fen)
+    expected.push_uci("d2d4")
+    assert board == expected
+
+
+def test_clock_model_measures_lag() -> None:
+    game = new_game("e2e4 e7e5", wtime=60000)
+    assert game.clock.remaining_time() <= 60000
+    game.clock.move_sent()
+
+    # Our clock came back 300 ms lower than expected (plus the increment).
+    game.update_state(dict(game.state, moves="e2e4 e7e5 g1f3 b8c6", wtime=61700))
+    assert game.clock.lag_samples == 1
+    assert 250 <= game.clock.lag <= 300
+
+
+def test_clock_model_move_overhead() -> None:
+    clock = new_game("e2e4 e7e5").clock
+    assert clock.move_overhead(1000) == 1000
+
+    clock.add_lag_sample(300)
+    assert clock.move_overhead(1000) == 300 + 4 * 150
+
+    clock.add_lag_sample(100000)
+    assert clock.move_overhead(1000) == 1000 * model.MAX_OVERHEAD_FACTOR
+
+
+def test_clock_model_move_overhead_minimum() -> None:
+    clock = new_game("e2e4 e7e5").clock
+    # Lichess can give back more than the lag, which doesn't count as a negative lag.
+    clock.add_lag_sample(-500)
+    assert clock.lag == 0
+    assert clock.move_overhead(1000) == 1000 * model.MIN_OVERHEAD_FACTOR
@@ -0,0 +1,115 @@
+import pytest
+import time
+import chess
+import chess.engine
+import config
+import engine_wrapper
+import lichess
+import model
+from typing import Any, Dict, List, Optional, Type, cast
+from test_bot.test_model import new_game
+
+# The move sources don't use Lichess here.
+li = cast(lichess.Lichess, None)
+asked: List[str] = []
+
+
+def fake_source(source_name: str, move: Optional[str], delay: float = 0, exact: bool = False,
+                opening_book: bool = False, online: bool = False) -> Type[engine_wrapper.MoveSource]:
+    class FakeSource(engine_wrapper.MoveSource):
+        name = source_name
+        is_online = online
+        is_exact = exact
+        is_opening_book = opening_book
+
+        def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game,
+                     max_time: Optional[float]) -> engine_wrapper.MOVE:
+            asked.append(self.name)
+            time.sleep(delay)
+            return chess.engine.PlayResult(chess.Move.from_uci(move) if move else None, None)
+
+    return FakeSource
+
+
+def move_sources(monkeypatch: pytest.MonkeyPatch, sources: List[Type[engine_wrapper.MoveSource]],
+                 concurrent_lookups: bool = False, max_time: float = 1) -> engine_wrapper.MoveSources:
+    asked.clear()
+    for source in sources:
+        monkeypatch.setitem(engine_wrapper.MOVE_SOURCES, source.name, source)
+    engine_cfg: Dict[str, Any] = {"move_sources": {"order": [source.name for source in sources], "budgets": {}},
+                                  "online_moves": {"max_out_of_book_moves": 2,
+                                                   "concurrent_lookups": {"enabled": concurrent_lookups,
+                                                                          "time_share": 0.5,
+                                                                          "max_time": max_time}}}
+    return engine_wrapper.MoveSources(config.Configuration(engine_cfg), new_game("e2e4 e7e5"))
+
+
+def uci(best_move: engine_wrapper.MOVE) -> Optional[str]:
+    assert isinstance(best_move, chess.engine.PlayResult)
+    return best_move.move.uci() if best_move.move else None
+
+
+def test_order(monkeypatch: pytest.MonkeyPatch) -> None:
+    sources = move_sources(monkeypatch, [fake_source("polyglot", None),
+                                         fake_source("syzygy", "g1f3", exact=True),
+                                         fake_source("chessdb_book", "b1c3", online=True, opening_book=True)])
+    assert uci(sources.get_move(li, chess.Board())) == "g1f3"
+    assert asked == ["polyglot", "syzygy"]
+    assert sources.stats["polyglot"].lookups == 1
+    assert sources.stats["polyglot"].hits == 0
+    assert sources.stats["syzygy"].hits == 1
+    assert sources.stats["chessdb_book"].lookups == 0
+
+
+def test_out_of_book(monkeypatch: pytest.MonkeyPatch) -> None:
+    sources = move_sources(monkeypatch, [fake_source("chessdb_book", None, online=True, opening_book=True),
+                                         fake_source("syzygy", None, exact=True)])
+    for _ in range(3):
+        assert uci(sources.get_move(li, chess.Board())) is None
+    # The book isn't asked after `max_out_of_book_moves` positions without a move.
+    assert asked == ["chessdb_book", "syzygy", "chessdb_book", "syzygy", "syzygy"]
+
+
+def test_failing_source(monkeypatch: pytest.MonkeyPatch) -> None:
+    class FailingSource(engine_wrapper.MoveSource):
+        name = "polyglot"
+
+        def get_move(self, li: lichess.Lichess, board: chess.Board, game: model.Game,
+                     max_time: Optional[float]) -> engine_wrapper.MOVE:
+            raise ValueError("The book is broken.")
+
+    sources = move_sources(monkeypatch, [FailingSource, fake_source("syzygy", "g1f3", exact=True)])
+    assert uci(sources.get_move(li, chess.Board())) == "g1f3"
+    assert sources.stats["polyglot"].errors == 1
+
+
+def test_race_takes_first_move(monkeypatch: pytest.MonkeyPatch) -> None:
+    sources = move_sources(monkeypatch, [fake_source("chessdb_book", "b1c3", delay=0.5, online=True, opening_book=True),
+                                         fake_source("lichess_cloud_analysis", "g1f3", online=True, opening_book=True)],
+                           concurrent_lookups=True)
+    start_time = time.monotonic()
+    assert uci(sources.get_move(li, chess.Board())) == "g1f3"
+    assert time.monotonic() - start_time < 0.5
+
+
+def test_race_prefers_exact_source(monkeypatch: pytest.MonkeyPatch) -> None:
+    sources = move_sources(monkeypatch, [fake_source("online_egtb", "e1e2", delay=0.2, online=True, exact=True),
+                                         fake_source("chessdb_book", "b1c3", online=True, opening_book=True)],
+                           concurrent_lookups=True)
+    assert uci(sources.get_move(li, chess.Board())) == "e1e2"
+
+    # The book's move is taken once the tablebase has no move.
+    sources = move_sources(monkeypatch, [fake_source("online_egtb", None, delay=0.2, online=True, exact=True),
+                                         fake_source("chessdb_book", "b1c3", online=True, opening_book=True)],
+                           concurrent_lookups=True)
+    assert uci(sources.get_move(li, chess.Board())) == "b1c3"
+
+
+def test_race_ignores_late_sources(monkeypatch: pytest.MonkeyPatch) -> None:
+    sources = move_sources(monkeypatch, [fake_source("chessdb_book", "b1c3", delay=0.5, online=True, opening_book=True),
+                                         fake_source("polyglot", None)],
+                           concurrent_lookups=True, max_time=0.1)
+    start_time = time.monotonic()
+    assert uci(sources.get_move(li, chess.Board())) is None
+    assert time.monotonic() - start_time < 0.5
+    assert asked == ["chessdb_book", "polyglot"]
@@ -0,0 +1,94 @@
+import pytest
+import time
+import config
+import online_cache
+from typing import Any
+
+
+def new_cache(tmp_path: Any, **settings: Any) -> online_cache.OnlineCache:
+    cache_cfg = {"enabled": True, "path": str(tmp_path / "online_cache.sqlite"), "ttl": 1, "negative_ttl": 0.5,
+                 "max_entries": 100}
+    cache_cfg.update(settings)
+    return online_cache.OnlineCache(config.Configuration(cache_cfg))
+
+
+def test_cache_key() -> None:
+    fen = "8/8/8/4k3/8/8/2KQ4/8 w - - 12 57"
+    other_move_number = "8/8/8/4k3/8/8/2KQ4/8 w - - 12 80"
+    other_halfmove_clock = "8/8/8/4k3/8/8/2KQ4/8 w - - 30 57"
+
+    key = online_cache.cache_key("https://www.chessdb.cn/cdb.php", {"action": "querypv", "board": fen}, False)
+    assert key == "https://www.chessdb.cn/cdb.php?action=querypv&board=8/8/8/4k3/8/8/2KQ4/8 w - -"
+    assert key == online_cache.cache_key("https://www.chessdb.cn/cdb.php",
+                                         {"board": other_halfmove_clock, "action": "querypv"}, False)
+
+    tablebase_key = online_cache.cache_key("http://tablebase.lichess.ovh/standard", {"fen": fen}, True)
+    assert tablebase_key == "http://tablebase.lichess.ovh/standard?fen=8/8/8/4k3/8/8/2KQ4/8 w - - 12"
+    assert tablebase_key == online_cache.cache_key("http://tablebase.lichess.ovh/standard", {"fen": other_move_number}, True)
+    assert tablebase_key != online_cache.cache_key("http://tablebase.lichess.ovh/standard",
+                                                   {"fen": other_halfmove_clock}, True)
+
+
+def test_classify_reply() -> None:
+    assert online_cache.classify_reply({"status": "ok", "pv": ["e2e4"]}) == online_cache.ANSWER
+    assert online_cache.classify_reply({"status": "unknown"}) == online_cache.UNKNOWN
+    assert online_cache.classify_reply({"status": "rate limited"}) == online_cache.ERROR
+    assert online_cache.classify_reply({"error": "Not found"}) == online_cache.UNKNOWN
+    assert online_cache.classify_reply({"error": "Too many requests"}) == online_cache.ERROR
+    assert online_cache.classify_reply({"category": "unknown", "moves": []}) == online_cache.UNKNOWN
+    assert online_cache.classify_reply({"category": "win", "moves": []}) == online_cache.ANSWER
+
+
+def test_ttl(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = new_cache(tmp_path)
+    cache.store("answer", {"status": "ok", "pv": ["e2e4"]})
+    cache.store("unknown", {"status": "unknown"})
+    cache.store("error", {"status": "rate limited"})
+    assert cache.load("answer") == {"status": "ok", "pv": ["e2e4"]}
+    assert cache.load("unknown") == {"status": "unknown"}
+    assert cache.load("error") is None
+
+    # After the negative ttl (half an hour), only the answer is left.
+    monkeypatch.setattr(time, "time", lambda: now + 0.75 * 3600)
+    assert cache.load("answer") is not None
+    assert cache.load("unknown") is None
+
+    # After the ttl (an hour), the answer has expired too.
+    monkeypatch.setattr(time, "time", lambda: now + 1.25 * 3600)
+    assert cache.load("answer") is None
+    cache.close()
+
+
+def test_disabled_cache(tmp_path: Any) -> None:
+    cache = new_cache(tmp_path, enabled=False)
+    cache.store("answer", {"status": "ok", "pv": ["e2e4"]})
+    assert cache.load("answer") is None
+
+
+def test_eviction(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = new_cache(tmp_path, max_entries=2)
+    for second, key in enumerate(["first", "second", "third"]):
+        monkeypatch.setattr(time, "time", lambda second=second: now + second)
+        cache.store(key, {"status": "ok", "pv": ["e2e4"]})
+
+    # Reading the first reply makes the second the least recently used.
+    monkeypatch.setattr(time, "time", lambda: now + 3)
+    assert cache.load("first") is not None
+    cache.evict(cache.connect(), now + 3)
+    assert cache.load("first") is not None
+    assert cache.load("second") is None
+    assert cache.load("third") is not None
+    cache.close()
+
+
+def test_eviction_every_hundred_stores(tmp_path: Any) -> None:
+    cache = new_cache(tmp_path, max_entries=10)
+    for index in range(100):
+        cache.store(f"key {index}", {"status": "ok", "pv": ["e2e4"]})
+    entries = cache.connect().execute("SELECT COUNT(*) FROM replies").fetchone()[0]
+    assert entries == 10
+    cache.close()
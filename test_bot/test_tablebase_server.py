@@ -0,0 +1,24 @@
+import tablebase_server
+
+
+def test_category() -> None:
+    assert tablebase_server.category(0, 0, 0) == "draw"
+    assert tablebase_server.category(2, 10, 0) == "win"
+    assert tablebase_server.category(2, 98, 0) == "win"
+    # The 50 move rule may come before the win, depending on the rounding of the dtz.
+    assert tablebase_server.category(2, 99, 0) == "maybe-win"
+    assert tablebase_server.category(2, 100, 1) == "maybe-win"
+    assert tablebase_server.category(2, 101, 0) == "maybe-win"
+    assert tablebase_server.category(2, 102, 0) == "cursed-win"
+    assert tablebase_server.category(2, 60, 50) == "cursed-win"
+    assert tablebase_server.category(1, 120, 0) == "cursed-win"
+    assert tablebase_server.category(-2, -10, 0) == "loss"
+    assert tablebase_server.category(-2, -100, 0) == "maybe-loss"
+    assert tablebase_server.category(-1, -3, 0) == "blessed-loss"
+
+
+def test_dtm_category() -> None:
+    assert tablebase_server.dtm_category(0, 0) == "draw"
+    assert tablebase_server.dtm_category(30, 10) == "win"
+    assert tablebase_server.dtm_category(-30, 10) == "loss"
+    assert tablebase_server.dtm_category(-95, 10) == "maybe-loss"
@@ -0,0 +1,89 @@
+import struct
+import chess
+import chess.polyglot
+import chess.syzygy
+import engine_wrapper
+import tablebases
+from typing import Dict, cast
+
+
+def test_shared_probe_cache() -> None:
+    shared_cache = tablebases.SharedProbeCache.create(1)
+    other_process_cache = tablebases.SharedProbeCache.attach(shared_cache.name)
+    try:
+        key = tablebases.probe_key("syzygy dtz", chess.Board())
+        assert shared_cache.load(key) is None
+        shared_cache.store(key, -37)
+        assert shared_cache.load(key) == -37
+        assert other_process_cache.load(key) == -37
+
+        # Another key in the same slot replaces the result.
+        other_key = key + shared_cache.slots
+        other_process_cache.store(other_key, 5)
+        assert shared_cache.load(key) is None
+        assert shared_cache.load(other_key) == 5
+    finally:
+        other_process_cache.close()
+        shared_cache.close()
+
+
+def test_shared_probe_cache_torn_slot() -> None:
+    shared_cache = tablebases.SharedProbeCache.create(1)
+    try:
+        key = tablebases.probe_key("syzygy wdl", chess.Board())
+        shared_cache.store(key, 2)
+        offset = key % shared_cache.slots * tablebases.SLOT.size
+
+        # Another process wrote the result of its key, but not yet its key and check.
+        struct.pack_into("<i", shared_cache.buffer, offset + 8, -2)
+        assert shared_cache.load(key) is None
+
+        # Another process wrote its key, but not yet its result and check.
+        shared_cache.store(key, 2)
+        struct.pack_into("<Q", shared_cache.buffer, offset, key + shared_cache.slots)
+        assert shared_cache.load(key) is None
+        assert shared_cache.load(key + shared_cache.slots) is None
+    finally:
+        shared_cache.close()
+
+
+class FakeTablebase:
+    """Made-up, but consistent, wdl and dtz scores of positions, which depend on the position's Zobrist hash."""
+    def probe_dtz(self, board: chess.Board) -> int:
+        dtz = chess.polyglot.zobrist_hash(board) % 241 - 120
+        return 0 if abs(dtz) < 10 else dtz
+
+    def probe_wdl(self, board: chess.Board) -> int:
+        dtz = self.probe_dtz(board)
+        return 0 if dtz == 0 else (2 if abs(dtz) <= 100 else 1) * (1 if dtz > 0 else -1)
+
+
+def best_moves(moves: Dict[chess.Move, int]) -> Dict[chess.Move, int]:
+    best_wdl = max(map(engine_wrapper.dtz_to_wdl, moves.values()))
+    return {move: dtz for move, dtz in moves.items() if engine_wrapper.dtz_to_wdl(dtz) == best_wdl}
+
+
+def test_score_best_syzygy_moves() -> None:
+    """The best moves are the same as when the dtz of every move is probed on a copy of the board."""
+    tablebase = cast(chess.syzygy.Tablebase, FakeTablebase())
+    fens = ["8/8/8/4k3/8/8/2KQ4/7r w - - {} 60",
+            "8/3k4/8/8/3PK3/8/1r6/6R1 b - - {} 60",
+            "4k3/8/8/8/8/8/4P3/4K2R w K - {} 60",
+            "8/8/2n5/3k4/8/8/1B6/2BK4 w - - {} 60"]
+    for fen in fens:
+        for halfmove_clock in [0, 20, 60, 90]:
+            tablebases.probe_cache.results.clear()
+            board = chess.Board(fen.format(halfmove_clock))
+            old_moves: Dict[chess.Move, int] = {}
+            for move in board.legal_moves:
+                board_copy = board.copy()
+                board_copy.push(move)
+                old_moves[move] = engine_wrapper.dtz_scorer(tablebase, board_copy)
+
+            position = board.copy(stack=False)
+            wdls = engine_wrapper.score_syzygy_moves(position, engine_wrapper.syzygy_wdl_scorer, tablebase,
+                                                     list(position.legal_moves))
+            moves = engine_wrapper.score_best_syzygy_moves(position, wdls, tablebase)
+            assert best_moves(moves) == best_moves(old_moves)
+            assert list(moves) == [move for move in board.legal_moves if move in moves]
+            assert position == board